@@ -0,0 +1,253 @@
+# Supabase クライアントの管理層
+# 全セッションで共有する1つのクライアントに、接続プール (keep-alive)・リクエストごとのタイムアウト・
+# 冪等な読み込みだけの再試行 (ジッターつき指数バックオフ)・サーキットブレーカーを付ける。
+# バックエンドが落ちている間は、直近に成功した同じ読み込みの結果を返し、書き込みはすぐ失敗させる。
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+
+# 1プロセスあたりの上限。Streamlit のセッション数ではなく同時に走るクエリ数で決める
+POOL = {"max_connections": 20, "max_keepalive_connections": 10, "keepalive_expiry": 30.0}
+TIMEOUT = {"connect": 3.0, "read": 10.0, "write": 10.0, "pool": 2.0}
+RETRY = {"attempts": 3, "base": 0.2, "cap": 2.0, "deadline": 15.0}
+BREAKER = {"failures": 5, "cooldown": 30.0}
+# 障害時に返す直近の読み込み結果の上限 (合計と1件あたり、JSON にしたバイト数)
+READ_CACHE_BYTES = 16 * 1024 * 1024
+READ_CACHE_ENTRY_BYTES = 256 * 1024
+# 障害時に古い値を返さない (保持しない) テーブルと列
+UNCACHED_TABLES = {"wallpaper_blobs"}
+SECRET_COLUMNS = {"password"}
+# 読み込みだけのRPC (再試行・キャッシュしてよいもの)
+READ_RPCS = {"weekly_top", "weekly_rank_around", "user_balance"}
+# 一時的な障害とみなす HTTP ステータスと Postgres のエラーコード
+TRANSIENT_STATUS = {"408", "429", "502", "503", "504", "520", "522", "524"}
+TRANSIENT_PG = {"40001", "40P01", "57014", "57P01", "08000", "08003", "08006"}
+
+
+class BackendUnavailable(Exception):
+    """サーキットブレーカーが開いていて、キャッシュも無いとき"""
+
+
+def http_client(pool=None, timeout=None):
+    """keep-alive つきの接続プールとタイムアウトを持つ httpx クライアント"""
+    pool = {**POOL, **(pool or {})}
+    timeout = {**TIMEOUT, **(timeout or {})}
+    return httpx.Client(limits=httpx.Limits(**pool), timeout=httpx.Timeout(**timeout))
+
+
+def is_transient(e):
+    if isinstance(e, httpx.TransportError): return True
+    code = str(getattr(e, "code", "") or "")
+    return code in TRANSIENT_STATUS or code in TRANSIENT_PG
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"calls": 0, "retries": 0, "failures": 0, "breaker_opened": 0, "served_stale": 0, "rejected": 0}
+
+    def add(self, key, n=1):
+        with self._lock: self.counts[key] += n
+
+    def snapshot(self):
+        with self._lock: return dict(self.counts)
+
+
+class Breaker:
+    """連続して failures 回失敗したら cooldown 秒開く。開いた後は1本だけ試しに通す (半開)"""
+
+    def __init__(self, failures, cooldown, stats):
+        self.failures, self.cooldown, self.stats = failures, cooldown, stats
+        self._lock = threading.Lock()
+        self.streak = 0
+        self.opened_at = None
+        self.probing = False
+
+    def state(self):
+        with self._lock: return self._state()
+
+    def _state(self):
+        if self.opened_at is None: return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        with self._lock:
+            s = self._state()
+            if s == "closed": return True
+            if s == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.streak, self.opened_at, self.probing = 0, None, False
+
+    def failure(self):
+        with self._lock:
+            self.streak += 1
+            if self.probing or (self.opened_at is None and self.streak >= self.failures):
+                self.stats.add("breaker_opened")
+                self.opened_at, self.probing = time.monotonic(), False
+
+
+class StaleResult:
+    """キャッシュから返した結果 (postgrest の APIResponse と同じく .data を持つ)"""
+
+    def __init__(self, data):
+        self.data = data
+        self.stale = True
+
+
+def _size(data):
+    try: return len(json.dumps(data, default=str, ensure_ascii=False).encode())
+    except Exception: return None
+
+
+class ReadCache:
+    """LRU。合計 max_bytes を超えたら古いものから捨て、max_entry より大きい結果は持たない"""
+
+    def __init__(self, max_bytes, max_entry):
+        self.max_bytes, self.max_entry = max_bytes, max_entry
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> (data, バイト数)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items: return None
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, data):
+        n = _size(data)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old: self.bytes -= old[1]
+            if n is None or n > self.max_entry: return
+            self._items[key] = (data, n)
+            self.bytes += n
+            while self.bytes > self.max_bytes: self.bytes -= self._items.popitem(last=False)[1][1]
+
+
+class ManagedQuery:
+    def __init__(self, owner, inner, table):
+        self._owner = owner
+        self._inner = inner
+        self._table = table
+        self._op = "select"
+        self._key = [table]
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if not callable(attr): return attr
+
+        def call(*args, **kwargs):
+            if name in ("select", "insert", "upsert", "update", "delete"): self._op = name
+            self._key.append((name, repr(args), repr(sorted(kwargs.items()))))
+            self._inner = attr(*args, **kwargs)
+            return self
+        return call
+
+    def execute(self):
+        return self._owner.run(self._inner.execute, tuple(self._key), read=self._op == "select")
+
+
+class ManagedRpc:
+    def __init__(self, owner, inner, name, params):
+        self._owner, self._inner, self._name, self._params = owner, inner, name, params
+
+    def execute(self):
+        key = ("rpc", self._name, repr(sorted(self._params.items())))
+        return self._owner.run(lambda: self._inner.rpc(self._name, self._params).execute(), key, read=self._name in READ_RPCS)
+
+
+class ManagedClient:
+    """table() と rpc() に再試行・ブレーカー・読み込みキャッシュを付け、それ以外は元のクライアントへ渡す"""
+
+    def __init__(self, inner, http=None, retry=None, breaker=None):
+        self._inner = inner
+        self._http = http
+        self.retry = {**RETRY, **(retry or {})}
+        self.stats = Stats()
+        self.breaker = Breaker(stats=self.stats, **{**BREAKER, **(breaker or {})})
+        self.cache = ReadCache(READ_CACHE_BYTES, READ_CACHE_ENTRY_BYTES)
+
+    def table(self, name):
+        return ManagedQuery(self, self._inner.table(name), name)
+
+    def rpc(self, name, params=None):
+        return ManagedRpc(self, self._inner, name, params or {})
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    def run(self, send, key, read):
+        self.stats.add("calls")
+        if not self.breaker.allow(): return self._degraded(key, read, None)
+        deadline = time.monotonic() + self.retry["deadline"]
+        attempt = 0
+        while True:
+            try:
+                res = send()
+            except Exception as e:
+                # 4xx など、バックエンドが応答したエラーはそのまま返す
+                if not is_transient(e): self.breaker.success(); raise
+                self.breaker.failure()
+                attempt += 1
+                # 書き込みは届いたかどうか分からないので再試行しない
+                delay = random.uniform(0, min(self.retry["cap"], self.retry["base"] * 2 ** attempt))
+                if not read or attempt >= self.retry["attempts"] or time.monotonic() + delay > deadline or not self.breaker.allow():
+                    self.stats.add("failures")
+                    return self._degraded(key, read, e)
+                self.stats.add("retries")
+                time.sleep(delay)
+                continue
+            self.breaker.success()
+            if read and self._cacheable(key, res.data): self.cache.put(key, res.data)
+            return res
+
+    @staticmethod
+    def _cacheable(key, data):
+        if key[0] in UNCACHED_TABLES: return False
+        return not (isinstance(data, list) and data and isinstance(data[0], dict) and SECRET_COLUMNS & data[0].keys())
+
+    def _degraded(self, key, read, error):
+        cached = self.cache.get(key) if read else None
+        if cached is not None:
+            self.stats.add("served_stale")
+            return StaleResult(cached)
+        self.stats.add("rejected")
+        if error is not None: raise error
+        raise BackendUnavailable("backend is unavailable (circuit open)")
+
+    def pool_stats(self):
+        """httpx (httpcore) の接続プールの状態。取れなければ空"""
+        pool = getattr(getattr(self._http, "_transport", None), "_pool", None)
+        if pool is None: return {}
+        conns = list(getattr(pool, "connections", []) or [])
+        return {
+            "connections": len(conns),
+            "idle": sum(1 for c in conns if c.is_idle()),
+            "max_connections": POOL["max_connections"],
+        }
+
+    def snapshot(self):
+        return {**self.stats.snapshot(), **self.pool_stats(), "breaker": self.breaker.state()}
+
+    def prometheus(self):
+        """tracing.export_metrics に足す行"""
+        snap = self.snapshot()
+        lines = ["# TYPE study_app_backend_events_total counter"]
+        for k in ("calls", "retries", "failures", "breaker_opened", "served_stale", "rejected"):
+            lines.append(f'study_app_backend_events_total{{event="{k}"}} {snap[k]}')
+        lines.append("# TYPE study_app_backend_pool_connections gauge")
+        for k in ("connections", "idle"):
+            if k in snap: lines.append(f'study_app_backend_pool_connections{{state="{k}"}} {snap[k]}')
+        lines.append("# TYPE study_app_backend_breaker_open gauge")
+        lines.append(f"study_app_backend_breaker_open {0 if snap['breaker'] == 'closed' else 1}")
+        return lines
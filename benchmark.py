@@ -0,0 +1,243 @@
+# 画面操作ごとの再実行時間・往復回数・転送量を測るベンチマーク
+# Streamlit の AppTest (ヘッドレス) でアプリを動かし、ローカルの SQLite (local_db.py) に対して測る。
+#
+#   $ python benchmark.py --users 2000 --years 3 --runs 20
+#
+# 合成データ (ユーザー数 × 年数ぶんのログ) を作ってから、ログイン・ログインボーナス・タイマー・
+# 手動記録・タスク完了 (1件 / まとめて)・ショップ購入・分析/ランキング表示の各操作について p50 / p95 を出す。
+import argparse
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+BENCH_USER, BENCH_PASSWORD = "bench", "bench"
+SUBJECTS = ["数学", "英語", "国語", "理科", "社会", "プログラミング"]
+
+
+# --- 合成データ ---
+def generate(path, users, years, seed=0):
+    """users 人ぶんのユーザーと years 年ぶんのログ・タスク・集計を一括で作る。
+    BENCH_USER は毎日ログがある重いユーザーにする"""
+    from local_db import LocalClient
+    LocalClient(path)  # スキーマ作成
+    rng = random.Random(seed)
+    today = date.today()
+    days = years * 365
+    pw = hashlib.sha256(BENCH_PASSWORD.encode()).hexdigest()
+    conn = sqlite3.connect(path)
+    with conn:
+        names = [BENCH_USER] + [f"user{i:05d}" for i in range(users - 1)]
+        conn.executemany(
+            "insert or replace into users (username, password, nickname, xp, coins, last_login_date) values (?, ?, ?, ?, ?, ?)",
+            [(u, pw, u, 0, 0, str(today)) for u in names],
+        )
+        conn.executemany("insert into subjects (username, subject_name) values (?, ?)", [(u, s) for u in names for s in SUBJECTS[:3]])
+        for u in names:
+            heavy = u == BENCH_USER
+            n = days * 2 if heavy else rng.randint(0, days // 4)
+            rows = []
+            for _ in range(n):
+                d = today - timedelta(days=rng.randrange(days))
+                rows.append((u, rng.choice(SUBJECTS), rng.randint(10, 120), str(d), f"{d}T12:00:00.000000+00:00"))
+            conn.executemany("insert into study_logs (username, subject, duration_minutes, study_date, created_at) values (?, ?, ?, ?, ?)", rows)
+            tasks = [(u, f"task{i}", rng.choice(["未完了", "完了"]), str(today + timedelta(days=rng.randint(-days, 30))), "中") for i in range(200 if heavy else 10)]
+            conn.executemany("insert into tasks (username, task_name, status, due_date, priority) values (?, ?, ?, ?, ?)", tasks)
+            if heavy:
+                start = str(today - timedelta(days=days))
+                conn.executemany("insert into task_rules (username, task_name, priority, freq, start_date) values (?, ?, '中', ?, ?)", [(u, "復習", "daily", start), (u, "小テスト", "weekly", start)])
+        # ログは科目辞書 (subjects.id) を参照する。一覧に無い科目は hidden で足す
+        conn.execute("insert into subjects (username, subject_name, hidden) select distinct username, subject, 1 from study_logs where true on conflict (username, subject_name) do nothing")
+        conn.execute("update study_logs set subject_id = (select s.id from subjects s where s.username = study_logs.username and s.subject_name = study_logs.subject), subject = null")
+        conn.execute("delete from study_daily_rollup")
+        conn.execute(
+            "insert into study_daily_rollup (username, day, subject, minutes, sessions) "
+            "select l.username, l.study_date, coalesce(s.subject_name, ''), sum(l.duration_minutes), count(*) "
+            "from study_logs l left join subjects s on s.id = l.subject_id group by 1, 2, 3"
+        )
+        conn.execute("update users set xp = (select coalesce(sum(duration_minutes), 0) from study_logs l where l.username = users.username), coins = 100000")
+    conn.close()
+
+
+# --- 操作 ---
+def _button(at, label=None, key=None):
+    for b in at.button:
+        if (label is None or b.label == label) and (key is None or b.key == key): return b
+    raise LookupError(f"button not found: {label or key} (have {[b.label for b in at.button]}, exc={at.exception}, err={[e.value for e in at.error]})")
+
+
+def _login(at):
+    at.run()
+    at.selectbox[0].set_value("ログイン").run()
+    at.text_input[0].input(BENCH_USER)
+    at.text_input[1].input(BENCH_PASSWORD)
+    return _button(at, "ログイン").click()
+
+
+def _goto(at, page):
+    # フラグメントだけの再実行の後は、AppTest にそのフラグメントの要素しか無いのでページ全体を実行し直す
+    if not any(r.key == "page" for r in at.radio): at.run()
+    return at.radio(key="page").set_value(page)
+
+
+def _db(sql, *params):
+    conn = sqlite3.connect(os.environ["STUDY_APP_DB"])
+    with conn: conn.execute(sql, params)
+    conn.close()
+
+
+def flow_login(new_app):
+    at = new_app()
+    return [_login(at)]
+
+
+def flow_login_bonus(new_app):
+    at = new_app()
+    _db("update users set last_login_date = ?, version = version + 1 where username = ?", str(date.today() - timedelta(days=1)), BENCH_USER)
+    _db("delete from balance_ledger where username = ? and reason = 'login' and ref = ?", BENCH_USER, str(date.today()))
+    return [_login(at)]
+
+
+def flow_timer(new_app, at):
+    _goto(at, "⏱️ タイマー").run()
+    yield _button(at, "スタート").click()
+    yield _button(at, "⏹️ 終了して記録").click()
+
+
+def flow_manual_log(new_app, at):
+    _goto(at, "⏱️ タイマー").run()
+    next(n for n in at.number_input if n.label == "分 (m)").set_value(25)
+    next(t for t in at.text_input if t.label == "科目").input("数学")
+    yield _button(at, "記録").click()
+
+
+def flow_complete_task(new_app, at):
+    _db("insert into tasks (username, task_name, status, due_date, priority) values (?, 'bench-task', '未完了', ?, '中')", BENCH_USER, str(date.today()))
+    at.session_state["selected_date"] = str(date.today())
+    at.session_state["calendar_cache"] = {}  # 直接追加したタスクを表示させる
+    _goto(at, "📝 ToDo").run()
+    yield next(b for b in at.button if b.label == "完了: bench-task").click()
+
+
+def flow_bulk_tasks(new_app, at):
+    day = str(date.today())
+    for i in range(5): _db("insert into tasks (username, task_name, status, due_date, priority) values (?, ?, '未完了', ?, '中')", BENCH_USER, f"bulk{i}", day)
+    conn = sqlite3.connect(os.environ["STUDY_APP_DB"])
+    ids = [r[0] for r in conn.execute("select id from tasks where username = ? and due_date = ? and task_name like 'bulk%' and status = '未完了'", (BENCH_USER, day))]
+    conn.close()
+    at.session_state["selected_date"] = day
+    at.session_state["calendar_cache"] = {}
+    _goto(at, "📝 ToDo").run()
+    at.multiselect(key=f"bulk_{day}").set_value(ids).run()
+    yield _button(at, "まとめて完了").click()
+
+
+def flow_shop_buy(new_app, at):
+    _db("delete from user_items where username = ? and category = 'font'", BENCH_USER)
+    _db("insert into balance_ledger (username, reason, coin_delta) values (?, 'bench', 100000)", BENCH_USER)
+    at.session_state["profile"] = {}  # 直接消した持ち物を読み直させる
+    _goto(at, "🛒 ショップ").run()
+    yield _button(at, key="buy_f_ピクセル風").click()
+
+
+def flow_analytics(new_app, at):
+    _goto(at, "📝 ToDo").run()
+    yield _goto(at, "📊 分析")
+
+
+def flow_ranking(new_app, at):
+    _goto(at, "📝 ToDo").run()
+    yield _goto(at, "🏆 ランキング")
+
+
+FLOWS = {
+    "login": flow_login,
+    "login_bonus": flow_login_bonus,
+    "timer_start_stop": flow_timer,
+    "manual_log": flow_manual_log,
+    "complete_task": flow_complete_task,
+    "bulk_tasks": flow_bulk_tasks,
+    "shop_buy": flow_shop_buy,
+    "open_analytics": flow_analytics,
+    "open_ranking": flow_ranking,
+}
+# ログイン前から測る操作 (それ以外はログイン済みのセッションで測る)
+LOGIN_FLOWS = {"login", "login_bonus"}
+
+
+def measure(step):
+    """1回の再実行 (run) の時間・往復回数・転送量"""
+    from local_db import STATS
+    STATS.reset()
+    t0 = time.perf_counter()
+    at = step.run()
+    elapsed = time.perf_counter() - t0
+    if at.exception: raise RuntimeError(at.exception[0].message)
+    return {"seconds": elapsed, **STATS.snapshot()}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run(flows, runs, timeout):
+    from streamlit.testing.v1 import AppTest
+    new_app = lambda: AppTest.from_file(APP, default_timeout=timeout)
+    report = {}
+    for name in flows:
+        samples = []
+        session = None
+        for _ in range(runs):
+            if name in LOGIN_FLOWS:
+                samples += [measure(step) for step in FLOWS[name](new_app)]
+                continue
+            if session is None:
+                session = new_app()
+                _login(session).run()
+            samples += [measure(step) for step in FLOWS[name](new_app, session)]
+        secs = [s["seconds"] for s in samples]
+        report[name] = {
+            "reruns": len(samples),
+            "p50_ms": round(statistics.median(secs) * 1000, 1),
+            "p95_ms": round(percentile(secs, 0.95) * 1000, 1),
+            "round_trips": round(statistics.mean(s["calls"] for s in samples), 1),
+            "kb": round(statistics.mean(s["bytes"] for s in samples) / 1024, 1),
+        }
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser(description="再実行時間・往復回数・転送量のベンチマーク")
+    ap.add_argument("--db", help="既存のベンチマーク用DB (省略時は一時ファイルに生成)")
+    ap.add_argument("--users", type=int, default=500)
+    ap.add_argument("--years", type=int, default=2)
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--timeout", type=float, default=60)
+    ap.add_argument("--flows", nargs="*", default=list(FLOWS), choices=list(FLOWS))
+    ap.add_argument("--json", help="結果を JSON で書き出すパス")
+    args = ap.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="study-bench-"), "bench.db")
+    if not args.db or not os.path.exists(path):
+        t0 = time.perf_counter()
+        generate(path, args.users, args.years)
+        print(f"generated {args.users} users x {args.years} years in {time.perf_counter() - t0:.1f}s -> {path}")
+    os.environ["STUDY_APP_DB"] = path
+
+    report = run(args.flows, args.runs, args.timeout)
+    print(f"{'flow':<18}{'reruns':>8}{'p50 ms':>10}{'p95 ms':>10}{'trips':>8}{'KB':>10}")
+    for name, r in report.items():
+        print(f"{name:<18}{r['reruns']:>8}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['round_trips']:>8}{r['kb']:>10}")
+    if args.json:
+        with open(args.json, "w") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,747 @@
+# ローカル用ストレージ (SQLite)
+# streamlit_app.py が使う Supabase クライアントの table(...).select/insert/update/upsert/delete
+# + eq/neq/gt/gte/lt/lte/in_/order/limit/execute と rpc(name, params).execute() の部分だけを同じ形で実装する。
+# RPC は supabase/migrations/ の関数と同じ処理を Python で1トランザクションにして行う。
+# Supabase なしでアプリを動かしたり、1台で負荷試験をしたりするためのもの。
+import json
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime, timedelta, timezone
+
+import pandas as pd
+
+from backend import READ_RPCS
+
+SCHEMA = """
+create table if not exists users (
+    username text primary key,
+    password text,
+    nickname text,
+    xp integer not null default 0,
+    coins integer not null default 0,
+    unlocked_themes text default '標準',
+    current_theme text default '標準',
+    current_title text default '見習い',
+    unlocked_titles text default '見習い',
+    current_wallpaper text default '真っ黒',
+    unlocked_wallpapers text default '真っ黒',
+    custom_title_unlocked integer default 0,
+    custom_wallpaper_unlocked integer default 0,
+    custom_bg_data text,
+    custom_bg_hash text,
+    daily_goal integer default 60,
+    last_goal_reward_date text,
+    last_login_date text,
+    version integer not null default 0,
+    updated_at text
+);
+
+create table if not exists study_logs (
+    id integer primary key autoincrement,
+    username text not null,
+    subject text,
+    subject_id integer,
+    duration_minutes integer not null,
+    study_date text not null,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+create index if not exists study_logs_user_date on study_logs (username, study_date);
+create index if not exists study_logs_user_created on study_logs (username, created_at);
+
+create table if not exists tasks (
+    id integer primary key autoincrement,
+    username text not null,
+    task_name text,
+    status text default '未完了',
+    due_date text,
+    priority text,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+create index if not exists tasks_user_due on tasks (username, due_date);
+
+create table if not exists task_rules (
+    id integer primary key autoincrement,
+    username text not null,
+    task_name text not null,
+    priority text,
+    freq text not null check (freq in ('daily', 'weekly')),
+    start_date text not null,
+    until_date text,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+create index if not exists task_rules_user on task_rules (username, start_date);
+
+create table if not exists subjects (
+    id integer primary key autoincrement,
+    username text not null,
+    subject_name text not null,
+    hidden integer not null default 0
+);
+create index if not exists subjects_user on subjects (username);
+
+create table if not exists study_daily_rollup (
+    username text not null,
+    day text not null,
+    subject text not null,
+    minutes integer not null default 0,
+    sessions integer not null default 0,
+    primary key (username, day, subject)
+);
+create index if not exists study_daily_rollup_day on study_daily_rollup (day);
+
+create table if not exists wallpaper_blobs (
+    hash text not null,
+    variant text not null,
+    mime text not null,
+    width integer not null,
+    height integer not null,
+    bytes integer not null,
+    data text not null,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    primary key (hash, variant)
+);
+
+create table if not exists study_sessions (
+    username text primary key,
+    subject text not null,
+    start_time real not null,
+    heartbeat_at text
+);
+
+create table if not exists user_items (
+    username text not null,
+    category text not null,
+    item text not null,
+    acquired_at text not null default (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    primary key (username, category, item)
+);
+
+create table if not exists study_log_imports (
+    import_id text not null,
+    username text not null,
+    subject text,
+    duration_minutes integer not null,
+    study_date text not null,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+create index if not exists study_log_imports_id on study_log_imports (import_id, username);
+
+create table if not exists balance_ledger (
+    id integer primary key autoincrement,
+    username text not null,
+    reason text not null,
+    ref text,
+    xp_delta integer not null default 0,
+    coin_delta integer not null default 0,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+create index if not exists balance_ledger_user_time on balance_ledger (username, created_at);
+create index if not exists balance_ledger_user_ref on balance_ledger (username, reason, ref);
+create unique index if not exists balance_ledger_once on balance_ledger (username, reason, ref) where reason in ('goal', 'login');
+
+create table if not exists balance_snapshots (
+    username text primary key,
+    until text not null,
+    xp integer not null,
+    coins integer not null,
+    entries integer not null
+);
+
+create table if not exists shop_items (
+    category text not null,
+    item text not null,
+    price integer not null,
+    primary key (category, item)
+);
+insert or ignore into shop_items (category, item, price) values
+    ('font', 'ピクセル風', 500), ('font', '手書き風', 800), ('font', 'ポップ', 1000),
+    ('font', '明朝体', 1200), ('font', '筆文字', 1500),
+    ('wallpaper', '夕焼け', 500), ('wallpaper', '夜空', 800), ('wallpaper', 'ダンジョン', 1200), ('wallpaper', '王宮', 2000),
+    ('pass', 'custom_title', 9999), ('pass', 'custom_wallpaper', 9999),
+    ('gacha', 'title', 100);
+
+create table if not exists gacha_pool (
+    item text primary key,
+    rarity text not null default 'N',
+    weight integer not null default 1
+);
+insert or ignore into gacha_pool (item, rarity, weight) values
+    ('駆け出し', 'N', 20), ('努力家', 'N', 20), ('夜更かし', 'N', 20),
+    ('集中王', 'R', 15), ('天才', 'R', 15),
+    ('覚醒者', 'SR', 4), ('大賢者', 'SR', 4),
+    ('神童', 'SSR', 2);
+"""
+
+# SQLite に真偽値型がないので、読み出し時に bool へ戻す列
+BOOL_COLUMNS = {"custom_title_unlocked", "custom_wallpaper_unlocked", "hidden"}
+# 既存のファイルに後から足した列 (create table if not exists では足されない)
+ADDED_COLUMNS = {"subjects": {"hidden": "integer not null default 0"}, "study_logs": {"subject_id": "integer"}, "tasks": {"rule_id": "integer"}}
+# 旧形式 (users のカンマ区切り文字列) から user_items へ移す列 (0007_user_items.sql と同じ)
+LEGACY_ITEM_COLUMNS = {"unlocked_themes": "font", "unlocked_wallpapers": "wallpaper", "unlocked_titles": "title"}
+LEGACY_PASS_COLUMNS = {"custom_title_unlocked": "custom_title", "custom_wallpaper_unlocked": "custom_wallpaper"}
+_IDENT = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+JST = timezone(timedelta(hours=9))
+RANK_COLUMNS = ["rank", "username", "nickname", "current_title", "duration_minutes"]
+GACHA_MAX_PULLS = 100
+IMPORT_CHUNK = 1000
+
+
+def _ident(name):
+    name = name.strip()
+    if not _IDENT.match(name): raise ValueError(f"invalid identifier: {name!r}")
+    return f'"{name}"'
+
+
+def _value(v):
+    if isinstance(v, bool): return int(v)
+    if hasattr(v, "isoformat"): return v.isoformat()
+    return v
+
+
+class Stats:
+    """往復回数と転送バイト数 (結果を JSON にした大きさ) の集計。ベンチマーク用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls, self.bytes = 0, 0
+
+    def add(self, n_bytes):
+        with self._lock:
+            self.calls += 1
+            self.bytes += n_bytes
+
+    def snapshot(self):
+        with self._lock:
+            return {"calls": self.calls, "bytes": self.bytes}
+
+
+STATS = Stats()
+
+
+class Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class Query:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = _ident(table)
+        self.op = "select"
+        self.columns = "*"
+        self.payload = None
+        self.on_conflict = None
+        self.filters = []
+        self.orders = []
+        self.limit_n = None
+
+    # --- 操作 ---
+    def select(self, columns="*"):
+        self.op, self.columns = "select", columns
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload = "insert", rows if isinstance(rows, list) else [rows]
+        return self
+
+    def upsert(self, rows, on_conflict=None):
+        self.op, self.payload, self.on_conflict = "upsert", rows if isinstance(rows, list) else [rows], on_conflict
+        return self
+
+    def update(self, fields):
+        self.op, self.payload = "update", fields
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    # --- 条件 ---
+    def _filter(self, col, sql_op, value):
+        self.filters.append((f"{_ident(col)} {sql_op} ?", [_value(value)]))
+        return self
+
+    def eq(self, col, value): return self._filter(col, "=", value)
+    def neq(self, col, value): return self._filter(col, "!=", value)
+    def gt(self, col, value): return self._filter(col, ">", value)
+    def gte(self, col, value): return self._filter(col, ">=", value)
+    def lt(self, col, value): return self._filter(col, "<", value)
+    def lte(self, col, value): return self._filter(col, "<=", value)
+
+    def in_(self, col, values):
+        values = list(values)
+        if not values:
+            self.filters.append(("0", []))
+        else:
+            self.filters.append((f"{_ident(col)} in ({', '.join('?' * len(values))})", [_value(v) for v in values]))
+        return self
+
+    def order(self, col, desc=False):
+        self.orders.append(f"{_ident(col)} {'desc' if desc else 'asc'}")
+        return self
+
+    def limit(self, n):
+        self.limit_n = int(n)
+        return self
+
+    # --- 実行 ---
+    def _where(self):
+        if not self.filters: return "", []
+        return " where " + " and ".join(f for f, _ in self.filters), [p for _, ps in self.filters for p in ps]
+
+    def _select_cols(self):
+        if self.columns.strip() == "*": return "*"
+        return ", ".join(_ident(c) for c in self.columns.split(","))
+
+    def execute(self):
+        where, params = self._where()
+        if self.op == "select":
+            sql = f"select {self._select_cols()} from {self.table}{where}"
+            if self.orders: sql += " order by " + ", ".join(self.orders)
+            if self.limit_n is not None: sql += f" limit {self.limit_n}"
+            return Result(self.client._record(self.client._run(sql, params)))
+        if self.op in ("insert", "upsert"):
+            out = []
+            for row in self.payload:
+                cols = list(row)
+                sql = f"insert into {self.table} ({', '.join(_ident(c) for c in cols)}) values ({', '.join('?' * len(cols))})"
+                if self.op == "upsert":
+                    keys = [k.strip() for k in (self.on_conflict or "id").split(",")]
+                    sets = [c for c in cols if c not in keys]
+                    sql += f" on conflict ({', '.join(_ident(k) for k in keys)}) do "
+                    sql += ("update set " + ", ".join(f"{_ident(c)} = excluded.{_ident(c)}" for c in sets)) if sets else "nothing"
+                out += self.client._run(sql + " returning *", [_value(row[c]) for c in cols])
+            return Result(self.client._record(out))
+        if self.op == "update":
+            cols = list(self.payload)
+            sets = [f"{_ident(c)} = ?" for c in cols]
+            # Postgres 側の users_version トリガーと同じく、更新のたびに version を進める
+            if self.table == '"users"': sets += ['"version" = "version" + 1', "\"updated_at\" = strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')"]
+            sql = f"update {self.table} set {', '.join(sets)}{where} returning *"
+            return Result(self.client._record(self.client._run(sql, [_value(self.payload[c]) for c in cols] + params)))
+        if self.op == "delete":
+            return Result(self.client._record(self.client._run(f"delete from {self.table}{where} returning *", params)))
+        raise ValueError(self.op)
+
+
+class Rpc:
+    def __init__(self, client, name, params):
+        if name not in RPCS: raise ValueError(f"unknown rpc: {name!r}")
+        self.client, self.name, self.params = client, name, params
+
+    def execute(self):
+        # 読み込みだけのRPCは書き込みロックを取らない
+        with nullcontext() if self.name in READ_RPCS else self.client.transaction():
+            return Result(RPCS[self.name](self.client, self.params))
+
+
+class LocalClient:
+    """スレッドごとに1本の接続を使い回す SQLite クライアント (WAL モード)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.conn().executescript(SCHEMA)
+        self._backfill_user_items()
+        self._backfill_ledger()
+        self._migrate_subjects()
+        self._migrate_tasks()
+
+    def conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            c.row_factory = sqlite3.Row
+            c.execute("pragma journal_mode = wal")
+            c.execute("pragma synchronous = normal")
+            c.execute("pragma busy_timeout = 30000")
+            self._local.conn = c
+            self._local.depth = 0
+        return c
+
+    def _backfill_user_items(self):
+        """user_items が空のときだけ、旧形式の文字列から持ち物を移す"""
+        c = self.conn()
+        if c.execute("select 1 from user_items limit 1").fetchone(): return
+        rows = []
+        for r in c.execute(f"select username, {', '.join(list(LEGACY_ITEM_COLUMNS) + list(LEGACY_PASS_COLUMNS))} from users"):
+            rows += [(r["username"], cat, x.strip()) for col, cat in LEGACY_ITEM_COLUMNS.items() for x in (r[col] or "").split(",") if x.strip()]
+            rows += [(r["username"], "pass", item) for col, item in LEGACY_PASS_COLUMNS.items() if r[col]]
+        c.execute("begin")
+        c.executemany("insert or ignore into user_items (username, category, item) values (?, ?, ?)", rows)
+        c.execute("commit")
+
+    def _backfill_ledger(self):
+        """balance_ledger が空のときだけ、users の xp / coins を開始残高として移す (0010_balance_ledger.sql と同じ)"""
+        c = self.conn()
+        if c.execute("select 1 from balance_ledger limit 1").fetchone(): return
+        c.execute("begin")
+        c.execute("insert into balance_ledger (username, reason, xp_delta, coin_delta) select username, 'opening', xp, coins from users")
+        c.execute("insert or ignore into balance_ledger (username, reason, ref) select username, 'goal', last_goal_reward_date from users where last_goal_reward_date is not null")
+        c.execute("insert or ignore into balance_ledger (username, reason, ref) select username, 'login', last_login_date from users where last_login_date is not null")
+        c.execute("commit")
+
+    def _migrate_subjects(self):
+        """科目を辞書 (subjects.id) にし、ログに subject_id を入れる (0011_subject_ids.sql と同じ)"""
+        c = self.conn()
+        c.execute("begin immediate")
+        if c.execute("select 1 from sqlite_master where name = 'subjects_user_name'").fetchone():
+            c.execute("commit")
+            return
+        self._add_columns(c)
+        c.execute("delete from subjects where id not in (select min(id) from subjects group by username, subject_name)")
+        c.execute("create unique index subjects_user_name on subjects (username, subject_name)")
+        c.execute("insert or ignore into subjects (username, subject_name, hidden) select distinct username, subject, 1 from study_logs where coalesce(subject, '') <> ''")
+        c.execute("update study_logs set subject_id = (select s.id from subjects s where s.username = study_logs.username and s.subject_name = study_logs.subject) where subject_id is null")
+        c.execute("create index if not exists study_logs_subject on study_logs (subject_id)")
+        c.execute("commit")
+
+    def _migrate_tasks(self):
+        """繰り返しタスクの回を tasks.rule_id で持てるようにする (0012_task_engine.sql と同じ)"""
+        c = self.conn()
+        c.execute("begin immediate")
+        if not c.execute("select 1 from sqlite_master where name = 'tasks_rule_day'").fetchone():
+            self._add_columns(c)
+            c.execute("create unique index tasks_rule_day on tasks (rule_id, due_date) where rule_id is not null")
+        c.execute("commit")
+
+    def _add_columns(self, c):
+        for table, cols in ADDED_COLUMNS.items():
+            have = {r["name"] for r in c.execute(f"pragma table_info({table})")}
+            for col, decl in cols.items():
+                if col not in have: c.execute(f"alter table {table} add column {col} {decl}")
+
+    def _run(self, sql, params):
+        cur = self.conn().execute(sql, params)
+        rows = cur.fetchall()
+        return [{k: (bool(r[k]) if k in BOOL_COLUMNS and r[k] is not None else r[k]) for k in r.keys()} for r in rows]
+
+    def _record(self, data):
+        # トランザクション内 (RPC の代替) は Supabase では1往復なので、まとめて1回と数える
+        n = len(json.dumps(data, default=str, ensure_ascii=False).encode())
+        if self._local.depth: self._local.tx_bytes += n
+        else: STATS.add(n)
+        return data
+
+    def table(self, name):
+        return Query(self, name)
+
+    def rpc(self, name, params):
+        return Rpc(self, name, params)
+
+    @contextmanager
+    def transaction(self):
+        """RPC の代替処理を1トランザクションで実行する (入れ子は外側にまとめる)"""
+        c = self.conn()
+        if self._local.depth == 0:
+            c.execute("begin immediate")
+            self._local.tx_bytes = 0
+        self._local.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0: c.execute("rollback")
+            raise
+        else:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                c.execute("commit")
+                STATS.add(self._local.tx_bytes)
+
+
+# --- RPC の代替 (supabase/migrations/ の関数と同じ処理) ---
+# db は LocalClient。Rpc.execute() が書き込みのRPCを1トランザクションにまとめる。
+def _bump_rollup(db, u, day, subject, dm, ds):
+    subject = subject or ""
+    cur = db.table("study_daily_rollup").select("minutes, sessions").eq("username", u).eq("day", day).eq("subject", subject).execute()
+    if not cur.data:
+        if ds > 0: db.table("study_daily_rollup").insert({"username": u, "day": day, "subject": subject, "minutes": dm, "sessions": ds}).execute()
+        return
+    q = db.table("study_daily_rollup")
+    if cur.data[0]['sessions'] + ds <= 0: q = q.delete()
+    else: q = q.update({"minutes": cur.data[0]['minutes'] + dm, "sessions": cur.data[0]['sessions'] + ds})
+    q.eq("username", u).eq("day", day).eq("subject", subject).execute()
+
+
+def _update_user(db, u, fields):
+    res = db.table("users").update(fields).eq("username", u).execute()
+    return res.data[0].get("version") if res.data else None
+
+
+def _version(db, u):
+    res = db.table("users").select("version").eq("username", u).execute()
+    return res.data[0]['version'] if res.data else None
+
+
+# 残高台帳 (0010_balance_ledger.sql)
+# 残高 = スナップショット + created_at >= until の行の合計。末尾が LEDGER_SNAPSHOT_EVERY 行を超えたら
+# LEDGER_SNAPSHOT_LAG より前の行をスナップショットへ畳む。
+LEDGER_SNAPSHOT_EVERY = 64
+LEDGER_SNAPSHOT_LAG = timedelta(minutes=5)
+LEDGER_COLUMNS = ["username", "reason", "ref", "xp_delta", "coin_delta", "created_at"]
+
+
+def ledger_totals(entries):
+    """台帳の行 (DataFrame) を username ごとに合計する。監査や報酬の規則を変えた後の再計算もまとめてこれで行う"""
+    return entries.groupby("username").agg(xp=("xp_delta", "sum"), coins=("coin_delta", "sum"), entries=("xp_delta", "size"))
+
+
+def _ledger_cutoff():
+    return (datetime.now(timezone.utc) - LEDGER_SNAPSHOT_LAG).isoformat(timespec="milliseconds")
+
+
+def _snapshot(db, u):
+    res = db.table("balance_snapshots").select("*").eq("username", u).execute()
+    return res.data[0] if res.data else {"username": u, "until": "", "xp": 0, "coins": 0, "entries": 0}
+
+
+def _ledger_tail(db, u, snap):
+    res = db.table("balance_ledger").select(", ".join(LEDGER_COLUMNS)).eq("username", u).gte("created_at", snap['until']).execute()
+    return pd.DataFrame(res.data, columns=LEDGER_COLUMNS)
+
+
+def _balance(snap, tail):
+    return {"xp": int(snap['xp'] + tail['xp_delta'].sum()), "coins": int(snap['coins'] + tail['coin_delta'].sum())}
+
+
+def _user_balance(db, p):
+    snap = _snapshot(db, p["p_username"])
+    return _balance(snap, _ledger_tail(db, p["p_username"], snap))
+
+
+def _post_ledger(db, u, reason, ref=None, xp=0, coins=0):
+    db.table("balance_ledger").insert({"username": u, "reason": reason, "ref": None if ref is None else str(ref), "xp_delta": xp, "coin_delta": coins}).execute()
+    snap = _snapshot(db, u)
+    tail = _ledger_tail(db, u, snap)
+    if len(tail) > LEDGER_SNAPSHOT_EVERY:
+        cutoff = _ledger_cutoff()
+        done = tail[tail['created_at'] < cutoff]
+        if cutoff > snap['until']:
+            db.table("balance_snapshots").upsert({
+                "username": u, "until": cutoff, "entries": snap['entries'] + len(done), **_balance(snap, done),
+            }, on_conflict="username").execute()
+    return _balance(snap, tail)
+
+
+def _post_once(db, u, reason, ref, xp=0, coins=0):
+    """(reason, ref) がまだ無いときだけ足す (balance_ledger_once)。足さなければ None"""
+    if db.table("balance_ledger").select("username").eq("username", u).eq("reason", reason).eq("ref", str(ref)).limit(1).execute().data: return None
+    return _post_ledger(db, u, reason, ref, xp, coins)
+
+
+def _spend_coins(db, u, reason, ref, coins):
+    """残高が足りるときだけ引く。足りなければ None"""
+    if _user_balance(db, {"p_username": u})['coins'] < coins: return None
+    return _post_ledger(db, u, reason, ref, 0, -coins)
+
+
+def _rebuild_balance_snapshots(db, p):
+    cutoff = _ledger_cutoff()
+    entries = pd.DataFrame(db.table("balance_ledger").select(", ".join(LEDGER_COLUMNS)).lt("created_at", cutoff).execute().data, columns=LEDGER_COLUMNS)
+    rows = [{"username": u, "until": cutoff, "xp": int(r.xp), "coins": int(r.coins), "entries": int(r.entries)} for u, r in ledger_totals(entries).iterrows()]
+    db.table("balance_snapshots").delete().execute()
+    for i in range(0, len(rows), 500): db.table("balance_snapshots").insert(rows[i:i + 500]).execute()
+    return len(rows)
+
+
+def _grant_login_bonus(db, p):
+    u = p["p_username"]
+    granted = _post_once(db, u, "login", p["p_today"], coins=50) is not None
+    ud = db.table("users").select("last_login_date, version").eq("username", u).execute().data
+    ver = ud[0]['version'] if ud else None
+    if ud and ud[0]['last_login_date'] != p["p_today"]: ver = _update_user(db, u, {"last_login_date": p["p_today"]})
+    return {"granted": granted, "coins": _user_balance(db, p)['coins'], "version": ver}
+
+
+def _subject_ref(db, u, name):
+    """科目名から辞書の id を引く (無ければ一覧に出ない行として足す)。空なら None"""
+    if not name: return None
+    res = db.table("subjects").select("id").eq("username", u).eq("subject_name", name).execute()
+    if res.data: return res.data[0]['id']
+    return db.table("subjects").insert({"username": u, "subject_name": name, "hidden": True}).execute().data[0]['id']
+
+
+def _subject_names(db, u):
+    return {r['id']: r['subject_name'] for r in db.table("subjects").select("id, subject_name").eq("username", u).execute().data}
+
+
+def _commit_study_log(db, p):
+    u = p["p_username"]
+    log = db.table("study_logs").insert({"username": u, "subject_id": _subject_ref(db, u, p["p_subject"]), "duration_minutes": p["p_minutes"], "study_date": p["p_study_date"]}).execute().data[0]
+    _bump_rollup(db, u, p["p_study_date"], p["p_subject"], p["p_minutes"], 1)
+    res = db.table("users").select("daily_goal, version").eq("username", u).execute()
+    if not res.data: return {"minutes": p["p_minutes"], "xp": 0, "coins": 0, "goal_reached": False}
+    ud = res.data[0]
+    logs = db.table("study_logs").select("duration_minutes").eq("username", u).eq("study_date", p["p_today"]).execute()
+    total_today = sum(l['duration_minutes'] for l in logs.data)
+    goal_reached = total_today >= (ud.get('daily_goal') or 60) and _post_once(db, u, "goal", p["p_today"], coins=100) is not None
+    ver = _update_user(db, u, {"last_goal_reward_date": p["p_today"]}) if goal_reached else ud['version']
+    bal = _post_ledger(db, u, "study", log['id'], p["p_minutes"], p["p_minutes"])
+    return {"minutes": p["p_minutes"], **bal, "goal_reached": goal_reached, "version": ver}
+
+
+def _revert_study_log(db, p):
+    u = p["p_username"]
+    res = db.table("study_logs").delete().eq("id", p["p_log_id"]).eq("username", u).execute()
+    if not res.data: return {"minutes": 0, "xp": None, "coins": None}
+    log = res.data[0]
+    m = log['duration_minutes']
+    subject = _subject_names(db, u).get(log['subject_id'], log.get('subject')) if log.get('subject_id') else log.get('subject')
+    _bump_rollup(db, u, str(log['study_date']).split("T")[0], subject, -m, -1)
+    # 記録したときに付けた分をそのまま戻す (台帳に無い移行前のログは分数ぶん)
+    grant = db.table("balance_ledger").select("xp_delta, coin_delta").eq("username", u).eq("reason", "study").eq("ref", str(p["p_log_id"])).execute().data
+    xp = sum(g['xp_delta'] for g in grant) if grant else m
+    coins = sum(g['coin_delta'] for g in grant) if grant else m
+    bal = _post_ledger(db, u, "study_revert", p["p_log_id"], -xp, -coins)
+    return {"minutes": m, **bal, "version": _version(db, u)}
+
+
+def _task_rule_has(rule, day):
+    """繰り返しの rule に day (YYYY-MM-DD) の回があるか"""
+    start, until = str(rule['start_date'])[:10], rule['until_date'] and str(rule['until_date'])[:10]
+    if day < start or (until and day > until): return False
+    return rule['freq'] == "daily" or (date.fromisoformat(day) - date.fromisoformat(start)).days % 7 == 0
+
+
+def _commit_tasks(db, p):
+    u, action = p["p_username"], p["p_action"]
+    if action not in ("complete", "delete"): return {"completed": 0, "deleted": 0, "xp": None, "coins": None}
+    rules = {r['id']: r for r in db.table("task_rules").select("*").eq("username", u).in_("id", set(p["p_rule_ids"])).execute().data}
+    occ = [(rules[r], d) for r, d in zip(p["p_rule_ids"], p["p_days"]) if r in rules and _task_rule_has(rules[r], d)]
+    if action == "delete":
+        rows = db.table("tasks").select("id, rule_id").eq("username", u).in_("id", p["p_task_ids"]).execute().data
+        db.table("tasks").delete().in_("id", [r['id'] for r in rows if r['rule_id'] is None]).execute()
+        db.table("tasks").update({"status": "削除"}).in_("id", [r['id'] for r in rows if r['rule_id'] is not None]).execute()
+        for rule, d in occ:
+            if not db.table("tasks").update({"status": "削除"}).eq("rule_id", rule['id']).eq("due_date", d).execute().data:
+                db.table("tasks").insert({"username": u, "task_name": rule['task_name'], "status": "削除", "due_date": d, "priority": rule['priority'], "rule_id": rule['id']}).execute()
+        return {"completed": 0, "deleted": len(rows) + len(occ), "xp": None, "coins": None}
+    ids = [r['id'] for r in db.table("tasks").update({"status": "完了"}).eq("username", u).in_("id", p["p_task_ids"]).eq("status", "未完了").execute().data]
+    for rule, d in occ:
+        if db.table("tasks").select("id").eq("rule_id", rule['id']).eq("due_date", d).execute().data: continue
+        ids += [r['id'] for r in db.table("tasks").insert({"username": u, "task_name": rule['task_name'], "status": "完了", "due_date": d, "priority": rule['priority'], "rule_id": rule['id']}).execute().data]
+    if not ids: return {"completed": 0, "deleted": 0, "xp": None, "coins": None}
+    bal = _post_ledger(db, u, "task", ",".join(map(str, ids)), 10 * len(ids), 10 * len(ids))
+    return {"completed": len(ids), "deleted": 0, **bal, "version": _version(db, u)}
+
+
+def _rebuild_study_rollup(db, p):
+    u = p.get("p_username")
+    q = db.table("study_logs").select("username, study_date, subject, subject_id, duration_minutes")
+    if u: q = q.eq("username", u)
+    df = pd.DataFrame(q.execute().data)
+    dq = db.table("study_daily_rollup").delete()
+    (dq.eq("username", u) if u else dq.neq("username", "")).execute()
+    if df.empty: return 0
+    sq = db.table("subjects").select("id, subject_name")
+    names = {r['id']: r['subject_name'] for r in (sq.eq("username", u) if u else sq).execute().data}
+    df['day'] = df['study_date'].astype(str).str.split("T").str[0]
+    df['subject'] = df['subject_id'].map(names).fillna(df['subject']).fillna("")
+    agg = df.groupby(['username', 'day', 'subject'])['duration_minutes'].agg(minutes='sum', sessions='count').reset_index()
+    rows = agg.astype({"minutes": int, "sessions": int}).to_dict("records")
+    for i in range(0, len(rows), 500):
+        db.table("study_daily_rollup").insert(rows[i:i + 500]).execute()
+    return len(rows)
+
+
+def _weekly_board(db):
+    start = (datetime.now(JST).date() - timedelta(days=7)).strftime('%Y-%m-%d')
+    res = db.table("study_daily_rollup").select("username, minutes").gte("day", start).execute()
+    df = pd.DataFrame(res.data, columns=["username", "minutes"])
+    df = df.groupby('username')['minutes'].sum().reset_index()
+    df = df[df['minutes'] > 0].sort_values(['minutes', 'username'], ascending=[False, True], ignore_index=True)
+    df['rank'] = df.index + 1
+    return df.rename(columns={"minutes": "duration_minutes"})
+
+
+def _board_rows(db, df):
+    if df.empty: return []
+    users = db.table("users").select("username, nickname, current_title").in_("username", df['username'].tolist()).execute().data
+    df = pd.merge(df, pd.DataFrame(users, columns=["username", "nickname", "current_title"]), on='username', how='left')
+    return df[RANK_COLUMNS].to_dict("records")
+
+
+def _weekly_top(db, p):
+    return _board_rows(db, _weekly_board(db).head(p["p_limit"]))
+
+
+def _weekly_rank_around(db, p):
+    df = _weekly_board(db)
+    me = df.loc[df['username'] == p["p_username"], 'rank']
+    if me.empty: return []
+    r = int(me.iloc[0])
+    return _board_rows(db, df[df['rank'].between(r - p["p_radius"], r + p["p_radius"])])
+
+
+def _price(db, category, item):
+    res = db.table("shop_items").select("price").eq("category", category).eq("item", item).execute()
+    return res.data[0]['price'] if res.data else None
+
+
+def _user_state(db, u):
+    ver = _version(db, u)
+    return {"coins": _user_balance(db, {"p_username": u})['coins'], "version": ver} if ver is not None else {"coins": None, "version": None}
+
+
+def _purchase_item(db, p):
+    price = _price(db, p["p_category"], p["p_item"])
+    if price is None: return {"status": "unknown"}
+    u = p["p_username"]
+    row = {"username": u, "category": p["p_category"], "item": p["p_item"]}
+    if not db.table("user_items").upsert(row, on_conflict="username, category, item").execute().data:
+        return {"status": "owned", **_user_state(db, u)}
+    bal = _spend_coins(db, u, "purchase", f"{p['p_category']}:{p['p_item']}", price)
+    if bal is None:
+        db.table("user_items").delete().eq("username", u).eq("category", p["p_category"]).eq("item", p["p_item"]).execute()
+        return {"status": "insufficient", **_user_state(db, u)}
+    return {"status": "ok", "coins": bal["coins"], "version": _version(db, u)}
+
+
+def _draw_titles(db, p):
+    titles, price = p["p_titles"], _price(db, "gacha", "title")
+    pool = {r['item'] for r in db.table("gacha_pool").select("item").execute().data}
+    if price is None or not 0 < len(titles) <= GACHA_MAX_PULLS or p["p_equip"] not in titles or any(t not in pool for t in titles): return {"status": "unknown"}
+    u = p["p_username"]
+    cost = price * len(titles)
+    bal = _spend_coins(db, u, "gacha", len(titles), cost)
+    if bal is None: return {"status": "insufficient", **_user_state(db, u)}
+    ver = _update_user(db, u, {"current_title": p["p_equip"]})
+    rows = [{"username": u, "category": "title", "item": t} for t in dict.fromkeys(titles)]
+    new = db.table("user_items").upsert(rows, on_conflict="username, category, item").execute().data
+    return {"status": "ok", "coins": bal["coins"], "version": ver, "new": [r['item'] for r in new]}
+
+
+def _commit_study_log_import(db, p):
+    u = p["p_username"]
+    staged = db.table("study_log_imports").delete().eq("import_id", p["p_import_id"]).eq("username", u).execute().data
+    if not staged: return {"rows": 0, "minutes": 0, "xp": None, "coins": None}
+    ids = {name: _subject_ref(db, u, name) for name in {r['subject'] for r in staged if r['subject']}}
+    rows = [{"username": u, "subject_id": ids.get(r['subject']), "duration_minutes": r['duration_minutes'], "study_date": r['study_date']} for r in staged]
+    for i in range(0, len(rows), IMPORT_CHUNK): db.table("study_logs").insert(rows[i:i + IMPORT_CHUNK]).execute()
+    _rebuild_study_rollup(db, {"p_username": u})
+    minutes = sum(r['duration_minutes'] for r in rows)
+    bal = _post_ledger(db, u, "import", p["p_import_id"], minutes, minutes)
+    return {"rows": len(rows), "minutes": minutes, **bal, "version": _version(db, u)}
+
+
+RPCS = {
+    "commit_study_log": _commit_study_log,
+    "revert_study_log": _revert_study_log,
+    "commit_tasks": _commit_tasks,
+    "rebuild_study_rollup": _rebuild_study_rollup,
+    "weekly_top": _weekly_top,
+    "weekly_rank_around": _weekly_rank_around,
+    "purchase_item": _purchase_item,
+    "draw_titles": _draw_titles,
+    "commit_study_log_import": _commit_study_log_import,
+    "user_balance": _user_balance,
+    "grant_login_bonus": _grant_login_bonus,
+    "rebuild_balance_snapshots": _rebuild_balance_snapshots,
+}
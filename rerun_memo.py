@@ -0,0 +1,55 @@
+# 再実行ごとのメモ
+# 1回の再実行の間、同じ読み込み (科目辞書など) を1回で済ませる。描画スレッドで再実行の最初に begin() し、
+# スレッドプールで実行する読み込みには bind() で同じメモを引き継ぐ。書き込みの後は forget() で捨てる。
+import threading
+
+_local = threading.local()
+
+
+class Memo:
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def once(self, key, compute):
+        """key ごとに1回だけ compute() する (別スレッドから同時に呼ばれても1回)"""
+        with self._lock:
+            if key not in self.values: self.values[key] = compute()
+            return self.values[key]
+
+    def forget(self, key=None):
+        with self._lock:
+            if key is None: self.values.clear()
+            else: self.values.pop(key, None)
+
+
+def begin():
+    """描画スレッドで再実行の最初に呼ぶ"""
+    _local.memo = Memo()
+    return _local.memo
+
+
+def current():
+    return getattr(_local, "memo", None)
+
+
+def per_rerun(key, compute):
+    """再実行の外 (download_button のコールバックなど) では毎回 compute() する"""
+    memo = current()
+    return compute() if memo is None else memo.once(key, compute)
+
+
+def forget(key=None):
+    """key を省くとこの再実行のメモをすべて捨てる"""
+    memo = current()
+    if memo is not None: memo.forget(key)
+
+
+def bind(memo, fn):
+    """別スレッドで実行する関数に、呼び出し元の再実行のメモを引き継ぐ"""
+    def run(*args, **kwargs):
+        prev = current()
+        _local.memo = memo
+        try: return fn(*args, **kwargs)
+        finally: _local.memo = prev
+    return run
@@ -0,0 +1,167 @@
+# セッション・プロセスをまたいで共有する読み込みキャッシュ
+# ランキングやショップのカタログなど、誰が見ても同じ結果になる読み込みに使う。
+# 保存先はプロセス内 (MemoryStore) か、同じホストの複数プロセスで共有できる SQLite (SQLiteStore)。
+#
+# 各エントリは ttl 秒は新しいものとして返し、その後 stale 秒までは古い値として残す。
+# 期限切れのキーは1つのプロセス・スレッドだけが作り直し (ロックを取ったもの)、
+# 他は古い値があればそれを返し、無ければ作り直しが終わるまで少し待つ。
+import json
+import sqlite3
+import threading
+import time
+
+LOCK_LEASE = 30.0
+WAIT = 5.0
+POLL = 0.05
+
+
+class MemoryStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+        self._locks = {}
+
+    def get(self, key):
+        with self._lock: return self._items.get(key)
+
+    def set(self, key, value, fresh_until, stale_until):
+        with self._lock: self._items[key] = (value, fresh_until, stale_until)
+
+    def delete(self, key):
+        with self._lock: self._items.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for k in [k for k in self._items if k.startswith(prefix)]: del self._items[k]
+
+    def try_lock(self, key, lease):
+        now = time.time()
+        with self._lock:
+            if self._locks.get(key, 0) > now: return False
+            self._locks[key] = now + lease
+            return True
+
+    def unlock(self, key):
+        with self._lock: self._locks.pop(key, None)
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            for k in [k for k, v in self._items.items() if v[2] < now]: del self._items[k]
+
+
+class SQLiteStore:
+    """値は JSON で保存する。WAL モードなので読み込みは書き込みを待たない"""
+
+    SCHEMA = """
+    create table if not exists cache_entries (
+        key text primary key,
+        value text not null,
+        fresh_until real not null,
+        stale_until real not null
+    );
+    create table if not exists cache_locks (
+        key text primary key,
+        until real not null
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.conn().executescript(self.SCHEMA)
+
+    def conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            c.execute("pragma journal_mode = wal")
+            c.execute("pragma synchronous = normal")
+            self._local.conn = c
+        return c
+
+    def get(self, key):
+        r = self.conn().execute("select value, fresh_until, stale_until from cache_entries where key = ?", (key,)).fetchone()
+        return (json.loads(r[0]), r[1], r[2]) if r else None
+
+    def set(self, key, value, fresh_until, stale_until):
+        self.conn().execute(
+            "insert into cache_entries (key, value, fresh_until, stale_until) values (?, ?, ?, ?) "
+            "on conflict (key) do update set value = excluded.value, fresh_until = excluded.fresh_until, stale_until = excluded.stale_until",
+            (key, json.dumps(value, default=str, ensure_ascii=False), fresh_until, stale_until),
+        )
+
+    def delete(self, key):
+        self.conn().execute("delete from cache_entries where key = ?", (key,))
+
+    def delete_prefix(self, prefix):
+        self.conn().execute("delete from cache_entries where substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def try_lock(self, key, lease):
+        now = time.time()
+        cur = self.conn().execute(
+            "insert into cache_locks (key, until) values (?, ?) "
+            "on conflict (key) do update set until = excluded.until where cache_locks.until < ?",
+            (key, now + lease, now),
+        )
+        return cur.rowcount == 1
+
+    def unlock(self, key):
+        self.conn().execute("delete from cache_locks where key = ?", (key,))
+
+    def purge(self):
+        self.conn().execute("delete from cache_entries where stale_until < ?", (time.time(),))
+
+
+class SharedCache:
+    def __init__(self, store):
+        self.store = store
+        self._stats_lock = threading.Lock()
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "waits": 0}
+        self._sets = 0
+
+    def _count(self, key):
+        with self._stats_lock: self.stats[key] += 1
+
+    def get_or_compute(self, key, ttl, compute, stale=None):
+        """key が新しければその値、期限切れなら1か所だけで compute() して保存した値を返す"""
+        stale = ttl * 10 if stale is None else stale
+        hit = self.store.get(key)
+        now = time.time()
+        if hit and hit[1] > now:
+            self._count("hits")
+            return hit[0]
+        if self.store.try_lock(key, LOCK_LEASE):
+            try:
+                self._count("misses")
+                return self._put(key, compute(), ttl, stale)
+            finally:
+                self.store.unlock(key)
+        # 他が作り直している
+        if hit and hit[2] > now:
+            self._count("stale")
+            return hit[0]
+        self._count("waits")
+        deadline = time.time() + WAIT
+        while time.time() < deadline:
+            time.sleep(POLL)
+            hit = self.store.get(key)
+            if hit and hit[1] > time.time(): return hit[0]
+        return self._put(key, compute(), ttl, stale)
+
+    def _put(self, key, value, ttl, stale):
+        now = time.time()
+        self.store.set(key, value, now + ttl, now + stale)
+        self._sets += 1
+        if self._sets % 500 == 0: self.store.purge()
+        return value
+
+    def delete(self, *keys):
+        for k in keys: self.store.delete(k)
+
+    def invalidate(self, *prefixes):
+        for p in prefixes: self.store.delete_prefix(p)
+
+    def prometheus(self):
+        with self._stats_lock: stats = dict(self.stats)
+        return ["# TYPE study_app_shared_cache_total counter"] + [f'study_app_shared_cache_total{{result="{k}"}} {v}' for k, v in stats.items()]
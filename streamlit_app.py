@@ -1,5 +1,7 @@
 import streamlit as st
-from supabase import create_client, Client
+import streamlit.components.v1 as components
+from streamlit.errors import StreamlitAPIException
+from supabase import create_client, Client, ClientOptions
 import pandas as pd
 import random
 import time
@@ -7,9 +9,21 @@ from datetime import datetime, date, timedelta, timezone
 from streamlit_calendar import calendar
 import altair as alt
 import io
+import os
 import base64
-from PIL import Image
+from PIL import Image, ImageOps, features
 import hashlib
+import csv
+import json
+import uuid
+import atexit
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+import rerun_memo
+import backend
+import shared_cache
+import write_behind
 
 # ページ設定
 st.set_page_config(page_title="褒めてくれる勉強時間・タスク管理アプリ", layout="wide")
@@ -18,34 +32,161 @@ st.set_page_config(page_title="褒めてくれる勉強時間・タスク管理
 JST = timezone(timedelta(hours=9))
 
 # --- Supabase接続設定 ---
+# 環境変数 STUDY_APP_DB または secrets の [storage] backend = "sqlite" があれば、
+# Supabase の代わりにローカルの SQLite (local_db.py) を使う。
+# Supabase のクライアントは backend.py で包み、全セッションで1つの接続プールを共有する。
+# secrets の [supabase] に pool / timeout / retry / breaker の表を書くと backend.py の既定値を上書きできる。
+def _secret(section):
+    try: return st.secrets.get(section, {})
+    except FileNotFoundError: return {}
+
 @st.cache_resource
 def init_supabase():
-    try:
-        url = st.secrets["supabase"]["url"]
-        key = st.secrets["supabase"]["key"]
-        return create_client(url, key)
-    except:
-        return None
+    path = os.environ.get("STUDY_APP_DB")
+    if not path and _secret("storage").get("backend") == "sqlite":
+        path = _secret("storage").get("path", "study_app.db")
+    if path:
+        from local_db import LocalClient
+        return LocalClient(path)
+    conf = _secret("supabase")
+    http = backend.http_client(conf.get("pool"), conf.get("timeout"))
+    options = ClientOptions(httpx_client=http, postgrest_client_timeout=http.timeout)
+    client = backend.ManagedClient(create_client(conf["url"], conf["key"], options=options), http, conf.get("retry"), conf.get("breaker"))
+    tracing.COLLECTORS.append(client.prometheus)
+    return client
+
+# 接続に失敗したらキャッシュされず、次の再実行でやり直す
+try: supabase, SUPABASE_ERROR = init_supabase(), None
+except Exception as e: supabase, SUPABASE_ERROR = None, e
+
+# テーブル・RPC の呼び出しはすべて tracing.py で記録する (デバッグパネルとメトリクス用)
+if supabase is not None: supabase = tracing.TracedClient(supabase)
 
-supabase = init_supabase()
+# --- 共有キャッシュ (shared_cache.py) ---
+# 週間ランキング・ユーザー名と称号の引き当て・ショップのカタログは誰が見ても同じなので、セッションをまたいで共有する。
+# 環境変数 STUDY_APP_CACHE または secrets の [cache] path に SQLite ファイルを指定すると、
+# 同じホストで動く複数のプロセスでも共有する (無ければプロセス内のメモリ)。
+# 書き込んだ側がキーを消すので、自分の変更はすぐ反映される。他のホストの変更は TTL の間だけ遅れる。
+SHARED_TTL = {"ranking": 60, "catalog": 3600}
+
+@st.cache_resource
+def shared():
+    path = os.environ.get("STUDY_APP_CACHE") or _secret("cache").get("path")
+    cache = shared_cache.SharedCache(shared_cache.SQLiteStore(path) if path else shared_cache.MemoryStore())
+    tracing.COLLECTORS.append(cache.prometheus)
+    return cache
 
 # --- 画像処理関数 ---
-def image_to_base64(img):
-    buffered = io.BytesIO()
-    img.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
+# カスタム壁紙は元ファイルの sha256 をキーに wallpaper_blobs へ一度だけ保存し、
+# 解像度違いの WebP (非対応環境では JPEG) を持つ。ブラウザへは static/ 配下のファイルとして配信する。
+WALLPAPER_VARIANTS = [1920, 1280, 640]
+MAX_UPLOAD_BYTES = 15 * 1024 * 1024
+MAX_UPLOAD_PIXELS = 50_000_000
+WALLPAPER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "wallpapers")
+WALLPAPER_FORMAT = ("WEBP", "image/webp", "webp") if features.check("webp") else ("JPEG", "image/jpeg", "jpg")
+
+@st.cache_resource
+def image_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="wallpaper")
+
+def content_hash(data): return hashlib.sha256(data).hexdigest()
+
+def check_upload(data):
+    """デコード前にサイズ・画素数で弾く。問題なければ None、あればエラーメッセージを返す"""
+    if len(data) > MAX_UPLOAD_BYTES: return f"ファイルが大きすぎます (最大 {MAX_UPLOAD_BYTES // 1024 // 1024}MB)"
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if img.width * img.height > MAX_UPLOAD_PIXELS: return "画像の解像度が大きすぎます"
+    except Exception: return "画像を読み込めません"
+    return None
+
+def encode_wallpaper(data):
+    """元画像から解像度違いのバリアントを作る（ワーカースレッドで実行）"""
+    fmt, mime, _ = WALLPAPER_FORMAT
+    img = Image.open(io.BytesIO(data))
+    # JPEG は DCT スケーリングで必要な解像度付近まで縮小しながらデコードする
+    if img.format == "JPEG": img.draft("RGB", (WALLPAPER_VARIANTS[0], WALLPAPER_VARIANTS[0]))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    out = {}
+    for w in WALLPAPER_VARIANTS:
+        v = img.copy()
+        v.thumbnail((w, w * 9 // 16 if img.width >= img.height else w))
+        buf = io.BytesIO()
+        v.save(buf, format=fmt, quality=80, method=4) if fmt == "WEBP" else v.save(buf, format=fmt, quality=82, optimize=True, progressive=True)
+        out[str(w)] = {"mime": mime, "width": v.width, "height": v.height, "bytes": buf.tell(), "data": base64.b64encode(buf.getvalue()).decode()}
+    return out
+
+def has_wallpaper(h):
+    res = supabase.table("wallpaper_blobs").select("variant").eq("hash", h).execute()
+    return len(res.data) == len(WALLPAPER_VARIANTS)
+
+def put_wallpaper(h, variants):
+    rows = [{"hash": h, "variant": k, **v} for k, v in variants.items()]
+    supabase.table("wallpaper_blobs").upsert(rows, on_conflict="hash,variant").execute()
+    for k, v in variants.items(): _write_wallpaper_file(h, k, v["data"])
+
+def _wallpaper_path(h, variant): return os.path.join(WALLPAPER_DIR, f"{h}_{variant}.{WALLPAPER_FORMAT[2]}")
+
+def _write_wallpaper_file(h, variant, b64):
+    os.makedirs(WALLPAPER_DIR, exist_ok=True)
+    tmp = _wallpaper_path(h, variant) + ".tmp"
+    with open(tmp, "wb") as f: f.write(base64.b64decode(b64))
+    os.replace(tmp, _wallpaper_path(h, variant))
+
+@st.cache_data(max_entries=64)
+def wallpaper_urls(h):
+    """バリアントごとのURL。static配信が無効ならデータURIを返す"""
+    if not st.get_option("server.enableStaticServing"):
+        res = supabase.table("wallpaper_blobs").select("mime, data").eq("hash", h).eq("variant", str(WALLPAPER_VARIANTS[0])).execute()
+        return {str(WALLPAPER_VARIANTS[0]): f"data:{res.data[0]['mime']};base64,{res.data[0]['data']}"} if res.data else {}
+    missing = [str(w) for w in WALLPAPER_VARIANTS if not os.path.exists(_wallpaper_path(h, w))]
+    if missing:
+        res = supabase.table("wallpaper_blobs").select("variant, data").eq("hash", h).in_("variant", missing).execute()
+        for r in res.data: _write_wallpaper_file(h, r['variant'], r['data'])
+    return {str(w): f"app/static/wallpapers/{h}_{w}.{WALLPAPER_FORMAT[2]}" for w in WALLPAPER_VARIANTS if os.path.exists(_wallpaper_path(h, w))}
+
+def legacy_wallpaper(u):
+    """旧形式 (users.custom_bg_data の base64 PNG) のカスタム壁紙の元画像。無ければ None"""
+    res = supabase.table("users").select("custom_bg_data").eq("username", u).execute()
+    return base64.b64decode(res.data[0]['custom_bg_data']) if res.data and res.data[0]['custom_bg_data'] else None
 
 # --- デザイン適用関数 ---
-def apply_design(user_theme="標準", wallpaper="真っ黒", custom_data=None, bg_opacity=0.4):
-    fonts = {
-        "ピクセル風": "'DotGothic16', sans-serif",
-        "手書き風": "'Yomogi', cursive",
-        "ポップ": "'Hachi Maru Pop', cursive",
-        "明朝体": "'Shippori Mincho', serif",
-        "筆文字": "'Yuji Syuku', serif",
-        "標準": "sans-serif"
-    }
-    font_family = fonts.get(user_theme, "sans-serif")
+# フォントは subset_fonts.py で UI の文字だけに絞った WOFF2 を static/fonts/ から配信し、
+# 装備中のフォントの @font-face だけを出す。ファイルが無い・static配信が無効なら端末のフォント
+# (入っていればそのフォント、無ければ系統の近い標準フォント) で表示する。
+# 環境変数 STUDY_APP_REMOTE_FONTS=1 または secrets の [fonts] remote = true のときだけ、
+# 代わりに装備中のフォント1つを Google Fonts から読み込む。
+# CSS は (フォント, 壁紙, カスタム壁紙URL, 濃さ) ごとに一度だけ組み立ててキャッシュする。
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "fonts")
+FONTS = {
+    "ピクセル風": ("DotGothic16", "dotgothic16", "sans-serif"),
+    "手書き風": ("Yomogi", "yomogi", "cursive"),
+    "ポップ": ("Hachi Maru Pop", "hachi-maru-pop", "cursive"),
+    "明朝体": ("Shippori Mincho", "shippori-mincho", "serif"),
+    "筆文字": ("Yuji Syuku", "yuji-syuku", "serif"),
+}
+
+def remote_fonts():
+    if os.environ.get("STUDY_APP_REMOTE_FONTS"): return os.environ["STUDY_APP_REMOTE_FONTS"] == "1"
+    try: return bool(st.secrets.get("fonts", {}).get("remote"))
+    except Exception: return False
+
+def font_css(user_theme):
+    """(@font-face, font-family) を返す"""
+    if user_theme not in FONTS: return "", "sans-serif"
+    family, file, fallback = FONTS[user_theme]
+    if not st.get_option("server.enableStaticServing") or not os.path.exists(os.path.join(FONT_DIR, f"{file}.woff2")):
+        if not remote_fonts(): return "", f"'{family}', {fallback}"
+        return f"@import url('https://fonts.googleapis.com/css2?family={family.replace(' ', '+')}&display=swap');", f"'{family}', {fallback}"
+    face = f"@font-face {{ font-family: '{family}'; src: url('app/static/fonts/{file}.woff2') format('woff2'); font-display: swap; }}"
+    return face, f"'{family}', {fallback}"
+
+def apply_design(user_theme="標準", wallpaper="真っ黒", custom_urls=None, bg_opacity=0.4):
+    st.markdown(design_css(user_theme, wallpaper, custom_urls, bg_opacity), unsafe_allow_html=True)
+
+@st.cache_data(max_entries=256)
+def design_css(user_theme, wallpaper, custom_urls, bg_opacity):
+    font_face, font_family = font_css(user_theme)
     
     # 背景CSS設定
     bg_style = """
@@ -53,13 +194,23 @@ def apply_design(user_theme="標準", wallpaper="真っ黒", custom_data=None, b
         background-image: none !important;
     """
     
-    if wallpaper == "カスタム" and custom_data:
+    bg_media = ""
+    if wallpaper == "カスタム" and custom_urls:
+        variants = sorted(custom_urls.items(), key=lambda kv: -int(kv[0]))
         bg_style = f"""
-            background-image: linear-gradient(rgba(0,0,0,{bg_opacity}), rgba(0,0,0,{bg_opacity})), url("data:image/png;base64,{custom_data}") !important;
+            background-image: linear-gradient(rgba(0,0,0,{bg_opacity}), rgba(0,0,0,{bg_opacity})), url("{variants[0][1]}") !important;
             background-attachment: fixed !important;
             background-size: cover !important;
             background-position: center !important;
         """
+        # 小さい画面では小さいバリアントだけを読み込ませる
+        for w, url in variants[1:]:
+            bg_media += f"""
+    @media (max-width: {w}px) {{
+        [data-testid="stAppViewContainer"], .stApp {{
+            background-image: linear-gradient(rgba(0,0,0,{bg_opacity}), rgba(0,0,0,{bg_opacity})), url("{url}") !important;
+        }}
+    }}"""
     elif wallpaper != "真っ黒":
         wallpapers = {
             "草原": "1472214103451-9374bd1c798e", "夕焼け": "1472120435266-53107fd0c44a",
@@ -76,15 +227,17 @@ def apply_design(user_theme="標準", wallpaper="真っ黒", custom_data=None, b
                 background-size: cover !important;
             """
 
-    st.markdown(f"""
+    return f"""
     <style>
-    @import url('https://fonts.googleapis.com/css2?family=DotGothic16&family=Yomogi&family=Hachi+Maru+Pop&family=Shippori+Mincho&family=Yuji+Syuku&display=swap');
+    {font_face}
     
     /* アプリ全体の背景 */
     [data-testid="stAppViewContainer"], .stApp {{
         {bg_style}
     }}
     
+    {bg_media}
+    
     /* ヘッダー透明化 */
     [data-testid="stHeader"] {{
         background-color: rgba(0,0,0,0);
@@ -153,7 +306,7 @@ def apply_design(user_theme="標準", wallpaper="真っ黒", custom_data=None, b
     
     canvas {{ filter: invert(1) hue-rotate(180deg); }}
     </style>
-    """, unsafe_allow_html=True)
+    """
 
 # --- 認証・DB操作 ---
 def make_hashes(password): return hashlib.sha256(str.encode(password)).hexdigest()
@@ -169,14 +322,11 @@ def login_user(username, password):
 def add_user(username, password, nickname):
     try:
         # ★BGM完全削除＆初期壁紙「真っ黒」★
+        # 持ち物は user_items、xp / coins は残高台帳で持つので、旧列 (unlocked_* など) は書かない
         data = {
             "username": username, "password": make_hashes(password), "nickname": nickname,
-            "xp": 0, "coins": 0, 
-            "unlocked_themes": "標準", "current_theme": "標準",
-            "current_title": "見習い", "unlocked_titles": "見習い", 
-            "current_wallpaper": "真っ黒", "unlocked_wallpapers": "真っ黒", 
-            "custom_title_unlocked": False, "custom_wallpaper_unlocked": False,
-            "custom_bg_data": None,
+            "current_theme": "標準", "current_title": "見習い", "current_wallpaper": "真っ黒",
+            "custom_bg_data": None, "custom_bg_hash": None,
             "daily_goal": 60, "last_goal_reward_date": None, "last_login_date": None
         }
         supabase.table("users").insert(data).execute()
@@ -184,114 +334,1198 @@ def add_user(username, password, nickname):
     except Exception as e:
         return False, f"SQLエラー: {e}"
 
-def get_user_data(username):
-    try:
-        res = supabase.table("users").select("*").eq("username", username).execute()
-        return res.data[0] if res.data else None
-    except: return None
+# --- プロフィール (users 行) ---
+# 画面ごとに必要な列だけを取得し、セッションにキャッシュする。
+# 毎回の再実行では version だけを確認し、他のセッションが行を変えたときだけ取り直す。
+# 自分の書き込みは返ってきた version と一緒にキャッシュへ反映する。
+PROFILE_VIEWS = {
+    "hud": ["nickname", "xp", "coins", "current_title", "daily_goal", "last_goal_reward_date", "last_login_date"],
+    "theme": ["current_theme", "current_wallpaper", "custom_bg_hash"],
+    "settings": ["daily_goal", "current_theme", "current_wallpaper", "current_title", "inventory"],
+    "shop": ["coins", "current_theme", "current_wallpaper", "inventory"],
+}
+PROFILE_TYPES = {"xp": int, "coins": int, "daily_goal": int, "version": int}
+# users の列ではなく別に読むもの。xp / coins は残高台帳 (balance_ledger) から、inventory は user_items から
+BALANCE_COLUMNS = {"xp", "coins"}
+DERIVED_COLUMNS = BALANCE_COLUMNS | {"inventory"}
+
+def _typed_profile(row):
+    return {k: PROFILE_TYPES[k](v) if k in PROFILE_TYPES and v is not None else v for k, v in row.items()}
+
+def profile_columns(*views): return sorted({"username", "version"}.union(*(PROFILE_VIEWS[v] for v in views)))
+
+def _profile_cache(u):
+    c = st.session_state.get("profile")
+    if c is None or c.get("username") != u:
+        c = {"username": u}
+        st.session_state["profile"] = c
+    return c
+
+def profile_request(u, *views):
+    """(取得する列, キャッシュ済みの version) を返す。キャッシュに無い列があれば version は None"""
+    c = _profile_cache(u)
+    cols = profile_columns(*views)
+    return cols, (c.get("version") if all(k in c for k in cols) else None)
+
+def fetch_profile(u, cols, cached_version=None):
+    """キャッシュが最新なら None、ユーザーがいなければ {} を返す（描画スレッド外でも呼べる）"""
+    balance = bool(BALANCE_COLUMNS.intersection(cols))
+    if cached_version is not None:
+        res = supabase.table("users").select("version").eq("username", u).execute()
+        if not res.data: return {}
+        # 残高の増減では users 行の version は変わらないので、残高だけは毎回読む
+        if res.data[0]['version'] == cached_version: return fetch_balance(u) if balance else None
+    res = supabase.table("users").select(", ".join(c for c in cols if c not in DERIVED_COLUMNS)).eq("username", u).execute()
+    if not res.data: return {}
+    row = _typed_profile(res.data[0])
+    if balance: row.update(fetch_balance(u))
+    if "inventory" in cols: row["inventory"] = fetch_inventory(u)
+    return row
+
+def fetch_balance(u):
+    """{"xp", "coins"} (スナップショット + 短い末尾)"""
+    return _typed_profile(call_rpc("user_balance", {"p_username": u}))
+
+def grant_login_bonus(u, today):
+    """今日のログインボーナスを付ける。付けたら True (同じ日の2回目は台帳の一意制約で弾かれる)"""
+    r = call_rpc("grant_login_bonus", {"p_username": u, "p_today": today})
+    apply_profile(u, {"coins": r.get("coins"), "last_login_date": today, "version": r.get("version")})
+    return r["granted"]
+
+def merge_profile(u, fetched):
+    if fetched == {}:
+        st.session_state.pop("profile", None)
+        return None
+    c = _profile_cache(u)
+    # まだ書き込んでいない設定の変更は、読み直した値より優先する
+    if fetched: c.update(fetched); c.update(pref_writer().pending(u))
+    return c
+
+def get_profile(u, *views, check=True):
+    cols, ver = profile_request(u, *views)
+    if not check and ver is not None: return _profile_cache(u)
+    return merge_profile(u, fetch_profile(u, cols, ver))
+
+def apply_profile(u, fields):
+    """書き込み結果をキャッシュへ反映する。version が分からない書き込みの後は次回取り直す"""
+    c = _profile_cache(u)
+    c.update(_typed_profile({k: v for k, v in fields.items() if v is not None or k not in PROFILE_TYPES}))
+    if fields.get("version") is None: c.pop("version", None)
+
+def reset_profile():
+    st.session_state.pop("profile", None)
+
+# --- 設定の書き込み (write_behind.py) ---
+# フォント・壁紙・目標・称号の変更はすぐセッションのプロフィールへ反映し、users への書き込みは後回しにする。
+# 同じユーザーの変更はまとめ、最後の変更から PREF_DELAY 秒後 (続けて変えていても PREF_MAX_DELAY 秒後) に1回で書く。
+# ログアウトではそのユーザーの分を、プロセスの終了時 (atexit) には残りをすべて書き込む。
+# 書き込むと version が変わるので、次の確認で行を1回取り直す。
+PREF_DELAY = 2.0
+PREF_MAX_DELAY = 10.0
+
+@st.cache_resource
+def pref_writer():
+    def write(u, fields):
+        supabase.table("users").update(fields).eq("username", u).execute()
+        if "current_title" in fields: forget_ranking()
+    w = write_behind.WriteBehind(write, PREF_DELAY, PREF_MAX_DELAY)
+    tracing.COLLECTORS.append(w.prometheus)
+    atexit.register(w.close)
+    return w
+
+def save_prefs(user, fields):
+    _profile_cache(user['username']).update(_typed_profile(fields))
+    pref_writer().put(user['username'], fields)
+
+def flush_prefs(u): pref_writer().flush(u)
+
+# --- 持ち物 (user_items) ---
+# フォント・壁紙・称号・パスは user_items の (category, item) 行で持つ (supabase/migrations/0007_user_items.sql)。
+# プロフィールキャッシュには category ごとの dict (キーだけ使う、取得順を保った集合) として載せる。
+# 購入は未所持かつコインが足りるときだけ成立する1回のRPCで行い、価格はサーバー側の shop_items を正とする。
+# 称号ガチャの排出テーブルも gacha_pool (0008_gacha_batch.sql) のレア度・重みを正とする。
+GACHA_RARITIES = ["N", "R", "SR", "SSR"]
+# 全員が最初から持っているもの (行は作らない)
+DEFAULT_ITEMS = {"font": ["標準"], "wallpaper": ["真っ黒"], "title": ["見習い"]}
+
+def shop_catalog():
+    """{category: {item: 価格}}。価格は shop_items から読む (全セッションで共有)"""
+    def load():
+        cat = {}
+        for r in supabase.table("shop_items").select("category, item, price").order("price").execute().data:
+            cat.setdefault(r['category'], {})[r['item']] = r['price']
+        return cat
+    return shared().get_or_compute("catalog:shop", SHARED_TTL["catalog"], load)
+
+def gacha_table():
+    """{称号: [レア度, 重み]}。gacha_pool から読む (全セッションで共有)"""
+    def load():
+        res = supabase.table("gacha_pool").select("item, rarity, weight").order("item").execute()
+        return {r['item']: [r['rarity'], r['weight']] for r in res.data}
+    return shared().get_or_compute("catalog:gacha", SHARED_TTL["catalog"], load)
+
+def fetch_inventory(u):
+    res = supabase.table("user_items").select("category, item").eq("username", u).order("acquired_at").execute()
+    inv = {c: dict.fromkeys(items) for c, items in DEFAULT_ITEMS.items()}
+    for r in res.data: inv.setdefault(r['category'], {})[r['item']] = None
+    return inv
+
+def owns(user, category, item): return item in user.get("inventory", {}).get(category, {})
+def owned(user, category): return list(user.get("inventory", {}).get(category, {}))
+
+def _apply_grant(user, r, category, items, fields=None):
+    """購入RPCの結果 (新しい coins / version) と増えた持ち物をキャッシュへ反映する"""
+    if r.get("status") == "unknown": return
+    inv = dict(user.get("inventory") or {})
+    if r["status"] in ("ok", "owned"): inv[category] = {**inv.get(category, {}), **dict.fromkeys(items)}
+    apply_profile(user['username'], {"coins": r.get("coins"), "version": r.get("version"), "inventory": inv, **(fields or {})})
+
+def purchase_item(user, category, item):
+    """"ok" / "owned" (所持済み) / "insufficient" (コイン不足) / "unknown" を返す"""
+    r = call_rpc("purchase_item", {"p_username": user['username'], "p_category": category, "p_item": item})
+    _apply_grant(user, r, category, [item])
+    return r["status"]
+
+def roll_gacha(n, seed, table):
+    """n 回分を重みつきで一度に引く。同じ seed (と排出テーブル) なら同じ結果になる"""
+    titles = list(table)
+    return random.Random(seed).choices(titles, weights=[table[t][1] for t in titles], k=n)
+
+def rarest(results, table):
+    """最もレア度の高い称号 (同じなら後に出たもの)"""
+    return max(reversed(results), key=lambda t: GACHA_RARITIES.index(table[t][0]))
+
+def draw_titles(user, n, seed=None):
+    """称号ガチャを n 回まとめて引く。coins・新しい称号・装備 (最もレアな称号) は1回のRPCで書く。
+    (状態, 結果) を返し、結果は {"results", "new", "equip", "seed"}"""
+    if seed is None: seed = random.randrange(2 ** 32)
+    table = gacha_table()
+    results = roll_gacha(n, seed, table)
+    equip = rarest(results, table)
+    flush_prefs(user['username'])  # 待っている称号の変更が後から装備を上書きしないように
+    r = call_rpc("draw_titles", {"p_username": user['username'], "p_titles": results, "p_equip": equip})
+    _apply_grant(user, r, "title", results, {"current_title": equip} if r["status"] == "ok" else None)
+    if r["status"] == "ok": forget_ranking()
+    return r["status"], {"results": results, "new": r.get("new") or [], "equip": equip, "seed": seed}
 
 # --- その他DB操作 ---
-def get_weekly_ranking():
-    start = (datetime.now(JST) - timedelta(days=7)).strftime('%Y-%m-%d')
+RANK_COLUMNS = ["rank", "username", "nickname", "current_title", "duration_minutes"]
+
+# ランキングは共有キャッシュに載せ、勉強ログの書き込み・名前や称号の変更で "ranking:" をまとめて消す
+def get_weekly_ranking(limit=10):
     try:
-        logs = supabase.table("study_logs").select("username, duration_minutes").gte("study_date", start).execute()
-        if not logs.data: return pd.DataFrame()
-        df = pd.DataFrame(logs.data).groupby('username').sum().reset_index()
-        users = supabase.table("users").select("username, nickname, current_title").execute()
-        df_users = pd.DataFrame(users.data)
-        merged = pd.merge(df, df_users, on='username', how='left')
-        return merged.sort_values('duration_minutes', ascending=False)
+        rows = shared().get_or_compute(f"ranking:top:{limit}", SHARED_TTL["ranking"], lambda: call_rpc("weekly_top", {"p_limit": limit}))
+        return pd.DataFrame(rows, columns=RANK_COLUMNS)
     except: return pd.DataFrame()
 
-def get_subjects(username):
+def get_my_rank(username, radius=2):
     try:
-        res = supabase.table("subjects").select("subject_name").eq("username", username).execute()
-        return [r['subject_name'] for r in res.data]
+        rows = shared().get_or_compute(f"ranking:around:{username}:{radius}", SHARED_TTL["ranking"], lambda: call_rpc("weekly_rank_around", {"p_username": username, "p_radius": radius}))
+        return pd.DataFrame(rows, columns=RANK_COLUMNS)
+    except: return pd.DataFrame()
+
+def forget_ranking(): shared().invalidate("ranking:")
+
+# --- 科目辞書 (subjects) ---
+# 科目はユーザーごとの辞書で持ち、ログは subjects.id を subject_id として参照する (0011_subject_ids.sql)。
+# 一覧から消した科目や一覧に無い科目 (「その他」・取り込み) も hidden の行として残し、id は変えない。
+# 辞書は1回の再実行で1回だけ読む (先読みスレッドからの呼び出しも同じ結果を使う)。
+def subject_dict(username):
+    """[{"id", "subject_name", "hidden"}] (id 順)"""
+    def load():
+        res = supabase.table("subjects").select("id, subject_name, hidden").eq("username", username).order("id").execute()
+        return res.data
+    return rerun_memo.per_rerun(("subjects", username), load)
+
+def get_subjects(username):
+    try: return [r['subject_name'] for r in subject_dict(username) if not r['hidden']]
     except: return []
 
-def add_subject_db(u, s): supabase.table("subjects").insert({"username": u, "subject_name": s}).execute()
-def delete_subject_db(u, s): supabase.table("subjects").delete().eq("username", u).eq("subject_name", s).execute()
+def subject_names(username):
+    """{id: 科目名}"""
+    return {r['id']: r['subject_name'] for r in subject_dict(username)}
+
+def subject_dtype(names):
+    """ログの subject 列の型。科目なしは "" にする"""
+    return pd.CategoricalDtype(["", *dict.fromkeys(names.values())])
+
+def add_subject_db(u, s):
+    supabase.table("subjects").upsert({"username": u, "subject_name": s, "hidden": False}, on_conflict="username, subject_name").execute()
+    invalidate_views()
+def delete_subject_db(u, s):
+    # 過去のログが参照しているので行は消さずに一覧から外す
+    supabase.table("subjects").update({"hidden": True}).eq("username", u).eq("subject_name", s).execute()
+    invalidate_views()
+
+# --- 勉強ログ確定RPC ---
+# ログ追加・削除・タスク完了などは残高台帳への追記と合わせてサーバー側の関数で1往復で行う
+# (supabase/migrations/0001_study_log_rpc.sql, 0010_balance_ledger.sql など)。ローカルの SQLite では local_db が同じ処理を行う。
+def call_rpc(name, params):
+    return supabase.rpc(name, params).execute().data
 
 def add_study_log(u, s, m, d):
-    # ログ追加
-    supabase.table("study_logs").insert({"username": u, "subject": s, "duration_minutes": m, "study_date": str(d)}).execute()
-    
-    ud = get_user_data(u)
-    if not ud: return m, 0, 0, False
+    flush_prefs(u)  # 目標 (daily_goal) の変更を先に書く
+    r = call_rpc("commit_study_log", {"p_username": u, "p_subject": s, "p_minutes": m, "p_study_date": str(d), "p_today": str(date.today())})
+    apply_profile(u, {"xp": r["xp"], "coins": r["coins"], "version": r.get("version"), **({"last_goal_reward_date": str(date.today())} if r["goal_reached"] else {})})
+    invalidate_views(); forget_ranking()
+    return r["minutes"], r["xp"], r["coins"], r["goal_reached"]
 
-    today_str = str(date.today())
-    logs = supabase.table("study_logs").select("duration_minutes").eq("username", u).eq("study_date", today_str).execute()
-    total_today = sum([l['duration_minutes'] for l in logs.data]) if logs.data else m
-    
-    new_xp = ud['xp'] + m
-    new_coins = ud['coins'] + m
-    
-    goal_reached = False
-    goal = ud.get('daily_goal', 60)
-    last_reward = ud.get('last_goal_reward_date')
-    
-    if last_reward != today_str and total_today >= goal:
-        new_coins += 100
-        supabase.table("users").update({
-            "xp": new_xp, "coins": new_coins, "last_goal_reward_date": today_str
-        }).eq("username", u).execute()
-        goal_reached = True
-    else:
-        supabase.table("users").update({"xp": new_xp, "coins": new_coins}).eq("username", u).execute()
-        
-    return m, new_xp, new_coins, goal_reached
-
-def delete_study_log(lid, u, m):
-    supabase.table("study_logs").delete().eq("id", lid).execute()
-    ud = get_user_data(u)
-    if ud: supabase.table("users").update({"xp": max(0, ud['xp']-m), "coins": max(0, ud['coins']-m)}).eq("username", u).execute()
+def delete_study_log(lid, u):
+    r = call_rpc("revert_study_log", {"p_log_id": int(lid), "p_username": u})
+    if r.get("xp") is not None: apply_profile(u, {"xp": r["xp"], "coins": r["coins"], "version": r.get("version")})
+    reset_study_logs()  # 消した分を古いログで埋めるため、次の表示で読み直す
+    invalidate_views(); forget_ranking()
     return True
 
-def get_study_logs(u):
-    res = supabase.table("study_logs").select("*").eq("username", u).order("created_at", desc=True).execute()
-    return pd.DataFrame(res.data) if res.data else pd.DataFrame()
+# --- 勉強ログストア (セッション単位の差分同期) ---
+# タイマー画面に出す最近の RECENT_LOGS 件だけを持つ。初回はその件数だけを取得し、以降は最後に見た id
+# (単調に増える) より大きい行だけを取り込む。削除・取り込みの後はストアを捨てて読み直す。
+# 'd'(日付文字列) と 'dt'(datetime) 列は取り込み時に一度だけ作る。
+RECENT_LOGS = 5
+
+def _typed_logs(rows, names):
+    """names は {subject_id: 科目名}。科目はカテゴリ型にする"""
+    df = pd.DataFrame(rows)
+    if df.empty: return df
+    df['subject'] = df['subject_id'].map(names).fillna("").astype(subject_dtype(names))
+    df['d'] = df['study_date'].astype(str).str.split("T").str[0]
+    df['dt'] = pd.to_datetime(df['d'])
+    df['duration_minutes'] = df['duration_minutes'].astype(int)
+    return df
+
+def _log_store(u):
+    store = st.session_state.get("log_store")
+    if store is None or store["username"] != u:
+        store = {"username": u, "df": pd.DataFrame(), "last_id": 0}
+        st.session_state["log_store"] = store
+    return store
+
+LOG_COLUMNS = ["id", "subject_id", "duration_minutes", "study_date", "created_at"]
+
+def fetch_log_rows(u, after=0):
+    """id が after より大きいログを新しい順に最大 RECENT_LOGS 件"""
+    return supabase.table("study_logs").select(", ".join(LOG_COLUMNS)).eq("username", u).gt("id", after).order("id", desc=True).limit(RECENT_LOGS).execute().data
+
+def get_study_logs(u, rows=None):
+    """最近の RECENT_LOGS 件。rows を渡した場合は取得済みの差分としてマージだけを行う"""
+    store = _log_store(u)
+    if rows is None: rows = fetch_log_rows(u, store["last_id"])
+    if rows:
+        names = subject_names(u)
+        delta = _typed_logs(rows, names)
+        df = pd.concat([delta, store["df"]], ignore_index=True) if not store["df"].empty else delta
+        # 新しい科目が増えたときは concat で object 型に戻るので、型をそろえ直す
+        if df['subject'].dtype != delta['subject'].dtype: df['subject'] = df['subject'].astype(str).astype(delta['subject'].dtype)
+        df = df.drop_duplicates(subset="id", keep="first").sort_values("id", ascending=False, ignore_index=True).head(RECENT_LOGS)
+        store["df"] = df
+        store["last_id"] = int(df['id'].iloc[0])
+    return store["df"]
+
+def reset_study_logs():
+    st.session_state.pop("log_store", None)
+
+# --- 日別集計 (study_daily_rollup) ---
+def get_rollup(u, since=None, until=None):
+    q = supabase.table("study_daily_rollup").select("day, subject, minutes, sessions").eq("username", u)
+    if since: q = q.gte("day", str(since))
+    if until: q = q.lt("day", str(until))
+    res = q.execute()
+    df = pd.DataFrame(res.data, columns=["day", "subject", "minutes", "sessions"])
+    df['day'] = df['day'].astype(str).str.split("T").str[0]
+    df['dt'] = pd.to_datetime(df['day'])
+    df['subject'] = df['subject'].astype("category")
+    return df
+
+def get_day_rollup(u, day):
+    """day 1日分の集計 (先の日付のログを含めない)"""
+    return get_rollup(u, day, day + timedelta(days=1))
+
+def calc_streak(rollup):
+    days = set(rollup.loc[rollup['minutes'] > 0, 'day'])
+    d = date.today()
+    if str(d) not in days: d -= timedelta(days=1)
+    streak = 0
+    while str(d) in days: streak += 1; d -= timedelta(days=1)
+    return streak
+
+def rebuild_rollup(u=None):
+    """既存の study_logs から集計テーブルを作り直す（バックフィル用）"""
+    return call_rpc("rebuild_study_rollup", {"p_username": u})
+
+# --- タスク ---
+# 表示中の期間 (カレンダーの6週間分) だけを読み、due_date を索引にして日ごとに引く。
+# 繰り返し (毎日・毎週) は task_rules に1行だけ持ち、読んだ期間の分だけその場で展開する。
+# 展開した回の id は "r<rule_id>:<日付>" で、完了・削除したときに tasks の行になる (0012_task_engine.sql)。
+# 完了・削除は commit_tasks で何件でも1往復、報酬の加算も1回。
+TASK_COLUMNS = ["id", "task_name", "status", "due_date", "priority", "rule_id"]
+TASK_REPEAT = {"なし": None, "毎日": "daily", "毎週": "weekly"}
+
+def get_tasks(u, start=None, end=None):
+    q = supabase.table("tasks").select(", ".join(TASK_COLUMNS)).eq("username", u)
+    if start: q = q.gte("due_date", str(start))
+    if end: q = q.lt("due_date", str(end))
+    return pd.DataFrame(q.order("due_date").execute().data, columns=TASK_COLUMNS)
+
+def get_task_rules(u, start, end):
+    """start <= 日 < end に回がありうる繰り返しだけ"""
+    rules = supabase.table("task_rules").select("id, task_name, priority, freq, start_date, until_date").eq("username", u).lt("start_date", str(end)).order("start_date").execute().data
+    return [r for r in rules if not r['until_date'] or str(r['until_date'])[:10] >= str(start)]
+
+def expand_task_rules(rules, start, end):
+    """繰り返しを start <= 日 < end の回に展開し、tasks と同じ列の DataFrame にする"""
+    frames = []
+    for r in rules:
+        first, step = date.fromisoformat(str(r['start_date'])[:10]), 7 if r['freq'] == "weekly" else 1
+        if first < start: first += timedelta(days=-(-(start - first).days // step) * step)
+        last = end - timedelta(days=1)
+        if r['until_date']: last = min(last, date.fromisoformat(str(r['until_date'])[:10]))
+        days = pd.date_range(first, last, freq=f"{step}D").strftime('%Y-%m-%d')
+        if len(days): frames.append(pd.DataFrame({"id": f"r{r['id']}:" + days, "task_name": r['task_name'], "status": "未完了", "due_date": days, "priority": r['priority'], "rule_id": r['id']}))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=TASK_COLUMNS)
+
+def task_store(tasks, rules, start, end):
+    """期間のタスクと繰り返しの回をまとめ、due_date (文字列) の索引で並べる。'削除' の回は除く"""
+    occ = expand_task_rules(rules, start, end)
+    if not tasks.empty:
+        tasks = tasks.assign(due_date=tasks['due_date'].astype(str).str[:10])
+        done = tasks.loc[tasks['rule_id'].notna()]
+        occ = occ[~occ['id'].isin("r" + done['rule_id'].astype("Int64").astype(str) + ":" + done['due_date'])]
+    df = pd.concat([f for f in (tasks, occ) if not f.empty], ignore_index=True) if not (tasks.empty and occ.empty) else pd.DataFrame(columns=TASK_COLUMNS)
+    df = df[df['status'] != "削除"]
+    return df.set_index(pd.Index(df['due_date'], name="day")).sort_index(kind="stable")
+
+def tasks_on(store, day):
+    """索引が並んでいるので、1日分は二分探索のスライスで引ける"""
+    return store.loc[day:day]
+
+def add_task(u, n, d, p, repeat=None):
+    if repeat: supabase.table("task_rules").insert({"username": u, "task_name": n, "priority": p, "freq": repeat, "start_date": str(d)}).execute()
+    else: supabase.table("tasks").insert({"username": u, "task_name": n, "status": "未完了", "due_date": str(d), "priority": p}).execute()
+    invalidate_views()
 
-def get_tasks(u):
-    res = supabase.table("tasks").select("*").eq("username", u).order("due_date").execute()
-    return pd.DataFrame(res.data) if res.data else pd.DataFrame()
+def stop_task_rule(u, rid, d):
+    """d の前日で繰り返しを終える (それまでの回は残る)"""
+    supabase.table("task_rules").update({"until_date": str(date.fromisoformat(str(d)) - timedelta(days=1))}).eq("id", int(rid)).eq("username", u).execute()
+    invalidate_views()
+
+def commit_tasks(u, action, ids):
+    """ids (tasks の id と繰り返しの回の id) をまとめて完了 ("complete") / 削除 ("delete") する"""
+    ids = [str(i) for i in ids]
+    occ = [i[1:].split(":", 1) for i in ids if i.startswith("r")]
+    r = call_rpc("commit_tasks", {
+        "p_username": u, "p_action": action, "p_task_ids": [int(i) for i in ids if not i.startswith("r")],
+        "p_rule_ids": [int(rid) for rid, _ in occ], "p_days": [d for _, d in occ],
+    })
+    if r.get("completed"): apply_profile(u, {"xp": r["xp"], "coins": r["coins"], "version": r.get("version")})
+    invalidate_views()
+    return r
+
+def complete_task(tid, u): return commit_tasks(u, "complete", [tid])
+
+# --- 一括インポート / エクスポート ---
+# インポートは CSV / JSON Lines を IMPORT_CHUNK 行ずつ読み、チャンク単位でまとめて検証して
+# study_log_imports に入れる。最後に commit_study_log_import (supabase/migrations/0009_study_log_import.sql) を
+# 1回呼び、ログへの移動・日別集計の作り直し・xp / coins の加算を1トランザクションで行う。
+# エクスポートはログとタスクを id 順に EXPORT_PAGE 件ずつ読み、ZIP (CSV 2つ) に書き足していく。
+IMPORT_CHUNK = 1000
+EXPORT_PAGE = 1000
+MAX_IMPORT_MINUTES = 24 * 60
+# JSON 配列は全体を読んでから分けるので大きさを抑える。大きいファイルは CSV / JSON Lines で取り込む
+MAX_JSON_IMPORT_BYTES = 20 * 1024 * 1024
+# 取り込む列 -> 受け付ける列名 (小文字)
+IMPORT_COLUMNS = {
+    "study_date": ["study_date", "date", "day", "日付"],
+    "subject": ["subject", "科目"],
+    "duration_minutes": ["duration_minutes", "minutes", "duration", "分"],
+}
+# study_logs の subject は subject_id から科目名に戻して書く
+EXPORT_TABLES = {
+    "study_logs": ["id", "study_date", "subject", "duration_minutes", "created_at"],
+    "tasks": ["id", "task_name", "status", "due_date", "priority", "created_at"],
+}
+
+def read_import_chunks(file, name):
+    """CSV と JSON Lines は少しずつ読む。JSON 配列は MAX_JSON_IMPORT_BYTES までまとめて読んでから分ける"""
+    name = name.lower()
+    if name.endswith(".csv"):
+        yield from pd.read_csv(file, chunksize=IMPORT_CHUNK, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    elif name.endswith((".jsonl", ".ndjson")):
+        yield from pd.read_json(file, lines=True, chunksize=IMPORT_CHUNK, dtype=False)
+    else:
+        raw = file.read(MAX_JSON_IMPORT_BYTES + 1)
+        if len(raw) > MAX_JSON_IMPORT_BYTES: raise ValueError(f"JSON 配列は {MAX_JSON_IMPORT_BYTES // 1024 // 1024}MB までです。CSV か JSON Lines にしてください")
+        rows = json.loads(raw)
+        if not isinstance(rows, list): raise ValueError("JSON は行の配列にしてください")
+        for i in range(0, len(rows), IMPORT_CHUNK): yield pd.DataFrame(rows[i:i + IMPORT_CHUNK])
+
+def validate_import_chunk(df, today):
+    """列名をそろえて型を変換する。(取り込む行の DataFrame, 不正な行数)"""
+    df = df.rename(columns={c: k for k, names in IMPORT_COLUMNS.items() for c in df.columns if str(c).strip().lower() in names})
+    missing = [k for k in ("study_date", "duration_minutes") if k not in df.columns]
+    if missing: raise ValueError(f"列がありません: {', '.join(missing)}")
+    day = df['study_date'].astype(str).str.strip().str.split("T").str[0].str.split(" ").str[0]
+    day = pd.to_datetime(day, errors="coerce", format="mixed")
+    minutes = pd.to_numeric(df['duration_minutes'], errors="coerce")
+    subject = df['subject'].fillna("").astype(str).str.strip().str.slice(0, 50) if 'subject' in df.columns else pd.Series("", index=df.index)
+    ok = day.notna() & (day <= pd.Timestamp(today)) & minutes.notna() & (minutes == minutes.round()) & minutes.between(1, MAX_IMPORT_MINUTES)
+    rows = pd.DataFrame({"study_date": day[ok].dt.strftime("%Y-%m-%d"), "subject": subject[ok], "duration_minutes": minutes[ok].astype(int)})
+    return rows, int((~ok).sum())
+
+def import_study_logs(u, file, name, progress=None):
+    """(取り込んだ行数, 飛ばした行数, 合計分数)"""
+    import_id = uuid.uuid4().hex
+    staged = skipped = 0
+    for chunk in read_import_chunks(file, name):
+        rows, bad = validate_import_chunk(chunk, date.today())
+        skipped += bad
+        if rows.empty: continue
+        rows.insert(0, "username", u)
+        rows.insert(0, "import_id", import_id)
+        supabase.table("study_log_imports").insert(rows.to_dict("records")).execute()
+        staged += len(rows)
+        if progress: progress(staged)
+    if not staged: return 0, skipped, 0
+    r = call_rpc("commit_study_log_import", {"p_import_id": import_id, "p_username": u})
+    if r.get("xp") is not None: apply_profile(u, {"xp": r["xp"], "coins": r["coins"], "version": r.get("version")})
+    reset_study_logs(); invalidate_views(); forget_ranking()
+    return r["rows"], skipped, r["minutes"]
+
+def iter_pages(table, u, columns):
+    """id 順に1ページずつ返す (キーセット方式なので後ろのページでも遅くならない)"""
+    last = 0
+    while True:
+        res = supabase.table(table).select(", ".join(columns)).eq("username", u).gt("id", last).order("id").limit(EXPORT_PAGE).execute()
+        if not res.data: return
+        yield res.data
+        if len(res.data) < EXPORT_PAGE: return
+        last = res.data[-1]['id']
+
+def export_user_data(u):
+    """ログとタスクを ZIP (CSV) にした bytes を返す。download_button から別スレッドで呼ばれる"""
+    out = io.BytesIO()
+    names = subject_names(u)
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        for table, columns in EXPORT_TABLES.items():
+            query = ["subject_id" if c == "subject" else c for c in columns]
+            with zf.open(f"{table}.csv", "w") as raw, io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as f:
+                w = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+                w.writeheader()
+                for page in iter_pages(table, u, query):
+                    if table == "tasks": page = [r for r in page if r['status'] != "削除"]
+                    if "subject_id" in query: page = [{**r, "subject": names.get(r['subject_id'], "")} for r in page]
+                    w.writerows(page)
+    return out.getvalue()
+
+# --- カレンダーのイベント ---
+# 表示中の月 (dayGridMonth の6週間分) だけを (ユーザー, 月) 単位でキャッシュし、書き込み時に破棄する。
+# タスク・日別集計 (とログ) はキャッシュに無いときだけ、その6週間の分を読む。
+# ログは1日1件の合計イベントにまとめる (CALENDAR_COLLAPSE_LOGS)。
+CALENDAR_COLLAPSE_LOGS = True
+
+def month_grid_range(month):
+    first = date.fromisoformat(month + "-01")
+    start = first - timedelta(days=(first.weekday() + 1) % 7)
+    return start, start + timedelta(days=42)
+
+def shift_month(month, n):
+    y, m = divmod(int(month[:4]) * 12 + int(month[5:7]) - 1 + n, 12)
+    return f"{y:04d}-{m + 1:02d}"
+
+def build_events(tasks, logs_df, rollup):
+    frames = []
+    if not tasks.empty:
+        frames.append(pd.DataFrame({
+            "title": "📝 " + tasks['task_name'].astype(str),
+            "start": tasks['due_date'].astype(str),
+            "color": tasks['status'].eq('未完了').map({True: "#FF4B4B", False: "#888"}),
+        }))
+    if CALENDAR_COLLAPSE_LOGS and not rollup.empty:
+        per_day = rollup.groupby('day')['minutes'].sum().reset_index()
+        frames.append(pd.DataFrame({"title": "📖 " + per_day['minutes'].astype(str) + "分", "start": per_day['day'], "color": "#00CC00"}))
+    elif not CALENDAR_COLLAPSE_LOGS and not logs_df.empty:
+        frames.append(pd.DataFrame({
+            "title": "📖 " + logs_df['subject'].astype(str) + " (" + logs_df['duration_minutes'].astype(str) + "分)",
+            "start": logs_df['d'], "color": "#00CC00",
+        }))
+    return pd.concat(frames, ignore_index=True).to_dict("records") if frames else []
+
+def get_month_logs(u, start, end):
+    res = supabase.table("study_logs").select(", ".join(LOG_COLUMNS)).eq("username", u).gte("study_date", str(start)).lt("study_date", str(end)).execute()
+    return _typed_logs(res.data, subject_names(u))
+
+def get_calendar_month(u, month):
+    cache = st.session_state.setdefault("calendar_cache", {})
+    if (u, month) not in cache:
+        start, end = month_grid_range(month)
+        reads = {
+            "rules": submit_read(get_task_rules, u, start, end), "tasks": submit_read(get_tasks, u, start, end),
+            "rollup": submit_read(get_rollup, u, start, end),
+        }
+        if not CALENDAR_COLLAPSE_LOGS: reads["logs"] = submit_read(get_month_logs, u, start, end)
+        rules, days = reads["rules"].result(), reads["rollup"].result()
+        tasks = task_store(reads["tasks"].result(), rules, start, end)
+        logs = reads["logs"].result() if "logs" in reads else pd.DataFrame()
+        cache[(u, month)] = {
+            "tasks": tasks, "rules": rules, "events": build_events(tasks, logs, days),
+            "minutes": days.groupby('day')['minutes'].sum().to_dict(), "range": (str(start), str(end)),
+        }
+    return cache[(u, month)]
 
-def add_task(u, n, d, p): supabase.table("tasks").insert({"username": u, "task_name": n, "status": "未完了", "due_date": str(d), "priority": p}).execute()
-def delete_task(tid): supabase.table("tasks").delete().eq("id", tid).execute()
-def complete_task(tid, u):
-    supabase.table("tasks").update({"status": "完了"}).eq("id", tid).execute()
-    ud = get_user_data(u)
-    if ud: supabase.table("users").update({"xp": ud['xp']+10, "coins": ud['coins']+10}).eq("username", u).execute()
+def day_minutes(u, feed, day):
+    """day の勉強時間。表示中の6週間の外の日だけ、その日の集計を読む"""
+    if feed["range"][0] <= day < feed["range"][1]: return int(feed["minutes"].get(day, 0))
+    return int(get_day_rollup(u, date.fromisoformat(day))['minutes'].sum())
+
+# --- 通知キュー ---
+# トースト・風船・成功メッセージはセッションのキューに積み、次の描画で出す。
+# st.rerun() をまたいでも残るので、ハンドラーは待たずにすぐ再実行してよい。
+# scope を付けた通知 (成功メッセージなど) は同じ scope で show_notices したところにだけ出す。
+def notify(kind, msg=None, icon=None, scope=None):
+    st.session_state.setdefault("notices", []).append({"kind": kind, "msg": msg, "icon": icon, "scope": scope})
+
+def toast(msg, icon=None): notify("toast", msg, icon)
+def celebrate(): notify("balloons")
+
+def show_notices(scope=None):
+    queue = st.session_state.get("notices")
+    if not queue: return
+    keep = []
+    for n in queue:
+        if n["scope"] not in (None, scope): keep.append(n); continue
+        if n["kind"] == "toast": st.toast(n["msg"], icon=n["icon"])
+        elif n["kind"] == "balloons": st.balloons()
+        elif n["kind"] == "success": st.success(n["msg"], icon=n["icon"])
+        elif n["kind"] == "error": st.error(n["msg"], icon=n["icon"])
+    st.session_state["notices"] = keep
+
+# --- 壁紙変換待ちフラグメント ---
+# アップロードと旧形式の壁紙の移行は、どちらも変換をワーカースレッドに投げてここで待つ。
+# 変換中だけ呼ばれ、完了したら保存してページ全体を再実行する
+def start_wallpaper_job(data, legacy=False):
+    h = content_hash(data)
+    job = None if has_wallpaper(h) else image_executor().submit(encode_wallpaper, data)
+    st.session_state["wallpaper_job"] = {"hash": h, "future": job, "legacy": legacy}
 
-# --- タイマー更新フラグメント ---
 @st.fragment(run_every=1)
-def show_timer_fragment(user_name):
-    now = time.time()
-    start = st.session_state.get("start_time", now)
-    elapsed = int(now - start)
-    h, m, s = elapsed // 3600, (elapsed % 3600) // 60, elapsed % 60
-    
+def show_wallpaper_job(user_name):
+    job = st.session_state["wallpaper_job"]
+    fut = job["future"]
+    if fut is not None and not fut.done():
+        st.caption("⏳ 画像を変換中..."); return
+    st.session_state["wallpaper_job"] = None
+    try:
+        if fut is not None: put_wallpaper(job["hash"], fut.result())
+    except Exception as e:
+        st.error(f"画像の変換に失敗しました: {e}"); return
+    flush_prefs(user_name)  # 後から届いた壁紙の変更で上書きされないように
+    fields = {"current_wallpaper": "カスタム", "custom_bg_hash": job["hash"]}
+    if job["legacy"]: fields["custom_bg_data"] = None
+    supabase.table("users").update(fields).eq("username", user_name).execute()
+    if not job["legacy"]: toast("壁紙を更新しました！")
+    st.rerun()
+
+# --- ランキング表示 ---
+def render_rank_card(row):
+    rank = int(row['rank'])
+    medal = "🥇" if rank==1 else "🥈" if rank==2 else "🥉" if rank==3 else f"{rank}位"
     st.markdown(f"""
-    <div style="text-align: center; font-size: 6em; font-weight: bold; color: #00FF00; text-shadow: 0 0 20px #00FF00; margin-bottom: 20px;">
-        {h:02}:{m:02}:{s:02}
+    <div class="ranking-card">
+        <div class="rank-medal" style="color: {'#FFD700' if rank==1 else '#C0C0C0' if rank==2 else '#CD7F32' if rank==3 else '#fff'};">{medal}</div>
+        <div class="rank-info">
+            <div class="rank-name">{row['nickname']}</div>
+            <div class="rank-title">👑 {row.get('current_title') or '見習い'}</div>
+        </div>
+        <div class="rank-score">{int(row['duration_minutes'])} min</div>
     </div>
     """, unsafe_allow_html=True)
+
+# --- タイマー ---
+# 時計はブラウザ側で start_time から進める。サーバーが関わるのは開始・終了と
+# (TIMER_HEARTBEAT_SEC を設定した場合の) 低頻度のハートビートだけ。
+# 開始時刻は study_sessions に保存し、再接続時に復元する。
+TIMER_HEARTBEAT_SEC = None
+
+def start_study_session(u, subject):
+    start = time.time()
+    supabase.table("study_sessions").upsert({"username": u, "subject": subject, "start_time": start, "heartbeat_at": datetime.now(timezone.utc).isoformat()}, on_conflict="username").execute()
+    st.session_state.update({"is_studying": True, "start_time": start, "current_subject": subject})
+
+def restore_study_session(u):
+    res = supabase.table("study_sessions").select("subject, start_time").eq("username", u).execute()
+    if res.data: st.session_state.update({"is_studying": True, "start_time": res.data[0]['start_time'], "current_subject": res.data[0]['subject']})
+
+def end_study_session(u):
+    supabase.table("study_sessions").delete().eq("username", u).execute()
+    st.session_state["is_studying"] = False
+
+@st.fragment(run_every=TIMER_HEARTBEAT_SEC)
+def timer_heartbeat(user_name):
+    supabase.table("study_sessions").update({"heartbeat_at": datetime.now(timezone.utc).isoformat()}).eq("username", user_name).execute()
+
+def render_clock(start):
+    components.html(f"""
+    <div id="clock" style="text-align: center; font-family: sans-serif; font-size: 6em; font-weight: bold; color: #00FF00; text-shadow: 0 0 20px #00FF00;">00:00:00</div>
+    <script>
+    const start = {start * 1000};
+    const el = document.getElementById("clock");
+    const pad = (n) => String(n).padStart(2, "0");
+    function tick() {{
+        const t = Math.max(0, Math.floor((Date.now() - start) / 1000));
+        el.textContent = `${{pad(Math.floor(t / 3600))}}:${{pad(Math.floor(t % 3600 / 60))}}:${{pad(t % 60)}}`;
+    }}
+    tick(); setInterval(tick, 1000);
+    </script>
+    """, height=160)
+
+def show_timer(user_name):
+    start = st.session_state.get("start_time") or time.time()
+    render_clock(start)
+    if TIMER_HEARTBEAT_SEC: timer_heartbeat(user_name)
     
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
         if st.button("⏹️ 終了して記録", use_container_width=True, type="primary"):
-            duration = max(1, elapsed // 60)
+            duration = max(1, int(time.time() - start) // 60)
             _, _, _, reached = add_study_log(user_name, st.session_state.get("current_subject", "自習"), duration, date.today())
-            st.session_state["is_studying"] = False
-            st.session_state["celebrate"] = True
-            st.session_state["toast_msg"] = f"{duration}分 記録しました！"
-            if reached:
-                st.session_state["goal_reached_msg"] = "🎉 目標達成！ +100コイン！"
+            end_study_session(user_name)
+            celebrate(); toast(f"{duration}分 記録しました！")
+            if reached: toast("🎉 目標達成！ +100コイン！", icon="🎉")
             st.rerun()
 
+# --- フラグメント再実行 ---
+# ボタンのクリックがページ全体の実行中に処理された場合 (ヘッドレスのテストなど) は scope="fragment" が使えない
+def rerun_fragment():
+    try: st.rerun(scope="fragment")
+    except StreamlitAPIException: st.rerun()
+
+def refresh(*keys):
+    """ボタンのコールバックから、指定したフラグメントと HUD だけを再実行する (見つからなければページ全体)"""
+    try: st.rerun(["hud", *keys])
+    except StreamlitAPIException: st.rerun()
+
+# --- HUD ---
+# 画面上部のステータス (名前・称号・XP・コイン・今日の目標)。サイドバーやショップの書き込みはこれと自分だけを再実行する。
+# 今日の勉強時間はページ全体の実行で読んだ値 (today_minutes) を使う
+@st.fragment(key="hud")
+def hud():
+    user = get_profile(st.session_state["username"], "hud", check=False)
+    today_mins = st.session_state.get("today_minutes", 0)
+    level = (user['xp'] // 100) + 1
+    next_xp = level * 100
+    goal = user.get('daily_goal', 60)
+    goal_progress = min(1.0, today_mins / goal) if goal > 0 else 0
+    
+    st.markdown(f"""
+    <div class="status-bar">
+        <div class="stat-item"><div class="stat-label">PLAYER</div><div class="stat-val" style="font-size:1.2em;">{user['nickname']}</div><div style="font-size:0.7em; color:gold;">{user.get('current_title', '見習い')}</div></div>
+        <div class="stat-item"><div class="stat-label">LEVEL</div><div class="stat-val" style="color:#00e5ff;">{level}</div></div>
+        <div class="stat-item"><div class="stat-label">XP</div><div class="stat-val">{user['xp']} <span style="font-size:0.5em; color:#888;">/ {next_xp}</span></div></div>
+        <div class="stat-item"><div class="stat-label">COIN</div><div class="stat-val" style="color:#FFD700;">{user['coins']} G</div></div>
+        <div class="stat-item" style="border-left:1px solid #444; padding-left:15px;">
+            <div class="stat-label">TODAY'S GOAL</div>
+            <div class="stat-val" style="color:#ff9900;">{today_mins} <span style="font-size:0.5em; color:#888;">/ {goal} min</span></div>
+        </div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    st.progress(goal_progress)
+    if today_mins >= goal and goal > 0:
+        if user.get('last_goal_reward_date') == str(date.today()):
+             st.caption("✅ 今日の目標達成済み！ボーナス獲得済み")
+        else:
+             st.caption("🔥 あと少しで目標達成！")
+
+# --- サイドバー設定 ---
+# 目標・称号の変更はこのフラグメントと HUD だけを、壁紙・フォントの変更 (ページ全体のデザイン) はページ全体を再実行する。
+# 再実行するフラグメントはコールバックからしか指定できないので、HUD が変わる書き込みはコールバックで行う
+def save_goal():
+    user = get_profile(st.session_state["username"], "settings", check=False)
+    save_prefs(user, {"daily_goal": st.session_state["goal_input"]})
+    notify("success", "保存しました", scope="sidebar"); refresh("sidebar")
+
+def equip_title(widget, msg):
+    user = get_profile(st.session_state["username"], "settings", check=False)
+    save_prefs(user, {"current_title": st.session_state[widget]})
+    toast(msg); refresh("sidebar")
+
+@st.fragment(key="sidebar")
+def sidebar_settings():
+    user = get_profile(st.session_state["username"], "settings", check=False)
+    st.subheader("⚙️ 設定")
+    show_notices("sidebar")
+
+    # 目標設定
+    st.markdown("##### 🎯 1日の目標")
+    new_goal = st.number_input("目標時間(分)", min_value=10, max_value=600, value=user.get('daily_goal', 60), step=10, key="goal_input")
+    if new_goal != user.get('daily_goal', 60): st.button("目標を保存", on_click=save_goal)
+
+    st.divider()
+
+    # 壁紙設定 (真っ黒、プリセット、カスタム)
+    walls = owned(user, "wallpaper")
+    if "草原" in walls: walls.remove("草原") # 初期化で草原に戻さない
+    job = st.session_state.get("wallpaper_job")
+    if job: show_wallpaper_job(user['username'])
+
+    if owns(user, "pass", "custom_wallpaper"):
+        bg_mode = st.radio("壁紙モード", ["プリセット", "カスタム画像"], horizontal=True, label_visibility="collapsed")
+        if bg_mode == "カスタム画像":
+            st.caption("画像をアップロードして壁紙に設定")
+            uploaded_file = st.file_uploader("画像を選択", type=['jpg', 'png', 'jpeg', 'webp'])
+            if uploaded_file and not job:
+                if st.button("この画像を適用"):
+                    if uploaded_file.size > MAX_UPLOAD_BYTES: st.error(f"ファイルが大きすぎます (最大 {MAX_UPLOAD_BYTES // 1024 // 1024}MB)")
+                    else:
+                        data = uploaded_file.getvalue()
+                        err = check_upload(data)
+                        if err: st.error(err)
+                        else:
+                            start_wallpaper_job(data)
+                            rerun_fragment()
+            elif not job and user.get('current_wallpaper') == 'カスタム': st.success("カスタム画像適用中")
+        else:
+            current_w = user.get('current_wallpaper', '真っ黒')
+            if current_w not in walls: current_w = "真っ黒"
+            new_w = st.selectbox("壁紙", walls, index=walls.index(current_w) if current_w in walls else 0)
+            if new_w != user.get('current_wallpaper'):
+                save_prefs(user, {"current_wallpaper": new_w})
+                st.rerun()
+    else:
+        current_w = user.get('current_wallpaper', '真っ黒')
+        if current_w not in walls: current_w = "真っ黒"
+        new_w = st.selectbox("壁紙", walls, index=walls.index(current_w) if current_w in walls else 0)
+        if new_w != user.get('current_wallpaper'):
+            save_prefs(user, {"current_wallpaper": new_w})
+            st.rerun()
+
+    # フォント設定
+    themes = owned(user, "font")
+    new_t = st.selectbox("フォント", themes, index=themes.index(user.get('current_theme', '標準')) if user.get('current_theme') in themes else 0)
+    if new_t != user.get('current_theme'):
+        save_prefs(user, {"current_theme": new_t})
+        st.rerun()
+
+    with st.expander("👑 称号コレクション"):
+        my_titles = owned(user, "title")
+        current = user.get('current_title', '見習い')
+
+        if owns(user, "pass", "custom_title"):
+            tab_list, tab_custom = st.tabs(["📜 リスト", "✏️ 自由入力"])
+            with tab_list:
+                idx = my_titles.index(current) if current in my_titles else 0
+                st.selectbox("獲得済み", my_titles, index=idx, key="title_list")
+                st.button("装備", key="eq_list", on_click=equip_title, args=("title_list", "装備を変更しました！"))
+            with tab_custom:
+                st.text_input("名前を入力", value=current, key="title_custom")
+                st.button("設定", key="eq_custom", on_click=equip_title, args=("title_custom", "称号を設定しました！"))
+        else:
+            idx = my_titles.index(current) if current in my_titles else 0
+            st.selectbox("獲得済み", my_titles, index=idx, key="title_only_list")
+            st.button("装備", key="eq_only_list", on_click=equip_title, args=("title_only_list", "装備を変更しました！"))
+
+    if st.button("ログアウト"): flush_prefs(st.session_state["username"]); st.session_state["logged_in"] = False; reset_study_logs(); reset_profile(); st.rerun()
+
+# --- ページ ---
+# 選択中のページだけを描画し、そのページに必要なデータだけを読み込む。
+def page_todo(user, data):
+    c1, c2 = st.columns([0.6, 0.4])
+    month = st.session_state.setdefault("calendar_month", str(date.today())[:7])
+    feed = get_calendar_month(user['username'], month)
+    tasks = feed["tasks"]
+
+    with c1:
+        st.subheader("📅 カレンダー")
+        n1, n2, n3 = st.columns([0.2, 0.6, 0.2])
+        if n1.button("◀", key="cal_prev", use_container_width=True): st.session_state["calendar_month"] = shift_month(month, -1); st.rerun()
+        n2.markdown(f"<div style='text-align:center; font-weight:bold;'>{month.replace('-', '年')}月</div>", unsafe_allow_html=True)
+        if n3.button("▶", key="cal_next", use_container_width=True): st.session_state["calendar_month"] = shift_month(month, 1); st.rerun()
+        cal = calendar(events=feed["events"], options={"initialView": "dayGridMonth", "initialDate": month + "-01", "timeZone": "UTC", "height": 500, "headerToolbar": {"left": "", "center": "", "right": ""}}, callbacks=['dateClick'], key=f"cal_{month}")
+        if cal.get('dateClick'): st.session_state["selected_date"] = cal['dateClick']['date']
+
+    with c2:
+        sel_date_raw = st.session_state.get("selected_date", str(date.today()))
+        display_date = sel_date_raw.split("T")[0]
+        st.markdown(f"### 📌 {display_date}")
+
+        st.info(f"📚 **勉強時間: {day_minutes(user['username'], feed, display_date)} 分**")
+
+        st.write("📝 **タスク**")
+        day_tasks = tasks_on(tasks, display_date)
+        if day_tasks.empty: st.caption("タスクなし")
+        for task in day_tasks.itertuples():
+            name = ("🔁 " if pd.notna(task.rule_id) else "") + str(task.task_name)
+            if task.status == "未完了":
+                if st.button(f"完了: {name}", key=f"do_{task.id}"):
+                    complete_task(task.id, user['username']); st.rerun()
+            else: st.write(f"✅ {name}")
+        if not day_tasks.empty:
+            labels = dict(zip(day_tasks['id'], day_tasks['task_name']))
+            sel = st.multiselect("まとめて操作", list(labels), format_func=labels.get, key=f"bulk_{display_date}")
+            b1, b2 = st.columns(2)
+            if b1.button("まとめて完了", key="bulk_done", disabled=not sel, use_container_width=True):
+                r = commit_tasks(user['username'], "complete", sel)
+                if r.get("completed"): toast(f"{r['completed']}件のタスクを完了しました！")
+                st.rerun()
+            if b2.button("まとめて削除", key="bulk_delete", disabled=not sel, use_container_width=True):
+                commit_tasks(user['username'], "delete", sel); st.rerun()
+
+        st.divider()
+        with st.form("quick_add"):
+            tn = st.text_input("タスク追加")
+            repeat = st.selectbox("繰り返し", list(TASK_REPEAT))
+            if st.form_submit_button("追加") and tn:
+                add_task(user['username'], tn, display_date, "中", TASK_REPEAT[repeat]); st.rerun()
+        rules = [r for r in feed["rules"] if not r['until_date'] or str(r['until_date'])[:10] >= display_date]
+        if rules:
+            with st.expander("🔁 繰り返しタスク"):
+                for r in rules:
+                    r1, r2 = st.columns([0.6, 0.4])
+                    r1.write(f"{r['task_name']} ({'毎日' if r['freq'] == 'daily' else '毎週'})")
+                    if r2.button("この日から止める", key=f"stop_{r['id']}"):
+                        stop_task_rule(user['username'], r['id'], display_date); st.rerun()
+
+def page_timer(user, data):
+    logs_df, subs = data["logs"], data["subjects"]
+    c1, c2 = st.columns([1, 1])
+    with c1:
+        st.subheader("🔥 集中モード")
+        s_name = st.selectbox("科目", subs + ["その他"])
+        if s_name == "その他": s_name = st.text_input("科目名入力")
+        if st.button("スタート", type="primary", use_container_width=True):
+            if s_name:
+                start_study_session(user['username'], s_name)
+                st.rerun()
+    with c2:
+        st.subheader("✏️ 手動記録")
+        with st.form("manual_log"):
+            md = st.date_input("日付")
+            col_h, col_m = st.columns(2)
+            with col_h: h = st.number_input("時間 (h)", 0, 23, 0)
+            with col_m: m = st.number_input("分 (m)", 0, 59, 0)
+            ms = st.text_input("科目", value=s_name if s_name != "その他" else "")
+            if st.form_submit_button("記録"):
+                total_min = h * 60 + m
+                if total_min > 0:
+                    _, _, _, reached = add_study_log(user['username'], ms, total_min, md)
+                    celebrate(); toast("記録しました！")
+                    if reached: toast("🎉 目標達成！ +100コイン！", icon="🎉")
+                    st.rerun()
+                else: st.error("時間を入力してください")
+
+    st.divider()
+    st.write("📖 **最近の記録**")
+    if not logs_df.empty:
+        for _, r in logs_df.iterrows():
+            lc1, lc2 = st.columns([0.8, 0.2])
+            lc1.write(f"・{r['subject']} ({r['duration_minutes']}分) - {r['d']}")
+            if lc2.button("削除", key=f"dl_{r['id']}"):
+                delete_study_log(r['id'], user['username']); st.rerun()
+
+def page_analytics(user, data):
+    rollup = data["rollup"]
+    today_mins = int(rollup.loc[rollup['day'] == str(date.today()), 'minutes'].sum())
+    st.subheader("📊 学習データ分析")
+    if not rollup.empty:
+        k1, k2, k3 = st.columns(3)
+        total_all = int(rollup['minutes'].sum())
+        k1.metric("総勉強時間", f"{total_all//60}時間{total_all%60}分")
+        k2.metric("今日の勉強時間", f"{today_mins}分")
+        k3.metric("連続記録", f"{calc_streak(rollup)}日")
+
+        st.markdown("##### 📅 過去7日間の推移")
+        last_7 = pd.Timestamp.now(JST).normalize().tz_localize(None) - pd.Timedelta(days=6)
+        recent = rollup[rollup['dt'] >= last_7]
+        if not recent.empty:
+            chart = alt.Chart(recent).mark_bar().encode(
+                x=alt.X('dt:T', title='日付', axis=alt.Axis(format='%m/%d')),
+                y=alt.Y('minutes:Q', title='時間(分)'),
+                color=alt.Color('subject:N', title='科目'),
+                tooltip=['day', 'subject', 'minutes', 'sessions']
+            ).properties(height=300)
+            st.altair_chart(chart, use_container_width=True)
+        else: st.info("直近のデータがありません")
+
+        st.markdown("##### 📚 科目比率")
+        sub_dist = rollup.groupby('subject')['minutes'].sum().reset_index()
+        pie = alt.Chart(sub_dist).mark_arc(innerRadius=50).encode(
+            theta=alt.Theta(field="minutes", type="quantitative"),
+            color=alt.Color(field="subject", type="nominal"),
+            tooltip=['subject', 'minutes']
+        ).properties(height=300)
+        st.altair_chart(pie, use_container_width=True)
+    else: st.info("データがありません")
+
+    with st.expander("💾 データの取り込み・書き出し"):
+        st.caption(f"CSV / JSON Lines / JSON の列: study_date (日付), subject (科目), duration_minutes (分)。JSON 配列は {MAX_JSON_IMPORT_BYTES // 1024 // 1024}MB まで")
+        up = st.file_uploader("他のアプリの記録を取り込む", type=["csv", "jsonl", "ndjson", "json"], key="import_file")
+        if up and st.button("取り込む", key="import_run"):
+            bar = st.progress(0.0, text="取り込み中...")
+            try:
+                n, skipped, minutes = import_study_logs(user['username'], up, up.name, lambda k: bar.progress(min(1.0, up.tell() / max(1, up.size)), text=f"{k} 件を確認済み"))
+            except (ValueError, TypeError, UnicodeDecodeError) as e:
+                st.error(f"読み込めませんでした: {e}")
+            else:
+                toast(f"{n} 件 ({minutes}分) を取り込みました" + (f"、{skipped} 件は不正なため飛ばしました" if skipped else ""))
+                st.rerun()
+        u = user['username']
+        st.download_button("📤 ログとタスクを書き出す (ZIP)", data=lambda: export_user_data(u), file_name=f"study_{u}_{date.today()}.zip", mime="application/zip", on_click="ignore", key="export_zip")
+
+def page_ranking(user, data):
+    st.subheader("🏆 週間ランキング")
+    df_rank = data["top"]
+    if not df_rank.empty:
+        for _, row in df_rank.iterrows(): render_rank_card(row)
+        if user['username'] not in set(df_rank['username']):
+            df_me = data["me"]
+            if not df_me.empty:
+                st.markdown("##### 📍 あなたの順位")
+                for _, row in df_me.iterrows(): render_rank_card(row)
+    else: st.info("データなし")
+
+def page_shop(user, data):
+    shop_fonts()
+    shop_wallpapers()
+    shop_other()
+
+# ショップの各セクションは独立したフラグメント。所持コインは HUD に出す。
+# 購入・ガチャ (コールバック) は自分のセクション・HUD・サイドバー (持ち物の一覧) だけを再実行し、
+# 装備しているフォント・壁紙の変更はページ全体のデザインが変わるのでページ全体を再実行する
+def buy(section, category, item):
+    user = get_profile(st.session_state["username"], "shop", check=False)
+    status = purchase_item(user, category, item)
+    if status == "ok": celebrate()
+    if status not in ("ok", "owned"): notify("error", "コイン不足" if status == "insufficient" else "この商品は購入できません", scope=section)
+    refresh(section, "sidebar")
+
+@st.fragment(key="shop_fonts")
+def shop_fonts():
+    user = get_profile(st.session_state["username"], "shop", check=False)
+    show_notices("shop_fonts")
+    st.markdown("### 🅰️ フォント")
+    cols = st.columns(3)
+    for i, (n, p) in enumerate(shop_catalog()["font"].items()):
+        with cols[i % 3]:
+            with st.container(border=True):
+                st.markdown(f"<div class='shop-title'>{n}</div>", unsafe_allow_html=True)
+                if owns(user, "font", n):
+                    st.markdown(f"<span class='shop-owned'>所有済み</span>", unsafe_allow_html=True)
+                    if st.button("装備", disabled=user.get('current_theme') == n, key=f"df_{n}"):
+                        save_prefs(user, {"current_theme": n}); st.rerun()
+                else:
+                    st.markdown(f"<div class='shop-price'>{p} G</div>", unsafe_allow_html=True)
+                    st.button("購入", key=f"buy_f_{n}", use_container_width=True, on_click=buy, args=("shop_fonts", "font", n))
+
+@st.fragment(key="shop_wallpapers")
+def shop_wallpapers():
+    user = get_profile(st.session_state["username"], "shop", check=False)
+    show_notices("shop_wallpapers")
+    st.markdown("### 🖼️ 壁紙")
+    cols = st.columns(2)
+    for i, (n, p) in enumerate(shop_catalog()["wallpaper"].items()):
+        with cols[i % 2]:
+            with st.container(border=True):
+                st.markdown(f"<div class='shop-title'>{n}</div>", unsafe_allow_html=True)
+                if owns(user, "wallpaper", n):
+                    st.markdown(f"<span class='shop-owned'>所有済み</span>", unsafe_allow_html=True)
+                    if st.button("装備", disabled=user.get('current_wallpaper') == n, key=f"d_{n}"):
+                        save_prefs(user, {"current_wallpaper": n}); st.rerun()
+                else:
+                    st.markdown(f"<div class='shop-price'>{p} G</div>", unsafe_allow_html=True)
+                    st.button("購入", key=f"buy_w_{n}", use_container_width=True, on_click=buy, args=("shop_wallpapers", "wallpaper", n))
+
+def render_gacha_result(res):
+    """まとめて引いた結果を1つの一覧で表示する (レア度の高い順)"""
+    table = gacha_table()
+    counts = pd.Series(res["results"]).value_counts()
+    order = sorted(counts.index, key=lambda t: (-GACHA_RARITIES.index(table[t][0]), t))
+    lines = [f"**{table[t][0]}** {t} ×{counts[t]}" + (" 🆕" if t in res["new"] else "") for t in order]
+    st.markdown(f"🎉 {len(res['results'])}回の結果  \n" + "  \n".join(lines))
+    st.caption(f"『{res['equip']}』を装備しました (新規 {len(res['new'])} 件 / シード {res['seed']})")
+
+def pull_gacha(n):
+    user = get_profile(st.session_state["username"], "shop", check=False)
+    status, result = draw_titles(user, n)
+    if status == "ok":
+        st.session_state["gacha_result"] = result
+        if result["new"] or gacha_table()[result["equip"]][0] in ("SR", "SSR"): celebrate()
+    else: notify("error", "コイン不足", scope="shop_other")
+    refresh("shop_other", "sidebar")
+
+@st.fragment(key="shop_other")
+def shop_other():
+    user = get_profile(st.session_state["username"], "shop", check=False)
+    show_notices("shop_other")
+    st.markdown("### 💎 その他")
+    catalog = shop_catalog()
+    price = catalog["gacha"]["title"]
+    c1, c2 = st.columns(2)
+    with c1:
+        with st.container(border=True):
+            st.markdown("<div class='shop-title'>🎲 称号ガチャ</div>", unsafe_allow_html=True)
+            st.markdown(f"<div class='shop-price'>{price} G / 回</div>", unsafe_allow_html=True)
+            b1, b10 = st.columns(2)
+            b1.button("1回引く", key="gacha_1", type="primary", use_container_width=True, on_click=pull_gacha, args=(1,))
+            b10.button(f"10連 ({price * 10} G)", key="gacha_10", use_container_width=True, on_click=pull_gacha, args=(10,))
+            if st.session_state.get("gacha_result"): render_gacha_result(st.session_state["gacha_result"])
+
+    with c2:
+        with st.container(border=True):
+            st.markdown("<div class='shop-title'>👑 自由称号パス</div>", unsafe_allow_html=True)
+            st.markdown(f"<div class='shop-price'>{catalog['pass']['custom_title']} G</div>", unsafe_allow_html=True)
+            if owns(user, "pass", "custom_title"):
+                st.button("✅ 購入済み", disabled=True, use_container_width=True, key="done_pass")
+            else:
+                st.button("パスを購入", key="buy_pass", use_container_width=True, on_click=buy, args=("shop_other", "pass", "custom_title"))
+
+        with st.container(border=True):
+            st.markdown("<div class='shop-title'>🖼️ カスタム壁紙パス</div>", unsafe_allow_html=True)
+            st.markdown(f"<div class='shop-price'>{catalog['pass']['custom_wallpaper']} G</div>", unsafe_allow_html=True)
+            if owns(user, "pass", "custom_wallpaper"):
+                st.button("✅ 購入済み", disabled=True, use_container_width=True, key="buy_wp_done")
+            else:
+                st.button("パスを購入", key="buy_wp_pass", use_container_width=True, on_click=buy, args=("shop_other", "pass", "custom_wallpaper"))
+
+def page_subjects(user, data):
+    new_s = st.text_input("科目追加")
+    if st.button("追加"):
+        if new_s: add_subject_db(user['username'], new_s); st.rerun()
+    st.write("登録済み:")
+    for s in data["subjects"]:
+        c1, c2 = st.columns([0.8, 0.2])
+        c1.write(s)
+        if c2.button("削除", key=f"d_{s}"): delete_subject_db(user['username'], s); st.rerun()
+
+PAGES = ["📝 ToDo", "⏱️ タイマー", "📊 分析", "🏆 ランキング", "🛒 ショップ", "📚 科目"]
+PAGE_RENDERERS = dict(zip(PAGES, [page_todo, page_timer, page_analytics, page_ranking, page_shop, page_subjects]))
+
+# ページごとのデータ読み込み。session_state に触れないのでバックグラウンドで先読みできる
+PAGE_LOADERS = {
+    "📝 ToDo": lambda u: {},
+    "⏱️ タイマー": lambda u: {"subjects": get_subjects(u)},
+    "📊 分析": lambda u: {"rollup": get_rollup(u)},
+    "🏆 ランキング": lambda u: {"top": get_weekly_ranking(), "me": get_my_rank(u)},
+    "🛒 ショップ": lambda u: {},
+    "📚 科目": lambda u: {"subjects": get_subjects(u)},
+}
+# 勉強ログストアはセッションに紐づくため、描画スレッドで読み込む
+LOG_PAGES = {"⏱️ タイマー"}
+# 遷移の実績がないときの「次に開きそうなページ」
+DEFAULT_NEXT_PAGE = {"📝 ToDo": "⏱️ タイマー", "⏱️ タイマー": "📊 分析", "📊 分析": "🏆 ランキング", "🏆 ランキング": "🛒 ショップ", "🛒 ショップ": "📝 ToDo", "📚 科目": "⏱️ タイマー"}
+PREFETCH_MAX_AGE = 60
+# 毎回の再実行 (HUD・テーマ・サイドバー) で使うプロフィールの列
+MAIN_VIEWS = ("hud", "theme", "settings")
+
+@st.cache_resource
+def prefetch_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="prefetch")
+
+# --- 読み込みの同時実行 ---
+# 再実行の冒頭で、この回に必要な独立した読み込みをまとめてスレッドプールに投げる。
+# 待ち時間は各クエリの合計ではなく、最も遅いクエリ1本分に近づく。
+def current_page():
+    # 集中モード中はラジオが描画されず "page" が消えるので、最後に開いたページから戻す
+    if "page" not in st.session_state: st.session_state["page"] = st.session_state.get("current_page", PAGES[0])
+    return st.session_state["page"]
+
+def _fresh_prefetch(page, u):
+    pf = st.session_state.get("prefetch")
+    return pf if pf and pf["page"] == page and pf["username"] == u and time.time() - pf["at"] < PREFETCH_MAX_AGE else None
+
+def take_prefetch(page, u):
+    """page の先読みがまだ新しければ取り出す。別のページの先読みは残しておく"""
+    pf = _fresh_prefetch(page, u)
+    if pf: st.session_state.pop("prefetch")
+    return pf and pf["future"]
+
+def submit_read(fn, *args):
+    """スレッドプールで実行する。呼び出しはこの再実行のトレースに記録し、再実行ごとのメモも共有する"""
+    return prefetch_executor().submit(tracing.bind(tracing.current_trace(), rerun_memo.bind(rerun_memo.current(), fn)), *args)
+
+def start_reads(u):
+    reads = {"user": submit_read(fetch_profile, u, *profile_request(u, *MAIN_VIEWS))}
+    if st.session_state.get("is_studying"): return reads
+    page = current_page()
+    reads["today"] = submit_read(get_day_rollup, u, date.today())
+    reads["page"] = take_prefetch(page, u) or submit_read(PAGE_LOADERS[page], u)
+    if page in LOG_PAGES: reads["logs"] = submit_read(fetch_log_rows, u, _log_store(u)["last_id"])
+    return reads
+
+def load_page_data(page, u, reads):
+    data = None
+    if "page" in reads:
+        try: data = dict(reads["page"].result())
+        except Exception: data = None
+    if data is None: data = PAGE_LOADERS[page](u)
+    if page in LOG_PAGES: data["logs"] = get_study_logs(u, reads["logs"].result() if "logs" in reads else None)
+    return data
+
+def prefetch_next_page(page, u):
+    last = st.session_state.get("last_page")
+    counts = st.session_state.setdefault("page_transitions", {})
+    if last and last != page: counts[(last, page)] = counts.get((last, page), 0) + 1
+    st.session_state["last_page"] = page
+    seen = {nxt: c for (prev, nxt), c in counts.items() if prev == page}
+    nxt = max(seen, key=seen.get) if seen else DEFAULT_NEXT_PAGE[page]
+    # 同じページの先読みが残っていれば (書き込みで捨てられていなければ) 投げ直さない
+    if _fresh_prefetch(nxt, u): return
+    st.session_state["prefetch"] = {"page": nxt, "username": u, "at": time.time(), "future": submit_read(PAGE_LOADERS[nxt], u)}
+
+def invalidate_views():
+    """書き込み後に、キャッシュしたカレンダーと先読み結果を捨てる"""
+    st.session_state.pop("calendar_cache", None)
+    st.session_state.pop("prefetch", None)
+    rerun_memo.forget()
+
+# --- デバッグ: バックエンド呼び出しのトレース ---
+# URL に ?debug=1 を付けるか secrets の [debug] trace = true で、サイドバーに再実行ごとの
+# 呼び出し一覧 (ウォーターフォール) を出す。集計は環境変数 STUDY_APP_METRICS または
+# secrets の [debug] metrics_path のファイルへ Prometheus 形式で書き出す。
+def debug_enabled():
+    if st.query_params.get("debug") == "1": return True
+    try: return bool(st.secrets.get("debug", {}).get("trace"))
+    except Exception: return False
+
+def metrics_path():
+    if os.environ.get("STUDY_APP_METRICS"): return os.environ["STUDY_APP_METRICS"]
+    try: return st.secrets.get("debug", {}).get("metrics_path")
+    except Exception: return None
+
+def render_trace_panel(trace):
+    calls = list(trace.calls)
+    with st.sidebar.expander(f"🛠 バックエンド呼び出し ({len(calls)})"):
+        if not calls: st.caption("この再実行では呼び出しなし"); return
+        df = pd.DataFrame(calls).sort_values("start_ms").reset_index(drop=True)
+        df["end_ms"] = df["start_ms"] + df["ms"]
+        df["call"] = [f"{i:02d} {t}.{o}" for i, t, o in zip(df.index, df["table"], df["op"])]
+        st.caption(f"{df['end_ms'].max():.0f} ms / 合計 {df['ms'].sum():.0f} ms / {df['rows'].sum()} 行 / {df['bytes'].sum() / 1024:.1f} KB")
+        chart = alt.Chart(df).mark_bar().encode(
+            x=alt.X("start_ms:Q", title="ms"), x2="end_ms:Q",
+            y=alt.Y("call:N", sort=None, title=None), color=alt.Color("thread:N", legend=None),
+            tooltip=["site", "table", "op", "filters", alt.Tooltip("ms:Q", format=".1f"), "rows", "bytes"],
+        ).properties(height=max(120, 18 * len(df)))
+        st.altair_chart(chart, use_container_width=True)
+        st.dataframe(df[["site", "table", "op", "filters", "ms", "rows", "bytes"]].round({"ms": 1}), hide_index=True)
+    if hasattr(supabase, "snapshot"):
+        with st.sidebar.expander("🛠 接続プール・再試行"): st.json(supabase.snapshot())
+
 # --- メイン処理 ---
 def main():
+    trace = tracing.begin_trace()
+    rerun_memo.begin()
+    try: run_page()
+    finally:
+        try: tracing.export_metrics(metrics_path())
+        except OSError: pass
+    if debug_enabled(): render_trace_panel(trace)
+
+def run_page():
+    if supabase is None:
+        st.error(f"データベースに接続できません: {SUPABASE_ERROR!r}")
+        return
+    if hasattr(supabase, "breaker") and supabase.breaker.state() != "closed":
+        st.warning("サーバーにつながりにくいため、一部は前回読み込んだ内容を表示しています")
     if "logged_in" not in st.session_state: 
-        st.session_state.update({"logged_in": False, "username": "", "is_studying": False, "start_time": None, "celebrate": False, "toast_msg": None, "selected_date": str(date.today())})
+        st.session_state.update({"logged_in": False, "username": "", "is_studying": False, "start_time": None, "notices": [], "selected_date": str(date.today())})
 
     if not st.session_state["logged_in"]:
         st.title("🛡️ ログイン")
@@ -310,391 +1544,61 @@ def main():
                 if res:
                     st.session_state["logged_in"] = True
                     st.session_state["username"] = u
+                    restore_study_session(u)
                     st.rerun()
                 else: st.error(msg)
         return
 
     # ログイン後
-    user = get_user_data(st.session_state["username"])
+    reads = start_reads(st.session_state["username"])
+    try: fetched = reads["user"].result()
+    except Exception: fetched = {}
+    user = merge_profile(st.session_state["username"], fetched)
     if not user: st.session_state["logged_in"] = False; st.rerun()
 
     # 自動移行: 「草原」などの設定が残っていたら「真っ黒」に書き換える（初期化）
-    if user.get('current_wallpaper') == "草原" and "草原" in user.get('unlocked_wallpapers', ''):
-        supabase.table("users").update({"current_wallpaper": "真っ黒"}).eq("username", user['username']).execute()
-        user['current_wallpaper'] = "真っ黒"
+    if user.get('current_wallpaper') == "草原" and owns(user, "wallpaper", "草原"):
+        save_prefs(user, {"current_wallpaper": "真っ黒"})
         st.rerun()
 
+    # 自動移行: base64で保存された旧カスタム壁紙を、アップロードと同じ変換ジョブでハッシュ保存に移す (セッションごとに1回)
+    if user.get('current_wallpaper') == "カスタム" and not user.get('custom_bg_hash') and not st.session_state.get("wallpaper_job") and not st.session_state.get("legacy_wallpaper_tried"):
+        st.session_state["legacy_wallpaper_tried"] = True
+        data = legacy_wallpaper(user['username'])
+        if data: start_wallpaper_job(data, legacy=True)
+
     # ★ログインボーナス判定★
     today_str = str(date.today())
     if user.get('last_login_date') != today_str:
-        new_coins = user['coins'] + 50
-        supabase.table("users").update({
-            "coins": new_coins,
-            "last_login_date": today_str
-        }).eq("username", user['username']).execute()
-        st.toast("🎁 ログインボーナス！ +50コイン GET！", icon="🎁")
-        time.sleep(1)
-        user['coins'] = new_coins
+        if grant_login_bonus(user['username'], today_str): toast("🎁 ログインボーナス！ +50コイン GET！", icon="🎁")
 
     # デザイン適用
-    apply_design(user.get('current_theme', '標準'), user.get('current_wallpaper', '真っ黒'), user.get('custom_bg_data'))
+    custom_urls = wallpaper_urls(user['custom_bg_hash']) if user.get('custom_bg_hash') else None
+    apply_design(user.get('current_theme', '標準'), user.get('current_wallpaper', '真っ黒'), custom_urls)
 
     # ★ 集中モード (BGM無し)
     if st.session_state["is_studying"]:
         st.empty()
         st.markdown(f"<h1 style='text-align: center; font-size: 3em;'>🔥 {st.session_state.get('current_subject', '勉強')} 中...</h1>", unsafe_allow_html=True)
-        show_timer_fragment(user['username'])
+        show_timer(user['username'])
         return
 
     # 本日の勉強時間取得
-    logs_df = get_study_logs(user['username'])
-    today_mins = 0
-    if not logs_df.empty:
-        logs_df['d'] = logs_df['study_date'].astype(str).str.split("T").str[0]
-        today_mins = logs_df[logs_df['d'] == str(date.today())]['duration_minutes'].sum()
+    st.session_state["today_minutes"] = int(reads["today"].result()['minutes'].sum())
 
     # ★HUD
-    level = (user['xp'] // 100) + 1
-    next_xp = level * 100
-    goal = user.get('daily_goal', 60)
-    goal_progress = min(1.0, today_mins / goal) if goal > 0 else 0
-    
-    st.markdown(f"""
-    <div class="status-bar">
-        <div class="stat-item"><div class="stat-label">PLAYER</div><div class="stat-val" style="font-size:1.2em;">{user['nickname']}</div><div style="font-size:0.7em; color:gold;">{user.get('current_title', '見習い')}</div></div>
-        <div class="stat-item"><div class="stat-label">LEVEL</div><div class="stat-val" style="color:#00e5ff;">{level}</div></div>
-        <div class="stat-item"><div class="stat-label">XP</div><div class="stat-val">{user['xp']} <span style="font-size:0.5em; color:#888;">/ {next_xp}</span></div></div>
-        <div class="stat-item"><div class="stat-label">COIN</div><div class="stat-val" style="color:#FFD700;">{user['coins']} G</div></div>
-        <div class="stat-item" style="border-left:1px solid #444; padding-left:15px;">
-            <div class="stat-label">TODAY'S GOAL</div>
-            <div class="stat-val" style="color:#ff9900;">{today_mins} <span style="font-size:0.5em; color:#888;">/ {goal} min</span></div>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    st.progress(goal_progress)
-    if today_mins >= goal and goal > 0:
-        if user.get('last_goal_reward_date') == str(date.today()):
-             st.caption("✅ 今日の目標達成済み！ボーナス獲得済み")
-        else:
-             st.caption("🔥 あと少しで目標達成！")
+    hud()
 
     # サイドバー
-    with st.sidebar:
-        st.subheader("⚙️ 設定")
-        
-        # 目標設定
-        st.markdown("##### 🎯 1日の目標")
-        new_goal = st.number_input("目標時間(分)", min_value=10, max_value=600, value=user.get('daily_goal', 60), step=10)
-        if new_goal != user.get('daily_goal', 60):
-            if st.button("目標を保存"):
-                supabase.table("users").update({"daily_goal": new_goal}).eq("username", user['username']).execute()
-                st.success("保存しました"); time.sleep(0.5); st.rerun()
-        
-        st.divider()
-
-        # 壁紙設定 (真っ黒、プリセット、カスタム)
-        walls = user['unlocked_wallpapers'].split(',')
-        if "真っ黒" not in walls: walls.insert(0, "真っ黒")
-        if "草原" in walls: walls.remove("草原") # 初期化で草原に戻さない
-        
-        if user.get('custom_wallpaper_unlocked'):
-            bg_mode = st.radio("壁紙モード", ["プリセット", "カスタム画像"], horizontal=True, label_visibility="collapsed")
-            if bg_mode == "カスタム画像":
-                st.caption("画像をアップロードして壁紙に設定")
-                uploaded_file = st.file_uploader("画像を選択", type=['jpg', 'png', 'jpeg'])
-                if uploaded_file:
-                    if st.button("この画像を適用"):
-                        img = Image.open(uploaded_file)
-                        img.thumbnail((1920, 1080))
-                        b64_str = image_to_base64(img)
-                        supabase.table("users").update({"current_wallpaper": "カスタム", "custom_bg_data": b64_str}).eq("username", user['username']).execute()
-                        st.success("更新しました！"); time.sleep(1); st.rerun()
-                elif user.get('current_wallpaper') == 'カスタム': st.success("カスタム画像適用中")
-            else:
-                current_w = user.get('current_wallpaper', '真っ黒')
-                if current_w not in walls: current_w = "真っ黒"
-                new_w = st.selectbox("壁紙", walls, index=walls.index(current_w) if current_w in walls else 0)
-                if new_w != user.get('current_wallpaper'):
-                    supabase.table("users").update({"current_wallpaper": new_w}).eq("username", user['username']).execute()
-                    st.rerun()
-        else:
-            current_w = user.get('current_wallpaper', '真っ黒')
-            if current_w not in walls: current_w = "真っ黒"
-            new_w = st.selectbox("壁紙", walls, index=walls.index(current_w) if current_w in walls else 0)
-            if new_w != user.get('current_wallpaper'):
-                supabase.table("users").update({"current_wallpaper": new_w}).eq("username", user['username']).execute()
-                st.rerun()
-        
-        # フォント設定
-        themes = user.get('unlocked_themes', '標準').split(',')
-        new_t = st.selectbox("フォント", themes, index=themes.index(user.get('current_theme', '標準')) if user.get('current_theme') in themes else 0)
-        if new_t != user.get('current_theme'):
-            supabase.table("users").update({"current_theme": new_t}).eq("username", user['username']).execute()
-            st.rerun()
-            
-        with st.expander("👑 称号コレクション"):
-            my_titles = user.get('unlocked_titles', '見習い').split(',')
-            current = user.get('current_title', '見習い')
-            
-            if user.get('custom_title_unlocked'):
-                tab_list, tab_custom = st.tabs(["📜 リスト", "✏️ 自由入力"])
-                with tab_list:
-                    idx = my_titles.index(current) if current in my_titles else 0
-                    sel_t = st.selectbox("獲得済み", my_titles, index=idx)
-                    if st.button("装備", key="eq_list"):
-                        supabase.table("users").update({"current_title": sel_t}).eq("username", user['username']).execute()
-                        st.toast("装備を変更しました！"); time.sleep(1); st.rerun()
-                with tab_custom:
-                    custom_t = st.text_input("名前を入力", value=current)
-                    if st.button("設定", key="eq_custom"):
-                        supabase.table("users").update({"current_title": custom_t}).eq("username", user['username']).execute()
-                        st.toast("称号を設定しました！"); time.sleep(1); st.rerun()
-            else:
-                idx = my_titles.index(current) if current in my_titles else 0
-                sel_t = st.selectbox("獲得済み", my_titles, index=idx)
-                if st.button("装備", key="eq_only_list"):
-                    supabase.table("users").update({"current_title": sel_t}).eq("username", user['username']).execute()
-                    st.toast("装備を変更しました！"); time.sleep(1); st.rerun()
-
-        if st.button("ログアウト"): st.session_state["logged_in"] = False; st.rerun()
+    with st.sidebar: sidebar_settings()
 
     # メイン画面
-    if st.session_state.get("celebrate"): st.balloons(); st.session_state["celebrate"] = False
-    if st.session_state.get("toast_msg"): st.toast(st.session_state["toast_msg"]); st.session_state["toast_msg"] = None
-    if st.session_state.get("goal_reached_msg"):
-        st.toast(st.session_state["goal_reached_msg"], icon="🎉")
-        st.balloons()
-        st.session_state["goal_reached_msg"] = None
-
-    t1, t2, t3, t4, t5, t6 = st.tabs(["📝 ToDo", "⏱️ タイマー", "📊 分析", "🏆 ランキング", "🛒 ショップ", "📚 科目"])
-
-    with t1: # ToDo & Calendar
-        c1, c2 = st.columns([0.6, 0.4])
-        events = []
-        if not tasks.empty:
-            for _, r in tasks.iterrows():
-                color = "#FF4B4B" if r['status'] == '未完了' else "#888"
-                events.append({"title": f"📝 {r['task_name']}", "start": r['due_date'], "color": color})
-        if not logs_df.empty:
-            for _, r in logs_df.iterrows():
-                d_str = str(r['study_date']).split("T")[0]
-                events.append({"title": f"📖 {r['subject']} ({r['duration_minutes']}分)", "start": d_str, "color": "#00CC00"})
-
-        with c1:
-            st.subheader("📅 カレンダー")
-            cal = calendar(events=events, options={"initialView": "dayGridMonth", "height": 500}, callbacks=['dateClick'])
-            if cal.get('dateClick'): st.session_state["selected_date"] = cal['dateClick']['date']
-        
-        with c2:
-            sel_date_raw = st.session_state.get("selected_date", str(date.today()))
-            display_date = sel_date_raw.split("T")[0]
-            st.markdown(f"### 📌 {display_date}")
-            
-            day_mins_sel = 0
-            if not logs_df.empty:
-                day_logs = logs_df[logs_df['d'] == display_date]
-                day_mins_sel = day_logs['duration_minutes'].sum()
-                st.info(f"📚 **勉強時間: {day_mins_sel} 分**")
-            
-            st.write("📝 **タスク**")
-            if not tasks.empty:
-                day_tasks = tasks[tasks['due_date'] == display_date]
-                if not day_tasks.empty:
-                    for _, task in day_tasks.iterrows():
-                        if task['status'] == "未完了":
-                            if st.button(f"完了: {task['task_name']}", key=f"do_{task['id']}"):
-                                complete_task(task['id'], user['username']); st.rerun()
-                        else: st.write(f"✅ {task['task_name']}")
-                else: st.caption("タスクなし")
-            
-            st.divider()
-            with st.form("quick_add"):
-                tn = st.text_input("タスク追加")
-                if st.form_submit_button("追加"):
-                    add_task(user['username'], tn, display_date, "中"); st.rerun()
-
-    with t2: # タイマー
-        c1, c2 = st.columns([1, 1])
-        with c1:
-            st.subheader("🔥 集中モード")
-            subs = get_subjects(user['username'])
-            s_name = st.selectbox("科目", subs + ["その他"])
-            if s_name == "その他": s_name = st.text_input("科目名入力")
-            if st.button("スタート", type="primary", use_container_width=True):
-                if s_name:
-                    st.session_state["is_studying"] = True
-                    st.session_state["start_time"] = time.time()
-                    st.session_state["current_subject"] = s_name
-                    st.rerun()
-        with c2:
-            st.subheader("✏️ 手動記録")
-            with st.form("manual_log"):
-                md = st.date_input("日付")
-                col_h, col_m = st.columns(2)
-                with col_h: h = st.number_input("時間 (h)", 0, 23, 0)
-                with col_m: m = st.number_input("分 (m)", 0, 59, 0)
-                ms = st.text_input("科目", value=s_name if s_name != "その他" else "")
-                if st.form_submit_button("記録"):
-                    total_min = h * 60 + m
-                    if total_min > 0:
-                        _, _, _, reached = add_study_log(user['username'], ms, total_min, md)
-                        st.session_state["toast_msg"] = "記録しました！"
-                        st.session_state["celebrate"] = True
-                        if reached:
-                            st.session_state["goal_reached_msg"] = "🎉 目標達成！ +100コイン！"
-                        st.rerun()
-                    else: st.error("時間を入力してください")
-        
-        st.divider()
-        st.write("📖 **最近の記録**")
-        if not logs_df.empty:
-            for _, r in logs_df.head(5).iterrows():
-                lc1, lc2 = st.columns([0.8, 0.2])
-                d_str = str(r['study_date']).split("T")[0]
-                lc1.write(f"・{r['subject']} ({r['duration_minutes']}分) - {d_str}")
-                if lc2.button("削除", key=f"dl_{r['id']}"):
-                    delete_study_log(r['id'], user['username'], r['duration_minutes']); st.rerun()
-
-    with t3: # 分析
-        st.subheader("📊 学習データ分析")
-        if not logs_df.empty:
-            k1, k2 = st.columns(2)
-            total_all = logs_df['duration_minutes'].sum()
-            k1.metric("総勉強時間", f"{total_all//60}時間{total_all%60}分")
-            k2.metric("今日の勉強時間", f"{today_mins}分")
-            
-            st.markdown("##### 📅 過去7日間の推移")
-            logs_df['dt'] = pd.to_datetime(logs_df['study_date'])
-            last_7 = pd.Timestamp.now(JST).normalize().tz_localize(None) - pd.Timedelta(days=6)
-            recent = logs_df[logs_df['dt'] >= last_7].copy()
-            if not recent.empty:
-                chart = alt.Chart(recent).mark_bar().encode(
-                    x=alt.X('dt:T', title='日付', axis=alt.Axis(format='%m/%d')),
-                    y=alt.Y('duration_minutes:Q', title='時間(分)'),
-                    color=alt.Color('subject:N', title='科目'),
-                    tooltip=['study_date', 'subject', 'duration_minutes']
-                ).properties(height=300)
-                st.altair_chart(chart, use_container_width=True)
-            else: st.info("直近のデータがありません")
-            
-            st.markdown("##### 📚 科目比率")
-            sub_dist = logs_df.groupby('subject')['duration_minutes'].sum().reset_index()
-            pie = alt.Chart(sub_dist).mark_arc(innerRadius=50).encode(
-                theta=alt.Theta(field="duration_minutes", type="quantitative"),
-                color=alt.Color(field="subject", type="nominal"),
-                tooltip=['subject', 'duration_minutes']
-            ).properties(height=300)
-            st.altair_chart(pie, use_container_width=True)
-        else: st.info("データがありません")
-
-    with t4: # ランキング
-        st.subheader("🏆 週間ランキング")
-        df_rank = get_weekly_ranking()
-        if not df_rank.empty:
-            for i, row in df_rank.iterrows():
-                rank = i + 1
-                medal = "🥇" if rank==1 else "🥈" if rank==2 else "🥉" if rank==3 else f"{rank}位"
-                st.markdown(f"""
-                <div class="ranking-card">
-                    <div class="rank-medal" style="color: {'#FFD700' if rank==1 else '#C0C0C0' if rank==2 else '#CD7F32' if rank==3 else '#fff'};">{medal}</div>
-                    <div class="rank-info">
-                        <div class="rank-name">{row['nickname']}</div>
-                        <div class="rank-title">👑 {row.get('current_title', '見習い')}</div>
-                    </div>
-                    <div class="rank-score">{int(row['duration_minutes'])} min</div>
-                </div>
-                """, unsafe_allow_html=True)
-        else: st.info("データなし")
-        
-        st.markdown("### 🅰️ フォント")
-        font_items = [("ピクセル風", 500), ("手書き風", 800), ("ポップ", 1000), ("明朝体", 1200), ("筆文字", 1500)]
-        cols = st.columns(3)
-        my_fonts = user.get('unlocked_themes', '標準').split(',')
-        for i, (n, p) in enumerate(font_items):
-            with cols[i % 3]:
-                with st.container(border=True):
-                    st.markdown(f"<div class='shop-title'>{n}</div>", unsafe_allow_html=True)
-                    if n in my_fonts:
-                        st.markdown(f"<span class='shop-owned'>所有済み</span>", unsafe_allow_html=True)
-                        st.button("設定へ", disabled=True, key=f"df_{n}")
-                    else:
-                        st.markdown(f"<div class='shop-price'>{p} G</div>", unsafe_allow_html=True)
-                        if st.button("購入", key=f"buy_f_{n}", use_container_width=True):
-                            if user['coins'] >= p:
-                                nl = user['unlocked_themes'] + f",{n}"
-                                supabase.table("users").update({"coins": user['coins']-p, "unlocked_themes": nl}).eq("username", user['username']).execute()
-                                st.balloons(); st.rerun()
-                            else: st.error("コイン不足")
-
-        st.markdown("### 🖼️ 壁紙")
-        items = [("夕焼け", 500), ("夜空", 800), ("ダンジョン", 1200), ("王宮", 2000)]
-        cols = st.columns(2)
-        for i, (n, p) in enumerate(items):
-            with cols[i % 2]:
-                with st.container(border=True):
-                    st.markdown(f"<div class='shop-title'>{n}</div>", unsafe_allow_html=True)
-                    if n in user['unlocked_wallpapers']:
-                        st.markdown(f"<span class='shop-owned'>所有済み</span>", unsafe_allow_html=True)
-                        st.button("設定へ", disabled=True, key=f"d_{n}")
-                    else:
-                        st.markdown(f"<div class='shop-price'>{p} G</div>", unsafe_allow_html=True)
-                        if st.button("購入", key=f"buy_w_{n}", use_container_width=True):
-                            if user['coins'] >= p:
-                                nl = user['unlocked_wallpapers'] + f",{n}"
-                                supabase.table("users").update({"coins": user['coins']-p, "unlocked_wallpapers": nl}).eq("username", user['username']).execute()
-                                st.balloons(); st.rerun()
-                            else: st.error("コイン不足")
-
-        st.markdown("### 💎 その他")
-        c1, c2 = st.columns(2)
-        with c1:
-            with st.container(border=True):
-                st.markdown("<div class='shop-title'>🎲 称号ガチャ</div>", unsafe_allow_html=True)
-                st.markdown("<div class='shop-price'>100 G</div>", unsafe_allow_html=True)
-                if st.button("ガチャを回す", type="primary", use_container_width=True):
-                    if user['coins'] >= 100:
-                        got = random.choice(["駆け出し", "努力家", "集中王", "夜更かし", "天才", "覚醒者", "大賢者", "神童"])
-                        current = user.get('unlocked_titles', '')
-                        if got not in current: current += f",{got}"
-                        supabase.table("users").update({"coins": user['coins']-100, "unlocked_titles": current, "current_title": got}).eq("username", user['username']).execute()
-                        st.toast(f"🎉 称号『{got}』を獲得しました！"); st.balloons(); time.sleep(1); st.rerun()
-                    else: st.error("コイン不足")
-        
-        with c2:
-            with st.container(border=True):
-                st.markdown("<div class='shop-title'>👑 自由称号パス</div>", unsafe_allow_html=True)
-                st.markdown("<div class='shop-price'>9999 G</div>", unsafe_allow_html=True)
-                if user.get('custom_title_unlocked'):
-                    st.button("✅ 購入済み", disabled=True, use_container_width=True, key="done_pass")
-                else:
-                    if st.button("パスを購入", key="buy_pass", use_container_width=True):
-                        if user['coins'] >= 9999:
-                            supabase.table("users").update({"coins": user['coins']-9999, "custom_title_unlocked": True}).eq("username", user['username']).execute()
-                            st.balloons(); st.rerun()
-                        else: st.error("不足")
-                        
-            with st.container(border=True):
-                st.markdown("<div class='shop-title'>🖼️ カスタム壁紙パス</div>", unsafe_allow_html=True)
-                st.markdown("<div class='shop-price'>9999 G</div>", unsafe_allow_html=True)
-                if user.get('custom_wallpaper_unlocked'):
-                    st.button("✅ 購入済み", disabled=True, use_container_width=True, key="buy_wp_done")
-                else:
-                    if st.button("パスを購入", key="buy_wp_pass", use_container_width=True):
-                        if user['coins'] >= 9999:
-                            supabase.table("users").update({"coins": user['coins']-9999, "custom_wallpaper_unlocked": True}).eq("username", user['username']).execute()
-                            st.balloons(); st.rerun()
-                        else: st.error("不足")
-
-    with t6: # 科目
-        new_s = st.text_input("科目追加")
-        if st.button("追加"):
-            if new_s: add_subject_db(user['username'], new_s); st.rerun()
-        st.write("登録済み:")
-        for s in get_subjects(user['username']):
-            c1, c2 = st.columns([0.8, 0.2])
-            c1.write(s)
-            if c2.button("削除", key=f"d_{s}"): delete_subject_db(user['username'], s); st.rerun()
+    show_notices("main")
+
+    page = st.radio("ページ", PAGES, horizontal=True, label_visibility="collapsed", key="page")
+    st.session_state["current_page"] = page
+    PAGE_RENDERERS[page](user, load_page_data(page, user['username'], reads))
+    prefetch_next_page(page, user['username'])
 
 if __name__ == "__main__":
     main()
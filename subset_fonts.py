@@ -0,0 +1,87 @@
+# ショップのフォントを、UIで使う文字だけに絞った WOFF2 にして static/fonts/ に置く
+# Google Fonts などから入手した元の TTF/OTF を1つのディレクトリに置いて実行する。
+#
+#   $ pip install fonttools brotli
+#   $ python subset_fonts.py --source ~/Downloads/fonts
+#
+# 含める文字は streamlit_app.py の文字列リテラルに出てくる文字・ASCII・ひらがな・カタカナ・全角記号。
+# ニックネームや科目名など利用者が入力した文字で含まれないものは、ブラウザが代替フォントで表示する。
+# よく使う文字を足したいときは --extra-text にテキストファイルを渡す。
+import argparse
+import ast
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(HERE, "streamlit_app.py")
+OUT_DIR = os.path.join(HERE, "static", "fonts")
+# 出力ファイル名 (streamlit_app.FONTS と同じ) -> 元ファイル名の候補
+SOURCES = {
+    "dotgothic16": ["DotGothic16-Regular.ttf"],
+    "yomogi": ["Yomogi-Regular.ttf"],
+    "hachi-maru-pop": ["HachiMaruPop-Regular.ttf"],
+    "shippori-mincho": ["ShipporiMincho-Regular.ttf", "ShipporiMincho-Regular.otf"],
+    "yuji-syuku": ["YujiSyuku-Regular.ttf"],
+}
+RANGES = [
+    (0x20, 0x7E),      # ASCII
+    (0x3000, 0x303F),  # 全角の句読点・括弧
+    (0x3040, 0x309F),  # ひらがな
+    (0x30A0, 0x30FF),  # カタカナ
+    (0xFF01, 0xFF5E),  # 全角英数・記号
+]
+
+
+def ui_text(path=APP):
+    """アプリの文字列リテラルに出てくる文字"""
+    with open(path, encoding="utf-8") as f: tree = ast.parse(f.read())
+    return "".join(n.value for n in ast.walk(tree) if isinstance(n, ast.Constant) and isinstance(n.value, str))
+
+
+def glyphs(extra=""):
+    chars = {chr(c) for lo, hi in RANGES for c in range(lo, hi + 1)}
+    chars |= set(ui_text()) | set(extra)
+    return "".join(sorted(c for c in chars if c.isprintable()))
+
+
+def subset(src, dst, text):
+    from fontTools import subset as ft_subset
+    opts = ft_subset.Options()
+    opts.flavor = "woff2"
+    opts.layout_features = ["*"]
+    opts.name_IDs = ["*"]
+    opts.notdef_outline = True
+    font = ft_subset.load_font(src, opts)
+    sub = ft_subset.Subsetter(opts)
+    sub.populate(text=text)
+    sub.subset(font)
+    ft_subset.save_font(font, dst, opts)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="UIで使う文字だけのWOFF2フォントを作る")
+    ap.add_argument("--source", required=True, help="元のフォントファイルを置いたディレクトリ")
+    ap.add_argument("--extra-text", help="追加で含める文字を書いたテキストファイル")
+    args = ap.parse_args()
+    try:
+        import fontTools  # noqa: F401
+    except ImportError:
+        sys.exit("fonttools と brotli が必要です: pip install fonttools brotli")
+
+    extra = ""
+    if args.extra_text:
+        with open(args.extra_text, encoding="utf-8") as f: extra = f.read()
+    text = glyphs(extra)
+    os.makedirs(OUT_DIR, exist_ok=True)
+    for name, candidates in SOURCES.items():
+        src = next((os.path.join(args.source, c) for c in candidates if os.path.exists(os.path.join(args.source, c))), None)
+        if src is None:
+            print(f"skip {name}: {' / '.join(candidates)} not found")
+            continue
+        dst = os.path.join(OUT_DIR, f"{name}.woff2")
+        subset(src, dst, text)
+        print(f"{name}: {os.path.getsize(src) // 1024} KB -> {os.path.getsize(dst) // 1024} KB ({len(text)} chars)")
+
+
+if __name__ == "__main__":
+    main()
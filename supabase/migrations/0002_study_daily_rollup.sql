@@ -0,0 +1,59 @@
+-- 日別・科目別の集計テーブル
+-- study_logs への追加・削除時にトリガーで差分更新する。
+-- HUD と分析タブはこのテーブルだけを読むため、コストはログ件数ではなく日数に比例する。
+
+create table if not exists study_daily_rollup (
+    username text not null,
+    day date not null,
+    subject text not null,
+    minutes integer not null default 0,
+    sessions integer not null default 0,
+    primary key (username, day, subject)
+);
+
+create or replace function bump_study_rollup() returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op = 'INSERT' then
+        insert into study_daily_rollup (username, day, subject, minutes, sessions)
+        values (new.username, new.study_date, coalesce(new.subject, ''), new.duration_minutes, 1)
+        on conflict (username, day, subject) do update set
+            minutes = study_daily_rollup.minutes + excluded.minutes,
+            sessions = study_daily_rollup.sessions + 1;
+        return new;
+    else
+        update study_daily_rollup set
+            minutes = minutes - old.duration_minutes,
+            sessions = sessions - 1
+        where username = old.username and day = old.study_date and subject = coalesce(old.subject, '');
+        delete from study_daily_rollup
+        where username = old.username and day = old.study_date and subject = coalesce(old.subject, '')
+          and sessions <= 0;
+        return old;
+    end if;
+end;
+$$;
+
+drop trigger if exists study_logs_rollup on study_logs;
+create trigger study_logs_rollup
+after insert or delete on study_logs
+for each row execute function bump_study_rollup();
+
+-- 既存ログからの一括再構築: select rebuild_study_rollup();  (ユーザー指定も可)
+create or replace function rebuild_study_rollup(p_username text default null) returns integer
+language plpgsql
+as $$
+declare
+    v_rows integer;
+begin
+    delete from study_daily_rollup where p_username is null or username = p_username;
+    insert into study_daily_rollup (username, day, subject, minutes, sessions)
+    select username, study_date, coalesce(subject, ''), sum(duration_minutes), count(*)
+    from study_logs
+    where p_username is null or username = p_username
+    group by username, study_date, coalesce(subject, '');
+    get diagnostics v_rows = row_count;
+    return v_rows;
+end;
+$$;
@@ -0,0 +1,101 @@
+-- 週間ランキング (直近7日 + 今日) をサーバー側で保持する
+-- ログの追加・削除時にトリガーで差分更新し、日付が変わって集計期間がずれたら
+-- study_daily_rollup から作り直す。クライアントは表示する行だけを受け取る。
+
+create table if not exists weekly_leaderboard (
+    username text primary key,
+    minutes integer not null default 0
+);
+create index if not exists weekly_leaderboard_minutes_idx on weekly_leaderboard (minutes desc, username);
+
+create table if not exists weekly_leaderboard_meta (
+    id integer primary key default 1 check (id = 1),
+    window_start date not null
+);
+
+create or replace function leaderboard_window_start() returns date
+language sql stable
+as $$ select (now() at time zone 'Asia/Tokyo')::date - 7 $$;
+
+create or replace function refresh_weekly_leaderboard() returns void
+language plpgsql
+as $$
+declare
+    v_start date := leaderboard_window_start();
+begin
+    -- 同時に複数のセッションが作り直さないようにする
+    perform pg_advisory_xact_lock(hashtext('weekly_leaderboard'));
+    if exists (select 1 from weekly_leaderboard_meta where window_start = v_start) then
+        return;
+    end if;
+    delete from weekly_leaderboard where true;
+    insert into weekly_leaderboard (username, minutes)
+    select username, sum(minutes) from study_daily_rollup
+    where day >= v_start
+    group by username
+    having sum(minutes) > 0;
+    insert into weekly_leaderboard_meta (id, window_start) values (1, v_start)
+    on conflict (id) do update set window_start = excluded.window_start;
+end;
+$$;
+
+create or replace function bump_weekly_leaderboard() returns trigger
+language plpgsql
+as $$
+declare
+    v_start date;
+begin
+    select window_start into v_start from weekly_leaderboard_meta where id = 1;
+    if v_start is null then
+        return null;
+    end if;
+    if tg_op = 'INSERT' and new.study_date >= v_start then
+        insert into weekly_leaderboard (username, minutes) values (new.username, new.duration_minutes)
+        on conflict (username) do update set minutes = weekly_leaderboard.minutes + excluded.minutes;
+    elsif tg_op = 'DELETE' and old.study_date >= v_start then
+        update weekly_leaderboard set minutes = greatest(0, minutes - old.duration_minutes)
+        where username = old.username;
+        delete from weekly_leaderboard where username = old.username and minutes <= 0;
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists study_logs_leaderboard on study_logs;
+create trigger study_logs_leaderboard
+after insert or delete on study_logs
+for each row execute function bump_weekly_leaderboard();
+
+create or replace function weekly_top(p_limit integer default 10)
+returns table (rank bigint, username text, nickname text, current_title text, duration_minutes integer)
+language plpgsql
+as $$
+begin
+    perform refresh_weekly_leaderboard();
+    return query
+    select row_number() over (order by l.minutes desc, l.username), l.username, u.nickname, u.current_title, l.minutes
+    from weekly_leaderboard l left join users u on u.username = l.username
+    order by l.minutes desc, l.username
+    limit p_limit;
+end;
+$$;
+
+create or replace function weekly_rank_around(p_username text, p_radius integer default 2)
+returns table (rank bigint, username text, nickname text, current_title text, duration_minutes integer)
+language plpgsql
+as $$
+begin
+    perform refresh_weekly_leaderboard();
+    return query
+    with ranked as (
+        select row_number() over (order by l.minutes desc, l.username) as rk, l.username, l.minutes
+        from weekly_leaderboard l
+    ), me as (
+        select rk from ranked where ranked.username = p_username
+    )
+    select r.rk, r.username, u.nickname, u.current_title, r.minutes
+    from ranked r join me on r.rk between me.rk - p_radius and me.rk + p_radius
+    left join users u on u.username = r.username
+    order by r.rk;
+end;
+$$;
@@ -0,0 +1,16 @@
+-- カスタム壁紙をコンテンツハッシュで一度だけ保存する
+-- users には hash だけを持たせ、画像本体 (WebP / JPEG の解像度違い) は別テーブルに置く。
+
+create table if not exists wallpaper_blobs (
+    hash text not null,
+    variant text not null,
+    mime text not null,
+    width integer not null,
+    height integer not null,
+    bytes integer not null,
+    data text not null,
+    created_at timestamptz not null default now(),
+    primary key (hash, variant)
+);
+
+alter table users add column if not exists custom_bg_hash text;
@@ -0,0 +1,9 @@
+-- 進行中の集中モード (タイマー) の開始時刻をサーバー側に保持する
+-- 再接続・リロード後もタイマーを継続できるようにする。
+
+create table if not exists study_sessions (
+    username text primary key,
+    subject text not null,
+    start_time double precision not null,
+    heartbeat_at timestamptz not null default now()
+);
@@ -0,0 +1,116 @@
+-- users 行の変更を検知するための version / updated_at
+-- クライアントはプロフィールをセッションにキャッシュし、version が変わったときだけ取り直す。
+-- 書き込み系RPCは更新後の version を返す。
+
+alter table users add column if not exists version bigint not null default 0;
+alter table users add column if not exists updated_at timestamptz not null default now();
+
+create or replace function bump_user_version() returns trigger
+language plpgsql
+as $$
+begin
+    new.version := old.version + 1;
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists users_version on users;
+create trigger users_version
+before update on users
+for each row execute function bump_user_version();
+
+create or replace function commit_study_log(
+    p_username text,
+    p_subject text,
+    p_minutes integer,
+    p_study_date date,
+    p_today date
+) returns json
+language plpgsql
+as $$
+declare
+    v_total_today integer;
+    v_user users%rowtype;
+    v_goal_reached boolean := false;
+begin
+    insert into study_logs (username, subject, duration_minutes, study_date)
+    values (p_username, p_subject, p_minutes, p_study_date);
+
+    -- 行ロックを取ってから今日の合計を計算する
+    select * into v_user from users where username = p_username for update;
+    if not found then
+        return json_build_object('minutes', p_minutes, 'xp', 0, 'coins', 0, 'goal_reached', false);
+    end if;
+
+    select coalesce(sum(duration_minutes), 0) into v_total_today
+    from study_logs where username = p_username and study_date = p_today;
+
+    if v_user.last_goal_reward_date is distinct from p_today
+       and v_total_today >= coalesce(v_user.daily_goal, 60) then
+        v_goal_reached := true;
+    end if;
+
+    update users set
+        xp = xp + p_minutes,
+        coins = coins + p_minutes + case when v_goal_reached then 100 else 0 end,
+        last_goal_reward_date = case when v_goal_reached then p_today else last_goal_reward_date end
+    where username = p_username
+    returning * into v_user;
+
+    return json_build_object(
+        'minutes', p_minutes, 'xp', v_user.xp, 'coins', v_user.coins, 'goal_reached', v_goal_reached,
+        'version', v_user.version
+    );
+end;
+$$;
+
+create or replace function revert_study_log(
+    p_log_id bigint,
+    p_username text
+) returns json
+language plpgsql
+as $$
+declare
+    v_minutes integer;
+    v_user users%rowtype;
+begin
+    delete from study_logs where id = p_log_id and username = p_username
+    returning duration_minutes into v_minutes;
+    if v_minutes is null then
+        return json_build_object('minutes', 0, 'xp', null, 'coins', null);
+    end if;
+
+    update users set
+        xp = greatest(0, xp - v_minutes),
+        coins = greatest(0, coins - v_minutes)
+    where username = p_username
+    returning * into v_user;
+
+    return json_build_object('minutes', v_minutes, 'xp', v_user.xp, 'coins', v_user.coins, 'version', v_user.version);
+end;
+$$;
+
+create or replace function commit_task_complete(
+    p_task_id bigint,
+    p_username text
+) returns json
+language plpgsql
+as $$
+declare
+    v_user users%rowtype;
+begin
+    -- 未完了のタスクだけを完了にする（二重クリックで二重報酬にならない）
+    update tasks set status = '完了'
+    where id = p_task_id and username = p_username and status = '未完了';
+    if not found then
+        return json_build_object('completed', false, 'xp', null, 'coins', null);
+    end if;
+
+    update users set xp = xp + 10, coins = coins + 10
+    where username = p_username
+    returning * into v_user;
+
+    return json_build_object('completed', true, 'xp', v_user.xp, 'coins', v_user.coins, 'version', v_user.version);
+end;
+$$;
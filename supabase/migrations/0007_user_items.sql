@@ -0,0 +1,120 @@
+-- 持ち物 (フォント・壁紙・称号・パス) を users のカンマ区切り文字列から user_items の行へ移す
+-- 購入は「未所持」かつ「coins >= 価格」のときだけ coins を引いて行を足す1回のRPCで行う。
+-- 価格はクライアントから受け取らず shop_items を正とする。
+-- 旧列 (unlocked_themes / unlocked_wallpapers / unlocked_titles / custom_*_unlocked) は
+-- 切り戻し用に残すが、以後アプリからは読み書きしない。
+
+create table if not exists shop_items (
+    category text not null,
+    item text not null,
+    price integer not null,
+    primary key (category, item)
+);
+
+insert into shop_items (category, item, price) values
+    ('font', 'ピクセル風', 500), ('font', '手書き風', 800), ('font', 'ポップ', 1000),
+    ('font', '明朝体', 1200), ('font', '筆文字', 1500),
+    ('wallpaper', '夕焼け', 500), ('wallpaper', '夜空', 800), ('wallpaper', 'ダンジョン', 1200), ('wallpaper', '王宮', 2000),
+    ('pass', 'custom_title', 9999), ('pass', 'custom_wallpaper', 9999),
+    ('gacha', 'title', 100)
+on conflict (category, item) do update set price = excluded.price;
+
+create table if not exists gacha_pool (
+    item text primary key
+);
+
+insert into gacha_pool (item) values
+    ('駆け出し'), ('努力家'), ('集中王'), ('夜更かし'), ('天才'), ('覚醒者'), ('大賢者'), ('神童')
+on conflict do nothing;
+
+create table if not exists user_items (
+    username text not null,
+    category text not null,
+    item text not null,
+    acquired_at timestamptz not null default now(),
+    primary key (username, category, item)
+);
+
+-- 既存の文字列から移す (何度流しても同じ結果になる)
+insert into user_items (username, category, item)
+select username, 'font', trim(x) from users, unnest(string_to_array(coalesce(unlocked_themes, ''), ',')) x where trim(x) <> ''
+union all
+select username, 'wallpaper', trim(x) from users, unnest(string_to_array(coalesce(unlocked_wallpapers, ''), ',')) x where trim(x) <> ''
+union all
+select username, 'title', trim(x) from users, unnest(string_to_array(coalesce(unlocked_titles, ''), ',')) x where trim(x) <> ''
+union all
+select username, 'pass', 'custom_title' from users where custom_title_unlocked
+union all
+select username, 'pass', 'custom_wallpaper' from users where custom_wallpaper_unlocked
+on conflict do nothing;
+
+create or replace function purchase_item(
+    p_username text,
+    p_category text,
+    p_item text
+) returns json
+language plpgsql
+as $$
+declare
+    v_price integer;
+    v_user users%rowtype;
+begin
+    select price into v_price from shop_items
+    where category = p_category and item = p_item and category <> 'gacha';
+    if v_price is null then
+        return json_build_object('status', 'unknown');
+    end if;
+
+    -- 先に行を足す。同じ品を同時に買うと片方は主キーで待たされ、所持済みとして返る
+    insert into user_items (username, category, item) values (p_username, p_category, p_item)
+    on conflict do nothing;
+    if not found then
+        select * into v_user from users where username = p_username;
+        return json_build_object('status', 'owned', 'coins', v_user.coins, 'version', v_user.version);
+    end if;
+
+    update users set coins = coins - v_price
+    where username = p_username and coins >= v_price
+    returning * into v_user;
+    if not found then
+        delete from user_items where username = p_username and category = p_category and item = p_item;
+        select * into v_user from users where username = p_username;
+        return json_build_object('status', 'insufficient', 'coins', v_user.coins, 'version', v_user.version);
+    end if;
+
+    return json_build_object('status', 'ok', 'coins', v_user.coins, 'version', v_user.version);
+end;
+$$;
+
+-- 称号ガチャ: 引いた称号は所持済みでも coins を引き、装備する
+create or replace function draw_title(
+    p_username text,
+    p_title text
+) returns json
+language plpgsql
+as $$
+declare
+    v_price integer;
+    v_user users%rowtype;
+    v_new boolean;
+begin
+    select price into v_price from shop_items where category = 'gacha' and item = 'title';
+    if v_price is null or not exists (select 1 from gacha_pool where item = p_title) then
+        return json_build_object('status', 'unknown');
+    end if;
+
+    update users set coins = coins - v_price, current_title = p_title
+    where username = p_username and coins >= v_price
+    returning * into v_user;
+    if not found then
+        select * into v_user from users where username = p_username;
+        return json_build_object('status', 'insufficient', 'coins', v_user.coins, 'version', v_user.version);
+    end if;
+
+    insert into user_items (username, category, item) values (p_username, 'title', p_title)
+    on conflict do nothing;
+    v_new := found;
+
+    return json_build_object('status', 'ok', 'coins', v_user.coins, 'version', v_user.version, 'new', v_new);
+end;
+$$;
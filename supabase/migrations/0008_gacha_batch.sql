@@ -0,0 +1,54 @@
+-- 称号ガチャの一括引き (10連など) とレア度つきの排出テーブル
+-- 抽選はクライアントがシードつきの乱数で一度に行い、結果をまとめて1回のRPCで書く。
+-- coins の減算・新しい称号の追加・装備の変更は同一トランザクションで行う。
+
+alter table gacha_pool add column if not exists rarity text not null default 'N';
+alter table gacha_pool add column if not exists weight integer not null default 1;
+
+insert into gacha_pool (item, rarity, weight) values
+    ('駆け出し', 'N', 20), ('努力家', 'N', 20), ('夜更かし', 'N', 20),
+    ('集中王', 'R', 15), ('天才', 'R', 15),
+    ('覚醒者', 'SR', 4), ('大賢者', 'SR', 4),
+    ('神童', 'SSR', 2)
+on conflict (item) do update set rarity = excluded.rarity, weight = excluded.weight;
+
+drop function if exists draw_title(text, text);
+
+create or replace function draw_titles(
+    p_username text,
+    p_titles text[],
+    p_equip text
+) returns json
+language plpgsql
+as $$
+declare
+    v_price integer;
+    v_n integer := coalesce(array_length(p_titles, 1), 0);
+    v_user users%rowtype;
+    v_new text[];
+begin
+    select price into v_price from shop_items where category = 'gacha' and item = 'title';
+    if v_price is null or v_n = 0 or v_n > 100 or not (p_equip = any(p_titles))
+       or exists (select 1 from unnest(p_titles) t where t not in (select item from gacha_pool)) then
+        return json_build_object('status', 'unknown');
+    end if;
+
+    update users set coins = coins - v_price * v_n, current_title = p_equip
+    where username = p_username and coins >= v_price * v_n
+    returning * into v_user;
+    if not found then
+        select * into v_user from users where username = p_username;
+        return json_build_object('status', 'insufficient', 'coins', v_user.coins, 'version', v_user.version);
+    end if;
+
+    with ins as (
+        insert into user_items (username, category, item)
+        select distinct p_username, 'title', t from unnest(p_titles) t
+        on conflict do nothing
+        returning item
+    )
+    select coalesce(array_agg(item), '{}') into v_new from ins;
+
+    return json_build_object('status', 'ok', 'coins', v_user.coins, 'version', v_user.version, 'new', v_new);
+end;
+$$;
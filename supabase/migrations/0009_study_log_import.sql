@@ -0,0 +1,123 @@
+-- 勉強ログの一括インポート
+-- クライアントは検証済みの行を study_log_imports にまとめて入れ、最後に commit_study_log_import を1回呼ぶ。
+-- 取り込みの間は行ごとのトリガー (日別集計・週間ランキング) を止め、取り込み後に1回だけ作り直す。
+-- xp / coins も取り込んだ分数の合計で1回だけ加算する。
+
+create table if not exists study_log_imports (
+    import_id text not null,
+    username text not null,
+    subject text,
+    duration_minutes integer not null check (duration_minutes > 0),
+    study_date date not null,
+    created_at timestamptz not null default now()
+);
+create index if not exists study_log_imports_id_idx on study_log_imports (import_id, username);
+
+create or replace function bulk_import_active() returns boolean
+language sql stable
+as $$ select coalesce(current_setting('study_app.bulk_import', true), '') = 'on' $$;
+
+create or replace function bump_study_rollup() returns trigger
+language plpgsql
+as $$
+begin
+    if bulk_import_active() then
+        return null;
+    end if;
+    if tg_op = 'INSERT' then
+        insert into study_daily_rollup (username, day, subject, minutes, sessions)
+        values (new.username, new.study_date, coalesce(new.subject, ''), new.duration_minutes, 1)
+        on conflict (username, day, subject) do update set
+            minutes = study_daily_rollup.minutes + excluded.minutes,
+            sessions = study_daily_rollup.sessions + 1;
+        return new;
+    else
+        update study_daily_rollup set
+            minutes = minutes - old.duration_minutes,
+            sessions = sessions - 1
+        where username = old.username and day = old.study_date and subject = coalesce(old.subject, '');
+        delete from study_daily_rollup
+        where username = old.username and day = old.study_date and subject = coalesce(old.subject, '')
+          and sessions <= 0;
+        return old;
+    end if;
+end;
+$$;
+
+create or replace function bump_weekly_leaderboard() returns trigger
+language plpgsql
+as $$
+declare
+    v_start date;
+begin
+    if bulk_import_active() then
+        return null;
+    end if;
+    select window_start into v_start from weekly_leaderboard_meta where id = 1;
+    if v_start is null then
+        return null;
+    end if;
+    if tg_op = 'INSERT' and new.study_date >= v_start then
+        insert into weekly_leaderboard (username, minutes) values (new.username, new.duration_minutes)
+        on conflict (username) do update set minutes = weekly_leaderboard.minutes + excluded.minutes;
+    elsif tg_op = 'DELETE' and old.study_date >= v_start then
+        update weekly_leaderboard set minutes = greatest(0, minutes - old.duration_minutes)
+        where username = old.username;
+        delete from weekly_leaderboard where username = old.username and minutes <= 0;
+    end if;
+    return null;
+end;
+$$;
+
+create or replace function commit_study_log_import(
+    p_import_id text,
+    p_username text
+) returns json
+language plpgsql
+as $$
+declare
+    v_rows integer;
+    v_minutes integer;
+    v_start date;
+    v_user users%rowtype;
+begin
+    perform set_config('study_app.bulk_import', 'on', true);
+
+    with moved as (
+        delete from study_log_imports
+        where import_id = p_import_id and username = p_username
+        returning username, subject, duration_minutes, study_date
+    ), ins as (
+        insert into study_logs (username, subject, duration_minutes, study_date)
+        select username, subject, duration_minutes, study_date from moved
+        returning duration_minutes
+    )
+    select count(*), coalesce(sum(duration_minutes), 0) into v_rows, v_minutes from ins;
+
+    -- 途中で止まった取り込みの残りを片付ける
+    delete from study_log_imports where created_at < now() - interval '1 day';
+    perform set_config('study_app.bulk_import', 'off', true);
+
+    if v_rows = 0 then
+        return json_build_object('rows', 0, 'minutes', 0, 'xp', null, 'coins', null);
+    end if;
+
+    perform rebuild_study_rollup(p_username);
+    select window_start into v_start from weekly_leaderboard_meta where id = 1;
+    if v_start is not null then
+        delete from weekly_leaderboard where username = p_username;
+        insert into weekly_leaderboard (username, minutes)
+        select p_username, sum(minutes) from study_daily_rollup
+        where username = p_username and day >= v_start
+        having sum(minutes) > 0;
+    end if;
+
+    update users set xp = xp + v_minutes, coins = coins + v_minutes
+    where username = p_username
+    returning * into v_user;
+
+    return json_build_object(
+        'rows', v_rows, 'minutes', v_minutes, 'xp', v_user.xp, 'coins', v_user.coins, 'version', v_user.version
+    );
+end;
+$$;
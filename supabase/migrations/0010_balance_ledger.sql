@@ -0,0 +1,404 @@
+-- xp / coins を追記だけの台帳 (balance_ledger) で持つ
+-- 増減はすべて (理由, 増減, 参照ID) の1行として足し、users 行は書き換えない。
+-- 残高は balance_snapshots の値 + それ以降 (created_at >= until) の行の合計。
+-- 末尾が長くなったら、5分以上前の行をスナップショットへ畳む (書き込み中の行を取りこぼさないため)。
+-- 付与は行を足すだけ。コインを使うときだけ残高を確かめるためにユーザー単位の advisory lock を取る。
+-- users.xp / users.coins は開始残高として台帳へ移し、以後アプリからは読み書きしない。
+
+create table if not exists balance_ledger (
+    id bigserial primary key,
+    username text not null,
+    reason text not null,
+    ref text,
+    xp_delta integer not null default 0,
+    coin_delta integer not null default 0,
+    created_at timestamptz not null default clock_timestamp()
+);
+create index if not exists balance_ledger_user_time on balance_ledger (username, created_at);
+create index if not exists balance_ledger_user_ref on balance_ledger (username, reason, ref);
+-- 1日1回の報酬は同じ (理由, 日付) を2回足せない
+create unique index if not exists balance_ledger_once on balance_ledger (username, reason, ref)
+where reason in ('goal', 'login');
+
+create table if not exists balance_snapshots (
+    username text primary key,
+    until timestamptz not null,
+    xp bigint not null,
+    coins bigint not null,
+    entries integer not null
+);
+
+-- 開始残高と、移行前に受け取り済みの報酬 (何度流しても同じ結果になる)
+insert into balance_ledger (username, reason, xp_delta, coin_delta)
+select username, 'opening', xp, coins from users
+where not exists (select 1 from balance_ledger l where l.username = users.username and l.reason = 'opening');
+
+insert into balance_ledger (username, reason, ref)
+select username, 'goal', last_goal_reward_date::text from users where last_goal_reward_date is not null
+on conflict do nothing;
+insert into balance_ledger (username, reason, ref)
+select username, 'login', last_login_date::text from users where last_login_date is not null
+on conflict do nothing;
+
+create or replace function user_balance(p_username text) returns json
+language sql stable
+as $$
+    select json_build_object(
+        'xp', coalesce(s.xp, 0) + coalesce(t.xp, 0),
+        'coins', coalesce(s.coins, 0) + coalesce(t.coins, 0)
+    )
+    from (select 1) one
+    left join balance_snapshots s on s.username = p_username
+    left join lateral (
+        select sum(xp_delta) as xp, sum(coin_delta) as coins from balance_ledger l
+        where l.username = p_username and l.created_at >= coalesce(s.until, '-infinity')
+    ) t on true
+$$;
+
+create or replace function snapshot_balance(p_username text) returns void
+language plpgsql
+as $$
+declare
+    v_cutoff timestamptz := now() - interval '5 minutes';
+    v_from timestamptz;
+begin
+    -- 他が畳んでいる最中なら今回は見送る
+    if not pg_try_advisory_xact_lock(hashtext('balance:' || p_username)) then
+        return;
+    end if;
+    select until into v_from from balance_snapshots where username = p_username;
+    v_from := coalesce(v_from, '-infinity');
+    if v_from >= v_cutoff then
+        return;
+    end if;
+    insert into balance_snapshots (username, until, xp, coins, entries)
+    select p_username, v_cutoff, coalesce(sum(xp_delta), 0), coalesce(sum(coin_delta), 0), count(*)
+    from balance_ledger
+    where username = p_username and created_at >= v_from and created_at < v_cutoff
+    on conflict (username) do update set
+        until = excluded.until,
+        xp = balance_snapshots.xp + excluded.xp,
+        coins = balance_snapshots.coins + excluded.coins,
+        entries = balance_snapshots.entries + excluded.entries;
+end;
+$$;
+
+create or replace function post_ledger(
+    p_username text,
+    p_reason text,
+    p_ref text,
+    p_xp integer,
+    p_coins integer
+) returns json
+language plpgsql
+as $$
+declare
+    v_tail integer;
+begin
+    insert into balance_ledger (username, reason, ref, xp_delta, coin_delta)
+    values (p_username, p_reason, p_ref, p_xp, p_coins);
+
+    select count(*) into v_tail from balance_ledger l
+    where l.username = p_username
+      and l.created_at >= coalesce((select until from balance_snapshots where username = p_username), '-infinity');
+    if v_tail > 64 then
+        perform snapshot_balance(p_username);
+    end if;
+    return user_balance(p_username);
+end;
+$$;
+
+-- 残高が足りるときだけコインを引く。足りなければ null
+create or replace function spend_coins(
+    p_username text,
+    p_reason text,
+    p_ref text,
+    p_coins integer
+) returns json
+language plpgsql
+as $$
+begin
+    perform pg_advisory_xact_lock(hashtext('balance:' || p_username));
+    if (user_balance(p_username)->>'coins')::bigint < p_coins then
+        return null;
+    end if;
+    return post_ledger(p_username, p_reason, p_ref, 0, -p_coins);
+end;
+$$;
+
+-- 監査や報酬の規則を変えた後に、全員のスナップショットを台帳からまとめて作り直す
+create or replace function rebuild_balance_snapshots() returns integer
+language plpgsql
+as $$
+declare
+    v_cutoff timestamptz := now() - interval '5 minutes';
+    v_n integer;
+begin
+    lock table balance_snapshots in exclusive mode;
+    delete from balance_snapshots;
+    insert into balance_snapshots (username, until, xp, coins, entries)
+    select username, v_cutoff, sum(xp_delta), sum(coin_delta), count(*)
+    from balance_ledger where created_at < v_cutoff
+    group by username;
+    get diagnostics v_n = row_count;
+    return v_n;
+end;
+$$;
+
+create or replace function commit_study_log(
+    p_username text,
+    p_subject text,
+    p_minutes integer,
+    p_study_date date,
+    p_today date
+) returns json
+language plpgsql
+as $$
+declare
+    v_log_id bigint;
+    v_total_today integer;
+    v_user users%rowtype;
+    v_goal_reached boolean := false;
+    v_balance json;
+begin
+    insert into study_logs (username, subject, duration_minutes, study_date)
+    values (p_username, p_subject, p_minutes, p_study_date)
+    returning id into v_log_id;
+
+    select * into v_user from users where username = p_username;
+    if not found then
+        return json_build_object('minutes', p_minutes, 'xp', 0, 'coins', 0, 'goal_reached', false);
+    end if;
+
+    select coalesce(sum(duration_minutes), 0) into v_total_today
+    from study_logs where username = p_username and study_date = p_today;
+
+    -- 同じ日の2回目は balance_ledger_once で弾かれる
+    if v_total_today >= coalesce(v_user.daily_goal, 60) then
+        insert into balance_ledger (username, reason, ref, coin_delta)
+        values (p_username, 'goal', p_today::text, 100)
+        on conflict do nothing;
+        v_goal_reached := found;
+    end if;
+    if v_goal_reached then
+        update users set last_goal_reward_date = p_today where username = p_username
+        returning * into v_user;
+    end if;
+
+    v_balance := post_ledger(p_username, 'study', v_log_id::text, p_minutes, p_minutes);
+    return json_build_object(
+        'minutes', p_minutes, 'xp', v_balance->'xp', 'coins', v_balance->'coins', 'goal_reached', v_goal_reached,
+        'version', v_user.version
+    );
+end;
+$$;
+
+-- 記録したときに付けた分をそのまま戻す (台帳に無い移行前のログは分数ぶん)
+create or replace function revert_study_log(
+    p_log_id bigint,
+    p_username text
+) returns json
+language plpgsql
+as $$
+declare
+    v_minutes integer;
+    v_xp integer;
+    v_coins integer;
+    v_balance json;
+begin
+    delete from study_logs where id = p_log_id and username = p_username
+    returning duration_minutes into v_minutes;
+    if v_minutes is null then
+        return json_build_object('minutes', 0, 'xp', null, 'coins', null);
+    end if;
+
+    select coalesce(sum(xp_delta), v_minutes), coalesce(sum(coin_delta), v_minutes) into v_xp, v_coins
+    from balance_ledger where username = p_username and reason = 'study' and ref = p_log_id::text;
+
+    v_balance := post_ledger(p_username, 'study_revert', p_log_id::text, -v_xp, -v_coins);
+    return json_build_object(
+        'minutes', v_minutes, 'xp', v_balance->'xp', 'coins', v_balance->'coins',
+        'version', (select version from users where username = p_username)
+    );
+end;
+$$;
+
+create or replace function commit_task_complete(
+    p_task_id bigint,
+    p_username text
+) returns json
+language plpgsql
+as $$
+declare
+    v_balance json;
+begin
+    -- 未完了のタスクだけを完了にする（二重クリックで二重報酬にならない）
+    update tasks set status = '完了'
+    where id = p_task_id and username = p_username and status = '未完了';
+    if not found then
+        return json_build_object('completed', false, 'xp', null, 'coins', null);
+    end if;
+
+    v_balance := post_ledger(p_username, 'task', p_task_id::text, 10, 10);
+    return json_build_object(
+        'completed', true, 'xp', v_balance->'xp', 'coins', v_balance->'coins',
+        'version', (select version from users where username = p_username)
+    );
+end;
+$$;
+
+create or replace function grant_login_bonus(
+    p_username text,
+    p_today date
+) returns json
+language plpgsql
+as $$
+declare
+    v_granted boolean;
+    v_user users%rowtype;
+begin
+    insert into balance_ledger (username, reason, ref, coin_delta)
+    values (p_username, 'login', p_today::text, 50)
+    on conflict do nothing;
+    v_granted := found;
+
+    update users set last_login_date = p_today
+    where username = p_username and last_login_date is distinct from p_today
+    returning * into v_user;
+    if not found then
+        select * into v_user from users where username = p_username;
+    end if;
+
+    return json_build_object(
+        'granted', v_granted, 'coins', user_balance(p_username)->'coins', 'version', v_user.version
+    );
+end;
+$$;
+
+create or replace function purchase_item(
+    p_username text,
+    p_category text,
+    p_item text
+) returns json
+language plpgsql
+as $$
+declare
+    v_price integer;
+    v_balance json;
+    v_version bigint;
+begin
+    select price into v_price from shop_items
+    where category = p_category and item = p_item and category <> 'gacha';
+    if v_price is null then
+        return json_build_object('status', 'unknown');
+    end if;
+    select version into v_version from users where username = p_username;
+
+    -- 先に行を足す。同じ品を同時に買うと片方は主キーで待たされ、所持済みとして返る
+    insert into user_items (username, category, item) values (p_username, p_category, p_item)
+    on conflict do nothing;
+    if not found then
+        return json_build_object('status', 'owned', 'coins', user_balance(p_username)->'coins', 'version', v_version);
+    end if;
+
+    v_balance := spend_coins(p_username, 'purchase', p_category || ':' || p_item, v_price);
+    if v_balance is null then
+        delete from user_items where username = p_username and category = p_category and item = p_item;
+        return json_build_object('status', 'insufficient', 'coins', user_balance(p_username)->'coins', 'version', v_version);
+    end if;
+
+    return json_build_object('status', 'ok', 'coins', v_balance->'coins', 'version', v_version);
+end;
+$$;
+
+create or replace function draw_titles(
+    p_username text,
+    p_titles text[],
+    p_equip text
+) returns json
+language plpgsql
+as $$
+declare
+    v_price integer;
+    v_n integer := coalesce(array_length(p_titles, 1), 0);
+    v_balance json;
+    v_user users%rowtype;
+    v_new text[];
+begin
+    select price into v_price from shop_items where category = 'gacha' and item = 'title';
+    if v_price is null or v_n = 0 or v_n > 100 or not (p_equip = any(p_titles))
+       or exists (select 1 from unnest(p_titles) t where t not in (select item from gacha_pool)) then
+        return json_build_object('status', 'unknown');
+    end if;
+
+    v_balance := spend_coins(p_username, 'gacha', v_n::text, v_price * v_n);
+    if v_balance is null then
+        select * into v_user from users where username = p_username;
+        return json_build_object('status', 'insufficient', 'coins', user_balance(p_username)->'coins', 'version', v_user.version);
+    end if;
+
+    update users set current_title = p_equip where username = p_username
+    returning * into v_user;
+
+    with ins as (
+        insert into user_items (username, category, item)
+        select distinct p_username, 'title', t from unnest(p_titles) t
+        on conflict do nothing
+        returning item
+    )
+    select coalesce(array_agg(item), '{}') into v_new from ins;
+
+    return json_build_object('status', 'ok', 'coins', v_balance->'coins', 'version', v_user.version, 'new', v_new);
+end;
+$$;
+
+create or replace function commit_study_log_import(
+    p_import_id text,
+    p_username text
+) returns json
+language plpgsql
+as $$
+declare
+    v_rows integer;
+    v_minutes integer;
+    v_start date;
+    v_balance json;
+begin
+    perform set_config('study_app.bulk_import', 'on', true);
+
+    with moved as (
+        delete from study_log_imports
+        where import_id = p_import_id and username = p_username
+        returning username, subject, duration_minutes, study_date
+    ), ins as (
+        insert into study_logs (username, subject, duration_minutes, study_date)
+        select username, subject, duration_minutes, study_date from moved
+        returning duration_minutes
+    )
+    select count(*), coalesce(sum(duration_minutes), 0) into v_rows, v_minutes from ins;
+
+    -- 途中で止まった取り込みの残りを片付ける
+    delete from study_log_imports where created_at < now() - interval '1 day';
+    perform set_config('study_app.bulk_import', 'off', true);
+
+    if v_rows = 0 then
+        return json_build_object('rows', 0, 'minutes', 0, 'xp', null, 'coins', null);
+    end if;
+
+    perform rebuild_study_rollup(p_username);
+    select window_start into v_start from weekly_leaderboard_meta where id = 1;
+    if v_start is not null then
+        delete from weekly_leaderboard where username = p_username;
+        insert into weekly_leaderboard (username, minutes)
+        select p_username, sum(minutes) from study_daily_rollup
+        where username = p_username and day >= v_start
+        having sum(minutes) > 0;
+    end if;
+
+    v_balance := post_ledger(p_username, 'import', p_import_id, v_minutes, v_minutes);
+    return json_build_object(
+        'rows', v_rows, 'minutes', v_minutes, 'xp', v_balance->'xp', 'coins', v_balance->'coins',
+        'version', (select version from users where username = p_username)
+    );
+end;
+$$;
@@ -0,0 +1,199 @@
+-- 科目をユーザーごとの辞書 (subjects.id) にし、ログは subject_id で参照する
+-- ログに科目名を毎行持たないので、ログの取得量とアプリ側のメモリが減る。
+-- 一覧から消した科目も過去のログが参照するので行は消さず hidden にする。
+-- 一覧に無い科目 (タイマーの「その他」や取り込み) は hidden の行として辞書に足す。
+-- study_logs.subject は移行前の行のために残すが、以後は書かない。集計 (study_daily_rollup) は科目名のまま持つ。
+
+alter table subjects add column if not exists hidden boolean not null default false;
+
+-- 同じ名前の重複をまとめてから一意にする
+delete from subjects a using subjects b
+where a.username = b.username and a.subject_name = b.subject_name and a.id > b.id;
+create unique index if not exists subjects_user_name on subjects (username, subject_name);
+
+alter table study_logs add column if not exists subject_id bigint references subjects (id);
+
+insert into subjects (username, subject_name, hidden)
+select distinct username, subject, true from study_logs where coalesce(subject, '') <> ''
+on conflict (username, subject_name) do nothing;
+
+update study_logs l set subject_id = s.id
+from subjects s
+where l.subject_id is null and s.username = l.username and s.subject_name = l.subject;
+
+create index if not exists study_logs_subject on study_logs (subject_id);
+
+-- 科目名から辞書の id を引く (無ければ hidden で足す)。空なら null
+create or replace function subject_ref(p_username text, p_subject text) returns bigint
+language plpgsql
+as $$
+declare
+    v_id bigint;
+begin
+    if coalesce(p_subject, '') = '' then
+        return null;
+    end if;
+    insert into subjects (username, subject_name, hidden) values (p_username, p_subject, true)
+    on conflict (username, subject_name) do nothing
+    returning id into v_id;
+    if v_id is null then
+        select id into v_id from subjects where username = p_username and subject_name = p_subject;
+    end if;
+    return v_id;
+end;
+$$;
+
+create or replace function log_subject_name(p_subject_id bigint, p_subject text) returns text
+language sql stable
+as $$ select coalesce((select subject_name from subjects where id = p_subject_id), p_subject, '') $$;
+
+create or replace function bump_study_rollup() returns trigger
+language plpgsql
+as $$
+begin
+    if bulk_import_active() then
+        return null;
+    end if;
+    if tg_op = 'INSERT' then
+        insert into study_daily_rollup (username, day, subject, minutes, sessions)
+        values (new.username, new.study_date, log_subject_name(new.subject_id, new.subject), new.duration_minutes, 1)
+        on conflict (username, day, subject) do update set
+            minutes = study_daily_rollup.minutes + excluded.minutes,
+            sessions = study_daily_rollup.sessions + 1;
+        return new;
+    else
+        update study_daily_rollup set
+            minutes = minutes - old.duration_minutes,
+            sessions = sessions - 1
+        where username = old.username and day = old.study_date and subject = log_subject_name(old.subject_id, old.subject);
+        delete from study_daily_rollup
+        where username = old.username and day = old.study_date and subject = log_subject_name(old.subject_id, old.subject)
+          and sessions <= 0;
+        return old;
+    end if;
+end;
+$$;
+
+create or replace function rebuild_study_rollup(p_username text default null) returns integer
+language plpgsql
+as $$
+declare
+    v_rows integer;
+begin
+    delete from study_daily_rollup where p_username is null or username = p_username;
+    insert into study_daily_rollup (username, day, subject, minutes, sessions)
+    select l.username, l.study_date, coalesce(s.subject_name, l.subject, ''), sum(l.duration_minutes), count(*)
+    from study_logs l
+    left join subjects s on s.id = l.subject_id
+    where p_username is null or l.username = p_username
+    group by l.username, l.study_date, coalesce(s.subject_name, l.subject, '');
+    get diagnostics v_rows = row_count;
+    return v_rows;
+end;
+$$;
+
+create or replace function commit_study_log(
+    p_username text,
+    p_subject text,
+    p_minutes integer,
+    p_study_date date,
+    p_today date
+) returns json
+language plpgsql
+as $$
+declare
+    v_log_id bigint;
+    v_total_today integer;
+    v_user users%rowtype;
+    v_goal_reached boolean := false;
+    v_balance json;
+begin
+    insert into study_logs (username, subject_id, duration_minutes, study_date)
+    values (p_username, subject_ref(p_username, p_subject), p_minutes, p_study_date)
+    returning id into v_log_id;
+
+    select * into v_user from users where username = p_username;
+    if not found then
+        return json_build_object('minutes', p_minutes, 'xp', 0, 'coins', 0, 'goal_reached', false);
+    end if;
+
+    select coalesce(sum(duration_minutes), 0) into v_total_today
+    from study_logs where username = p_username and study_date = p_today;
+
+    -- 同じ日の2回目は balance_ledger_once で弾かれる
+    if v_total_today >= coalesce(v_user.daily_goal, 60) then
+        insert into balance_ledger (username, reason, ref, coin_delta)
+        values (p_username, 'goal', p_today::text, 100)
+        on conflict do nothing;
+        v_goal_reached := found;
+    end if;
+    if v_goal_reached then
+        update users set last_goal_reward_date = p_today where username = p_username
+        returning * into v_user;
+    end if;
+
+    v_balance := post_ledger(p_username, 'study', v_log_id::text, p_minutes, p_minutes);
+    return json_build_object(
+        'minutes', p_minutes, 'xp', v_balance->'xp', 'coins', v_balance->'coins', 'goal_reached', v_goal_reached,
+        'version', v_user.version
+    );
+end;
+$$;
+
+create or replace function commit_study_log_import(
+    p_import_id text,
+    p_username text
+) returns json
+language plpgsql
+as $$
+declare
+    v_rows integer;
+    v_minutes integer;
+    v_start date;
+    v_balance json;
+begin
+    perform set_config('study_app.bulk_import', 'on', true);
+
+    insert into subjects (username, subject_name, hidden)
+    select distinct p_username, subject, true from study_log_imports
+    where import_id = p_import_id and username = p_username and coalesce(subject, '') <> ''
+    on conflict (username, subject_name) do nothing;
+
+    with moved as (
+        delete from study_log_imports
+        where import_id = p_import_id and username = p_username
+        returning username, subject, duration_minutes, study_date
+    ), ins as (
+        insert into study_logs (username, subject_id, duration_minutes, study_date)
+        select m.username, s.id, m.duration_minutes, m.study_date
+        from moved m
+        left join subjects s on s.username = m.username and s.subject_name = m.subject
+        returning duration_minutes
+    )
+    select count(*), coalesce(sum(duration_minutes), 0) into v_rows, v_minutes from ins;
+
+    -- 途中で止まった取り込みの残りを片付ける
+    delete from study_log_imports where created_at < now() - interval '1 day';
+    perform set_config('study_app.bulk_import', 'off', true);
+
+    if v_rows = 0 then
+        return json_build_object('rows', 0, 'minutes', 0, 'xp', null, 'coins', null);
+    end if;
+
+    perform rebuild_study_rollup(p_username);
+    select window_start into v_start from weekly_leaderboard_meta where id = 1;
+    if v_start is not null then
+        delete from weekly_leaderboard where username = p_username;
+        insert into weekly_leaderboard (username, minutes)
+        select p_username, sum(minutes) from study_daily_rollup
+        where username = p_username and day >= v_start
+        having sum(minutes) > 0;
+    end if;
+
+    v_balance := post_ledger(p_username, 'import', p_import_id, v_minutes, v_minutes);
+    return json_build_object(
+        'rows', v_rows, 'minutes', v_minutes, 'xp', v_balance->'xp', 'coins', v_balance->'coins',
+        'version', (select version from users where username = p_username)
+    );
+end;
+$$;
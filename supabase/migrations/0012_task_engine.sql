@@ -0,0 +1,102 @@
+-- 繰り返しタスクとタスクの一括完了・削除
+-- 繰り返し (毎日・毎週) は task_rules に1行だけ持ち、アプリが表示中の期間の分だけ展開する。
+-- 回ごとの完了・削除は、その日の tasks 行 (rule_id つき) を作って記録する。
+-- 削除した回は status = '削除' の行として残し、再び展開されないようにする。
+-- commit_tasks は選んだタスクと繰り返しの回をまとめて1回で完了 / 削除し、報酬は台帳へ1行で足す。
+
+create table if not exists task_rules (
+    id bigserial primary key,
+    username text not null,
+    task_name text not null,
+    priority text,
+    freq text not null check (freq in ('daily', 'weekly')),
+    start_date date not null,
+    until_date date,
+    created_at timestamptz not null default now()
+);
+create index if not exists task_rules_user on task_rules (username, start_date);
+
+alter table tasks add column if not exists rule_id bigint references task_rules (id) on delete cascade;
+create unique index if not exists tasks_rule_day on tasks (rule_id, due_date) where rule_id is not null;
+
+create or replace function commit_tasks(
+    p_username text,
+    p_action text,
+    p_task_ids bigint[],
+    p_rule_ids bigint[],
+    p_days date[]
+) returns json
+language plpgsql
+as $$
+declare
+    v_rules bigint[];
+    v_days date[];
+    v_ids bigint[];
+    v_occ bigint[];
+    v_n integer;
+    v_balance json;
+begin
+    if p_action not in ('complete', 'delete') then
+        return json_build_object('completed', 0, 'deleted', 0, 'xp', null, 'coins', null);
+    end if;
+
+    -- 繰り返しの回のうち、本人のルールで実際にある日だけ
+    select coalesce(array_agg(r.id), '{}'), coalesce(array_agg(o.day), '{}') into v_rules, v_days
+    from unnest(coalesce(p_rule_ids, '{}'), coalesce(p_days, '{}')) as o(rule_id, day)
+    join task_rules r on r.id = o.rule_id and r.username = p_username
+    where o.day >= r.start_date and (r.until_date is null or o.day <= r.until_date)
+      and (r.freq = 'daily' or (o.day - r.start_date) % 7 = 0);
+
+    if p_action = 'complete' then
+        -- 未完了のものだけを完了にする（二重クリックで二重報酬にならない）
+        with done as (
+            update tasks set status = '完了'
+            where username = p_username and id = any(p_task_ids) and status = '未完了'
+            returning id
+        )
+        select coalesce(array_agg(id), '{}') into v_ids from done;
+
+        with ins as (
+            insert into tasks (username, task_name, status, due_date, priority, rule_id)
+            select p_username, r.task_name, '完了', o.day, r.priority, r.id
+            from unnest(v_rules, v_days) as o(rule_id, day)
+            join task_rules r on r.id = o.rule_id
+            on conflict do nothing
+            returning id
+        )
+        select coalesce(array_agg(id), '{}') into v_occ from ins;
+
+        v_ids := v_ids || v_occ;
+        v_n := coalesce(array_length(v_ids, 1), 0);
+        if v_n = 0 then
+            return json_build_object('completed', 0, 'deleted', 0, 'xp', null, 'coins', null);
+        end if;
+        v_balance := post_ledger(p_username, 'task', array_to_string(v_ids, ','), 10 * v_n, 10 * v_n);
+        return json_build_object(
+            'completed', v_n, 'deleted', 0, 'xp', v_balance->'xp', 'coins', v_balance->'coins',
+            'version', (select version from users where username = p_username)
+        );
+    end if;
+
+    -- 単発のタスクは消し、繰り返しの回は '削除' として残す
+    with gone as (
+        delete from tasks where username = p_username and id = any(p_task_ids) and rule_id is null
+        returning id
+    ), hidden as (
+        update tasks set status = '削除'
+        where username = p_username and id = any(p_task_ids) and rule_id is not null
+        returning id
+    )
+    select (select count(*) from gone) + (select count(*) from hidden) into v_n;
+
+    insert into tasks (username, task_name, status, due_date, priority, rule_id)
+    select p_username, r.task_name, '削除', o.day, r.priority, r.id
+    from unnest(v_rules, v_days) as o(rule_id, day)
+    join task_rules r on r.id = o.rule_id
+    on conflict (rule_id, due_date) where rule_id is not null do update set status = '削除';
+
+    return json_build_object(
+        'completed', 0, 'deleted', v_n + coalesce(array_length(v_rules, 1), 0), 'xp', null, 'coins', null
+    );
+end;
+$$;
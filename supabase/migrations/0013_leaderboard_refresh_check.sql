@@ -0,0 +1,29 @@
+-- 週間ランキングの作り直しが要るかを、ロックを取る前に確かめる
+-- weekly_top / weekly_rank_around は読み込みのたびに refresh_weekly_leaderboard を呼ぶ。
+-- 0003 では先に排他のアドバイザリロックを取っていたので、ランキングの読み込みがすべて1本ずつ順番に走っていた。
+-- 集計期間が同じなら (ほとんどの呼び出し) ロックを取らずに戻り、作り直すときだけロックしてからもう一度確かめる。
+
+create or replace function refresh_weekly_leaderboard() returns void
+language plpgsql
+as $$
+declare
+    v_start date := leaderboard_window_start();
+begin
+    if exists (select 1 from weekly_leaderboard_meta where window_start = v_start) then
+        return;
+    end if;
+    -- 同時に複数のセッションが作り直さないようにする
+    perform pg_advisory_xact_lock(hashtext('weekly_leaderboard'));
+    if exists (select 1 from weekly_leaderboard_meta where window_start = v_start) then
+        return;
+    end if;
+    delete from weekly_leaderboard where true;
+    insert into weekly_leaderboard (username, minutes)
+    select username, sum(minutes) from study_daily_rollup
+    where day >= v_start
+    group by username
+    having sum(minutes) > 0;
+    insert into weekly_leaderboard_meta (id, window_start) values (1, v_start)
+    on conflict (id) do update set window_start = excluded.window_start;
+end;
+$$;
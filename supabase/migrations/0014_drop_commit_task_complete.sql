@@ -0,0 +1,5 @@
+-- 1件ずつのタスク完了 commit_task_complete を消す
+-- 0012 以降、タスクの完了・削除は commit_tasks が1件でも複数件でも行い、アプリからは呼ばれない。
+-- 残しておくと報酬の規則を変えたときに直し漏れるので消す。
+
+drop function if exists commit_task_complete(bigint, text);
@@ -0,0 +1,12 @@
+-- 新規登録で旧列を書かなくてよいようにする
+-- 持ち物は user_items (0007)、xp / coins は balance_ledger (0010) が正で、users の旧列はもう読まない。
+-- アプリは新しいユーザーの行にこれらの列を入れないので、既定値を付け、必須でなくする。
+
+alter table users
+    alter column xp set default 0,
+    alter column coins set default 0,
+    alter column unlocked_themes drop not null,
+    alter column unlocked_titles drop not null,
+    alter column unlocked_wallpapers drop not null,
+    alter column custom_title_unlocked drop not null,
+    alter column custom_wallpaper_unlocked drop not null;
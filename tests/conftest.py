@@ -0,0 +1,32 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import local_db  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """ユーザー alice / bob だけがいるローカルDB"""
+    client = local_db.LocalClient(str(tmp_path / "app.db"))
+    client.table("users").insert([{"username": "alice", "password": "x", "nickname": "Alice"}, {"username": "bob", "password": "x", "nickname": "Bob"}]).execute()
+    return client
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """streamlit_app をベアモード (ランタイムなし) で読み込む。ログイン前の画面まで実行される"""
+    os.environ["STUDY_APP_DB"] = str(tmp_path_factory.mktemp("app") / "app.db")
+    return importlib.import_module("streamlit_app")
+
+
+def rpc(db, name, **params):
+    return db.rpc(name, {f"p_{k}": v for k, v in params.items()}).execute().data
+
+
+def balance(db, u="alice"):
+    return rpc(db, "user_balance", username=u)
@@ -0,0 +1,116 @@
+import time
+
+import httpx
+import pytest
+
+import backend
+
+
+class Flaky:
+    """down の間はすべての呼び出しが接続エラーになるクライアント"""
+
+    def __init__(self, inner):
+        self.inner, self.down, self.sent = inner, False, 0
+
+    def table(self, name): return FlakyCall(self, self.inner.table(name))
+    def rpc(self, name, params): return FlakyCall(self, self.inner.rpc(name, params))
+
+
+class FlakyCall:
+    def __init__(self, owner, inner):
+        self.owner, self.inner = owner, inner
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        return lambda *a, **kw: FlakyCall(self.owner, attr(*a, **kw))
+
+    def execute(self):
+        self.owner.sent += 1
+        if self.owner.down: raise httpx.ConnectError("down")
+        return self.inner.execute()
+
+
+@pytest.fixture
+def flaky(db):
+    return Flaky(db)
+
+
+@pytest.fixture
+def client(flaky):
+    return backend.ManagedClient(flaky, retry={"attempts": 1}, breaker={"failures": 2, "cooldown": 0.05})
+
+
+def test_breaker_states():
+    b = backend.Breaker(failures=2, cooldown=0.05, stats=backend.Stats())
+    assert b.state() == "closed" and b.allow()
+    b.failure()
+    assert b.state() == "closed"
+    b.failure()
+    assert b.state() == "open" and not b.allow()
+    time.sleep(0.06)
+    assert b.state() == "half_open"
+    # 半開では1本だけ通す
+    assert b.allow() and not b.allow()
+    b.failure()
+    assert b.state() == "open"
+    time.sleep(0.06)
+    assert b.allow()
+    b.success()
+    assert b.state() == "closed" and b.allow()
+    assert b.stats.snapshot()["breaker_opened"] == 2
+
+
+def test_open_breaker_serves_stale_reads_and_rejects_writes(client, flaky):
+    read = lambda: client.table("users").select("username").eq("username", "alice").execute()
+    assert read().data == [{"username": "alice"}]
+    flaky.down = True
+    for _ in range(2):
+        assert read().stale
+    assert client.breaker.state() == "open"
+    sent = flaky.sent
+    # 開いている間はバックエンドへ送らない
+    assert read().data == [{"username": "alice"}]
+    with pytest.raises(backend.BackendUnavailable):
+        client.table("users").update({"nickname": "A"}).eq("username", "alice").execute()
+    with pytest.raises(backend.BackendUnavailable):
+        client.table("users").select("username").eq("username", "bob").execute()
+    assert flaky.sent == sent
+    flaky.down = False
+    time.sleep(0.06)
+    assert not getattr(read(), "stale", False)
+    assert client.breaker.state() == "closed"
+
+
+def test_writes_are_not_retried(flaky):
+    client = backend.ManagedClient(flaky, retry={"attempts": 3, "base": 0, "cap": 0}, breaker={"failures": 10})
+    flaky.down = True
+    with pytest.raises(httpx.ConnectError):
+        client.rpc("commit_study_log", {"p_username": "alice"}).execute()
+    assert flaky.sent == 1
+    with pytest.raises(httpx.ConnectError):
+        client.rpc("user_balance", {"p_username": "alice"}).execute()
+    assert flaky.sent == 4
+
+
+def test_secrets_and_blobs_are_not_kept(client, flaky):
+    client.table("users").select("*").eq("username", "alice").execute()
+    client.table("wallpaper_blobs").select("*").execute()
+    flaky.down = True
+    for q in (client.table("users").select("*").eq("username", "alice"), client.table("wallpaper_blobs").select("*")):
+        with pytest.raises(httpx.ConnectError):
+            q.execute()
+
+
+def test_read_cache_is_bounded():
+    cache = backend.ReadCache(max_bytes=25, max_entry=12)
+    cache.put("a", "x" * 8)  # JSON で10バイト
+    cache.put("b", "y" * 8)
+    assert cache.get("a") is not None  # a を新しくする
+    cache.put("c", "z" * 8)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("x" * 8, None, "z" * 8)
+    assert cache.bytes == 20
+    cache.put("big", "w" * 20)
+    assert cache.get("big") is None
+    # 大きくなった結果は古い値も捨てる
+    cache.put("a", "x" * 20)
+    assert cache.get("a") is None and cache.bytes == 10
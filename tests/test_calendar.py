@@ -0,0 +1,57 @@
+import uuid
+from datetime import date
+
+import tracing
+
+
+def new_user(app):
+    name = f"cal{uuid.uuid4().hex[:8]}"
+    assert app.add_user(name, "pw", name)[0]
+    return name
+
+
+def log(app, u, day, minutes):
+    app.call_rpc("commit_study_log", {"p_username": u, "p_subject": "数学", "p_minutes": minutes, "p_study_date": day, "p_today": day})
+
+
+def calls(fn, *args):
+    """fn が読んだテーブル・RPC の一覧と結果"""
+    trace = tracing.begin_trace()
+    result = fn(*args)
+    return [c["table"] for c in trace.calls], result
+
+
+def test_month_grid_range(app):
+    # 日曜始まりの6週間 (2026-01-01 は木曜)
+    assert app.month_grid_range("2026-01") == (date(2025, 12, 28), date(2026, 2, 8))
+    assert app.month_grid_range("2026-02") == (date(2026, 2, 1), date(2026, 3, 15))
+    assert (app.shift_month("2026-01", -1), app.shift_month("2026-12", 1)) == ("2025-12", "2027-01")
+
+
+def test_month_feed_reads_only_the_grid_and_is_cached(app):
+    u = new_user(app)
+    app.invalidate_views()
+    for day, minutes in [("2025-12-28", 10), ("2026-01-15", 20), ("2026-01-15", 5), ("2026-02-08", 40)]:
+        log(app, u, day, minutes)
+    app.add_task(u, "宿題", "2026-01-20", "高")
+    app.add_task(u, "先の宿題", "2026-03-01", "高")
+    read, feed = calls(app.get_calendar_month, u, "2026-01")
+    assert sorted(read) == ["study_daily_rollup", "task_rules", "tasks"]
+    assert feed["range"] == ("2025-12-28", "2026-02-08")
+    # 1日1件にまとめ、範囲外 (2026-02-08 以降) は含めない
+    assert sorted((e["start"], e["title"]) for e in feed["events"]) == [("2025-12-28", "📖 10分"), ("2026-01-15", "📖 25分"), ("2026-01-20", "📝 宿題")]
+    assert list(feed["tasks"]["task_name"]) == ["宿題"]
+    # 2回目はキャッシュから (読み込みなし)
+    assert calls(app.get_calendar_month, u, "2026-01") == ([], feed)
+    assert calls(app.day_minutes, u, feed, "2026-01-15") == ([], 25)
+    # 範囲外の日だけその日の集計を読む
+    assert calls(app.day_minutes, u, feed, "2026-02-08") == (["study_daily_rollup"], 40)
+
+
+def test_write_drops_cached_month(app):
+    u = new_user(app)
+    app.invalidate_views()
+    app.get_calendar_month(u, "2026-01")
+    app.add_task(u, "追加", "2026-01-10", "中")
+    read, feed = calls(app.get_calendar_month, u, "2026-01")
+    assert read and list(feed["tasks"]["task_name"]) == ["追加"]
@@ -0,0 +1,14 @@
+def test_missing_font_falls_back_to_system_fonts(app, monkeypatch):
+    monkeypatch.delenv("STUDY_APP_REMOTE_FONTS", raising=False)
+    monkeypatch.setattr(app, "FONT_DIR", "/nonexistent")
+    assert app.font_css("明朝体") == ("", "'Shippori Mincho', serif")
+    assert app.font_css("標準") == ("", "sans-serif")
+
+
+def test_remote_fonts_are_opt_in(app, monkeypatch):
+    monkeypatch.setattr(app, "FONT_DIR", "/nonexistent")
+    monkeypatch.setenv("STUDY_APP_REMOTE_FONTS", "1")
+    face, family = app.font_css("明朝体")
+    assert face.startswith("@import url('https://fonts.googleapis.com/css2?family=Shippori+Mincho")
+    monkeypatch.setenv("STUDY_APP_REMOTE_FONTS", "0")
+    assert app.font_css("明朝体")[0] == ""
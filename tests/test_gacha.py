@@ -0,0 +1,32 @@
+from conftest import balance, rpc
+
+
+def test_draw_titles(db):
+    db.table("balance_ledger").insert({"username": "alice", "reason": "opening", "coin_delta": 250}).execute()
+    assert rpc(db, "draw_titles", username="alice", titles=["天才", "無い称号"], equip="天才")["status"] == "unknown"
+    assert rpc(db, "draw_titles", username="alice", titles=["天才"], equip="神童")["status"] == "unknown"
+    r = rpc(db, "draw_titles", username="alice", titles=["天才", "天才"], equip="天才")
+    assert (r["status"], r["coins"], r["new"]) == ("ok", 50, ["天才"])
+    assert db.table("users").select("current_title").eq("username", "alice").execute().data[0]["current_title"] == "天才"
+    assert rpc(db, "draw_titles", username="alice", titles=["神童"], equip="神童")["status"] == "insufficient"
+    assert balance(db)["coins"] == 50
+
+
+def test_odds_come_from_gacha_pool(app):
+    db = app.supabase
+    assert app.gacha_table()["神童"] == ["SSR", 2]
+    pool = db.table("gacha_pool").select("*").execute().data
+    db.table("gacha_pool").update({"weight": 0}).neq("item", "覚醒者").execute()
+    app.shared().invalidate("catalog:")
+    try:
+        table = app.gacha_table()
+        assert app.roll_gacha(10, 1, table) == ["覚醒者"] * 10
+        assert app.rarest(["駆け出し", "覚醒者", "天才"], table) == "覚醒者"
+    finally:
+        db.table("gacha_pool").upsert(pool, on_conflict="item").execute()
+        app.shared().invalidate("catalog:")
+
+
+def test_same_seed_same_results(app):
+    table = app.gacha_table()
+    assert app.roll_gacha(10, 42, table) == app.roll_gacha(10, 42, table)
@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+import uuid
+import zipfile
+from datetime import date, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def user(app):
+    """ログの無い新しいユーザー"""
+    name = f"imp{uuid.uuid4().hex[:8]}"
+    assert app.add_user(name, "pw", name)[0]
+    return name
+
+
+def logs(app, u):
+    res = app.supabase.table("study_logs").select("study_date, duration_minutes").eq("username", u).order("study_date").execute()
+    return [(r["study_date"], r["duration_minutes"]) for r in res.data]
+
+
+def read_zip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        return {n: list(csv.DictReader(io.TextIOWrapper(zf.open(n), encoding="utf-8-sig"))) for n in zf.namelist()}
+
+
+def test_export_then_import_round_trip(app, user):
+    src = io.BytesIO("日付,科目,分\n2026-01-05,数学,30\n2026-01-06T08:00:00,英語,45\n".encode("utf-8"))
+    assert app.import_study_logs(user, src, "old.csv") == (2, 0, 75)
+    data = app.export_user_data(user)
+    assert isinstance(data, bytes)
+    files = read_zip(data)
+    assert [(r["study_date"], r["subject"], r["duration_minutes"]) for r in files["study_logs.csv"]] == [("2026-01-05", "数学", "30"), ("2026-01-06", "英語", "45")]
+    assert files["tasks.csv"] == []
+    # 書き出したファイルをもう一度取り込める
+    other = f"{user}b"
+    assert app.add_user(other, "pw", other)[0]
+    buf = io.BytesIO(zipfile.ZipFile(io.BytesIO(data)).read("study_logs.csv"))
+    assert app.import_study_logs(other, buf, "study_logs.csv") == (2, 0, 75)
+    assert logs(app, other) == logs(app, user)
+
+
+def test_bad_rows_are_skipped(app, user):
+    rows = [
+        {"date": "2026-02-01", "minutes": 20},
+        {"date": "not a date", "minutes": 20},
+        {"date": "2026-02-02", "minutes": 0},
+        {"date": "2026-02-03", "minutes": 12.5},
+        {"date": "2026-02-04", "minutes": 24 * 60 + 1},
+    ]
+    src = io.BytesIO("\n".join(json.dumps(r) for r in rows).encode())
+    assert app.import_study_logs(user, src, "x.jsonl") == (1, 4, 20)
+    assert logs(app, user) == [("2026-02-01", 20)]
+
+
+def test_future_dates_are_rejected(app, user):
+    tomorrow = date.today() + timedelta(days=1)
+    src = io.BytesIO(json.dumps([{"study_date": str(date.today()), "duration_minutes": 10}, {"study_date": str(tomorrow), "duration_minutes": 10}]).encode())
+    assert app.import_study_logs(user, src, "x.json") == (1, 1, 10)
+    assert logs(app, user) == [(str(date.today()), 10)]
+
+
+def test_json_array_size_is_capped(app, user, monkeypatch):
+    monkeypatch.setattr(app, "MAX_JSON_IMPORT_BYTES", 10)
+    with pytest.raises(ValueError):
+        app.import_study_logs(user, io.BytesIO(b'[{"date": "2026-01-01", "minutes": 5}]'), "x.json")
+    assert logs(app, user) == []
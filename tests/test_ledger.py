@@ -0,0 +1,30 @@
+from conftest import balance, rpc
+
+
+def test_revert_takes_back_only_what_the_log_granted(db):
+    rpc(db, "commit_study_log", username="alice", subject="英語", minutes=60, study_date="2026-01-05", today="2026-01-05")
+    assert balance(db) == {"xp": 60, "coins": 160}
+    log_id = db.table("study_logs").select("id").eq("username", "alice").execute().data[0]["id"]
+    rpc(db, "revert_study_log", username="alice", log_id=log_id)
+    # 目標達成のボーナスは残る (1日1回)
+    assert balance(db) == {"xp": 0, "coins": 100}
+
+
+def test_login_bonus_once_per_day(db):
+    first = rpc(db, "grant_login_bonus", username="alice", today="2026-01-05")
+    again = rpc(db, "grant_login_bonus", username="alice", today="2026-01-05")
+    assert (first["granted"], first["coins"]) == (True, 50)
+    assert (again["granted"], again["coins"]) == (False, 50)
+    assert rpc(db, "grant_login_bonus", username="alice", today="2026-01-06")["coins"] == 100
+
+
+def test_snapshot_rolls_forward_and_matches_rebuild(db):
+    old = [{"username": "alice", "reason": "opening", "xp_delta": i, "coin_delta": 1, "created_at": "2020-01-01T00:00:00.000+00:00"} for i in range(70)]
+    db.table("balance_ledger").insert(old).execute()
+    rpc(db, "commit_study_log", username="alice", subject="数学", minutes=5, study_date="2026-01-05", today="2026-01-05")
+    snap = db.table("balance_snapshots").select("*").eq("username", "alice").execute().data[0]
+    assert (snap["entries"], snap["xp"], snap["coins"]) == (70, sum(range(70)), 70)
+    want = {"xp": sum(range(70)) + 5, "coins": 75}
+    assert balance(db) == want
+    assert rpc(db, "rebuild_balance_snapshots") == 1
+    assert balance(db) == want
@@ -0,0 +1,40 @@
+import uuid
+
+
+def new_user(app):
+    name = f"log{uuid.uuid4().hex[:8]}"
+    assert app.add_user(name, "pw", name)[0]
+    return name
+
+
+def insert_logs(app, u, minutes, created_at="2026-01-05T10:00:00+00:00"):
+    """同じ created_at の行をまとめて入れる (一括取り込みや同時の書き込みと同じ形)"""
+    rows = [{"username": u, "duration_minutes": m, "study_date": "2026-01-05", "created_at": created_at} for m in minutes]
+    return [r["id"] for r in app.supabase.table("study_logs").insert(rows).execute().data]
+
+
+def test_keeps_only_recent_logs(app):
+    u = new_user(app)
+    ids = insert_logs(app, u, range(1, 8))
+    df = app.get_study_logs(u)
+    assert list(df["id"]) == ids[::-1][:app.RECENT_LOGS]
+    assert app._log_store(u)["last_id"] == ids[-1]
+
+
+def test_rows_with_same_created_at_are_not_missed(app):
+    u = new_user(app)
+    first = insert_logs(app, u, [10])
+    app.get_study_logs(u)
+    # 最後に見た行と同じ created_at の行も、id が大きければ取り込む
+    later = insert_logs(app, u, [20, 30])
+    assert [r["id"] for r in app.fetch_log_rows(u, app._log_store(u)["last_id"])] == later[::-1]
+    assert list(app.get_study_logs(u)["id"]) == later[::-1] + first
+    assert app.fetch_log_rows(u, app._log_store(u)["last_id"]) == []
+
+
+def test_delete_backfills_from_older_logs(app):
+    u = new_user(app)
+    ids = insert_logs(app, u, range(1, 8))
+    app.get_study_logs(u)
+    app.delete_study_log(ids[-1], u)
+    assert list(app.get_study_logs(u)["id"]) == ids[-2::-1][:app.RECENT_LOGS]
@@ -0,0 +1,23 @@
+import uuid
+from datetime import date, timedelta
+
+
+def new_user(app):
+    name = f"page{uuid.uuid4().hex[:8]}"
+    assert app.add_user(name, "pw", name)[0]
+    return name
+
+
+def log(app, u, day, minutes):
+    app.call_rpc("commit_study_log", {"p_username": u, "p_subject": "数学", "p_minutes": minutes, "p_study_date": str(day), "p_today": str(day)})
+
+
+def test_today_excludes_future_logs(app):
+    u = new_user(app)
+    today = date.today()
+    log(app, u, today - timedelta(days=1), 5)
+    log(app, u, today, 20)
+    log(app, u, today + timedelta(days=3), 40)
+    reads = app.start_reads(u)
+    assert int(reads["today"].result()["minutes"].sum()) == 20
+    assert app.day_minutes(u, {"range": ("", "")}, str(today + timedelta(days=3))) == 40
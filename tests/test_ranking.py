@@ -0,0 +1,13 @@
+from datetime import datetime
+
+from conftest import rpc
+from local_db import JST
+
+
+def test_weekly_ranking(db):
+    today = datetime.now(JST).date()
+    for u, m in (("alice", 30), ("bob", 90)):
+        rpc(db, "commit_study_log", username=u, subject="数学", minutes=m, study_date=str(today), today=str(today))
+    top = rpc(db, "weekly_top", limit=10)
+    assert [(r["rank"], r["username"], r["nickname"], r["duration_minutes"]) for r in top] == [(1, "bob", "Bob", 90), (2, "alice", "Alice", 30)]
+    assert [r["username"] for r in rpc(db, "weekly_rank_around", username="alice", radius=0)] == ["alice"]
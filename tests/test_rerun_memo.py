@@ -0,0 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import rerun_memo
+
+
+def test_once_per_rerun_across_threads():
+    calls = []
+    load = lambda: calls.append(1) or len(calls)
+    rerun_memo.begin()
+    with ThreadPoolExecutor(4) as pool:
+        got = [f.result() for f in [pool.submit(rerun_memo.bind(rerun_memo.current(), rerun_memo.per_rerun), "k", load) for _ in range(8)]]
+    assert got == [1] * 8 and rerun_memo.per_rerun("k", load) == 1
+    rerun_memo.forget()
+    assert rerun_memo.per_rerun("k", load) == 2
+    # 次の再実行では読み直す
+    rerun_memo.begin()
+    assert rerun_memo.per_rerun("k", load) == 3
+
+
+def test_without_memo_computes_every_time():
+    calls = []
+    load = lambda: calls.append(1) or len(calls)
+    with ThreadPoolExecutor(1) as pool:
+        assert [pool.submit(rerun_memo.per_rerun, "k", load).result() for _ in range(2)] == [1, 2]
@@ -0,0 +1,52 @@
+from datetime import date, timedelta
+
+import pandas as pd
+
+from conftest import rpc
+
+
+def log(db, subject, minutes, day="2026-01-05", user="alice"):
+    return rpc(db, "commit_study_log", username=user, subject=subject, minutes=minutes, study_date=day, today=day)
+
+
+def rollup(db, user="alice"):
+    res = db.table("study_daily_rollup").select("day, subject, minutes, sessions").eq("username", user).order("day").order("subject").execute()
+    return [(r["day"], r["subject"], r["minutes"], r["sessions"]) for r in res.data]
+
+
+def log_ids(db, user="alice"):
+    return [r["id"] for r in db.table("study_logs").select("id").eq("username", user).order("id").execute().data]
+
+
+def test_rollup_is_kept_per_day_and_subject(db):
+    log(db, "数学", 30)
+    log(db, "数学", 15)
+    log(db, "英語", 20)
+    log(db, "数学", 10, day="2026-01-06")
+    assert rollup(db) == [("2026-01-05", "数学", 45, 2), ("2026-01-05", "英語", 20, 1), ("2026-01-06", "数学", 10, 1)]
+    first, _, english, _ = log_ids(db)
+    rpc(db, "revert_study_log", username="alice", log_id=first)
+    rpc(db, "revert_study_log", username="alice", log_id=english)
+    # 最後の1件を戻した科目の行は消える
+    assert rollup(db) == [("2026-01-05", "数学", 15, 1), ("2026-01-06", "数学", 10, 1)]
+
+
+def test_rebuild_matches_incremental_rollup(db):
+    for day, subject, minutes in [("2026-01-05", "数学", 30), ("2026-01-05", "英語", 20), ("2026-01-07", "数学", 45)]:
+        log(db, subject, minutes, day)
+    log(db, "国語", 25, user="bob")
+    rpc(db, "revert_study_log", username="alice", log_id=log_ids(db)[1])
+    before, bob = rollup(db), rollup(db, "bob")
+    db.table("study_daily_rollup").delete().eq("username", "alice").execute()
+    assert rpc(db, "rebuild_study_rollup", username="alice") == 2
+    assert rollup(db) == before
+    # 他のユーザーの行には触れない
+    assert rollup(db, "bob") == bob
+
+
+def test_streak_counts_back_from_today_or_yesterday(app):
+    today = date.today()
+    days = lambda *ago: pd.DataFrame({"day": [str(today - timedelta(days=n)) for n in ago], "minutes": 10})
+    assert app.calc_streak(days(0, 1, 2, 4)) == 3
+    assert app.calc_streak(days(1, 2)) == 2
+    assert app.calc_streak(days(2, 3)) == 0
@@ -0,0 +1,51 @@
+import pytest
+
+from shared_cache import MemoryStore, SharedCache, SQLiteStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    return MemoryStore() if request.param == "memory" else SQLiteStore(str(tmp_path / "cache.db"))
+
+
+class Counter:
+    def __init__(self):
+        self.n = 0
+
+    def __call__(self):
+        self.n += 1
+        return {"n": self.n}
+
+
+def test_fresh_value_is_reused(store):
+    cache, compute = SharedCache(store), Counter()
+    assert cache.get_or_compute("k", 60, compute) == {"n": 1}
+    assert cache.get_or_compute("k", 60, compute) == {"n": 1}
+    assert compute.n == 1
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 1
+
+
+def test_expired_value_is_recomputed(store):
+    cache, compute = SharedCache(store), Counter()
+    cache.get_or_compute("k", 0, compute)
+    assert cache.get_or_compute("k", 0, compute) == {"n": 2}
+
+
+def test_stale_value_while_another_recomputes(store):
+    cache, compute = SharedCache(store), Counter()
+    cache.get_or_compute("k", 0, compute, stale=60)
+    assert store.try_lock("k", 30)
+    # 作り直しているのが他なら古い値を返し、自分では計算しない
+    assert cache.get_or_compute("k", 0, compute, stale=60) == {"n": 1}
+    assert compute.n == 1 and cache.stats["stale"] == 1
+    store.unlock("k")
+
+
+def test_invalidate_prefix(store):
+    cache, compute = SharedCache(store), Counter()
+    for k in ("ranking:top:10", "ranking:around:alice:2", "catalog:shop"): cache.get_or_compute(k, 60, compute)
+    cache.invalidate("ranking:")
+    assert store.get("ranking:top:10") is None and store.get("ranking:around:alice:2") is None
+    assert store.get("catalog:shop") is not None
+    cache.delete("catalog:shop")
+    assert store.get("catalog:shop") is None
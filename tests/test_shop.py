@@ -0,0 +1,25 @@
+from conftest import balance, rpc
+
+
+def test_purchase_item(db):
+    assert rpc(db, "purchase_item", username="alice", category="font", item="ピクセル風")["status"] == "insufficient"
+    assert db.table("user_items").select("*").eq("username", "alice").execute().data == []
+    db.table("balance_ledger").insert({"username": "alice", "reason": "opening", "coin_delta": 600}).execute()
+    r = rpc(db, "purchase_item", username="alice", category="font", item="ピクセル風")
+    assert (r["status"], r["coins"]) == ("ok", 100)
+    assert rpc(db, "purchase_item", username="alice", category="font", item="ピクセル風")["status"] == "owned"
+    assert rpc(db, "purchase_item", username="alice", category="font", item="無い書体")["status"] == "unknown"
+    assert balance(db)["coins"] == 100
+
+
+def test_purchase_uses_shop_items_price(db):
+    db.table("shop_items").update({"price": 50}).eq("category", "font").eq("item", "ピクセル風").execute()
+    db.table("balance_ledger").insert({"username": "alice", "reason": "opening", "coin_delta": 60}).execute()
+    assert rpc(db, "purchase_item", username="alice", category="font", item="ピクセル風")["coins"] == 10
+
+
+def test_new_user_starts_with_default_items(app):
+    assert app.add_user("dave", "pw", "Dave") == (True, "登録成功")
+    assert app.login_user("dave", "pw")[0]
+    assert app.fetch_inventory("dave") == {c: dict.fromkeys(items) for c, items in app.DEFAULT_ITEMS.items()}
+    assert app.fetch_balance("dave") == {"xp": 0, "coins": 0}
@@ -0,0 +1,36 @@
+import sqlite3
+
+import pytest
+
+from conftest import balance, rpc
+
+
+def test_commit_and_revert_study_log(db):
+    r = rpc(db, "commit_study_log", username="alice", subject="数学", minutes=30, study_date="2026-01-05", today="2026-01-05")
+    assert (r["xp"], r["coins"], r["goal_reached"]) == (30, 30, False)
+    log = db.table("study_logs").select("id, subject_id").eq("username", "alice").execute().data[0]
+    assert log["subject_id"] is not None
+    assert db.table("study_daily_rollup").select("minutes, sessions").eq("username", "alice").execute().data == [{"minutes": 30, "sessions": 1}]
+
+    r = rpc(db, "revert_study_log", username="alice", log_id=log["id"])
+    assert (r["minutes"], r["xp"], r["coins"]) == (30, 0, 0)
+    assert db.table("study_daily_rollup").select("*").eq("username", "alice").execute().data == []
+    # 二度目は何も戻さない
+    assert rpc(db, "revert_study_log", username="alice", log_id=log["id"]) == {"minutes": 0, "xp": None, "coins": None}
+    assert balance(db) == {"xp": 0, "coins": 0}
+
+
+def test_goal_bonus_once_per_day(db):
+    for _ in range(3):
+        rpc(db, "commit_study_log", username="alice", subject="数学", minutes=60, study_date="2026-01-05", today="2026-01-05")
+    goals = db.table("balance_ledger").select("coin_delta").eq("username", "alice").eq("reason", "goal").execute().data
+    assert goals == [{"coin_delta": 100}]
+    assert balance(db) == {"xp": 180, "coins": 280}
+
+
+def test_failed_rpc_rolls_back(db):
+    rpc(db, "commit_study_log", username="alice", subject="数学", minutes=10, study_date="2026-01-05", today="2026-01-05")
+    with pytest.raises(sqlite3.IntegrityError):
+        rpc(db, "commit_study_log", username="alice", subject="数学", minutes=None, study_date="2026-01-05", today="2026-01-05")
+    assert len(db.table("study_logs").select("id").eq("username", "alice").execute().data) == 1
+    assert balance(db) == {"xp": 10, "coins": 10}
@@ -0,0 +1,89 @@
+from datetime import date
+
+import pandas as pd
+
+from conftest import rpc
+
+
+def add_rule(db, freq="daily", start="2026-01-05", until=None):
+    return db.table("task_rules").insert({"username": "alice", "task_name": "単語", "priority": "中", "freq": freq, "start_date": start, "until_date": until}).execute().data[0]["id"]
+
+
+def add_task(db, day="2026-01-05", user="alice"):
+    return db.table("tasks").insert({"username": user, "task_name": "宿題", "status": "未完了", "due_date": day, "priority": "高"}).execute().data[0]["id"]
+
+
+def commit(db, action, task_ids=(), occ=()):
+    return rpc(db, "commit_tasks", username="alice", action=action, task_ids=list(task_ids), rule_ids=[r for r, _ in occ], days=[d for _, d in occ])
+
+
+def rewards(db):
+    return db.table("balance_ledger").select("ref, coin_delta").eq("username", "alice").eq("reason", "task").execute().data
+
+
+def test_complete_is_idempotent(db):
+    a, b = add_task(db), add_task(db)
+    r = commit(db, "complete", [a, b])
+    assert (r["completed"], r["xp"], r["coins"]) == (2, 20, 20)
+    # 二重クリック・再送しても報酬は増えない
+    assert commit(db, "complete", [a, b]) == {"completed": 0, "deleted": 0, "xp": None, "coins": None}
+    assert rewards(db) == [{"ref": f"{a},{b}", "coin_delta": 20}]
+
+
+def test_complete_ignores_other_users_tasks(db):
+    assert commit(db, "complete", [add_task(db, user="bob")])["completed"] == 0
+    assert rewards(db) == []
+
+
+def test_complete_occurrences_once(db):
+    rule = add_rule(db)
+    r = commit(db, "complete", occ=[(rule, "2026-01-06"), (rule, "2026-01-07")])
+    assert r["completed"] == 2
+    assert commit(db, "complete", occ=[(rule, "2026-01-06")])["completed"] == 0
+    rows = db.table("tasks").select("status, due_date").eq("rule_id", rule).order("due_date").execute().data
+    assert rows == [{"status": "完了", "due_date": "2026-01-06"}, {"status": "完了", "due_date": "2026-01-07"}]
+    assert len(rewards(db)) == 1
+
+
+def test_occurrence_must_exist(db):
+    weekly = add_rule(db, "weekly", start="2026-01-05", until="2026-01-31")
+    # 曜日が違う・開始前・終了後・他人のルールは無視する
+    r = commit(db, "complete", occ=[(weekly, "2026-01-06"), (weekly, "2026-01-01"), (weekly, "2026-02-02"), (weekly + 100, "2026-01-12")])
+    assert r["completed"] == 0
+    assert commit(db, "complete", occ=[(weekly, "2026-01-12")])["completed"] == 1
+
+
+def test_delete(db):
+    one_off, rule = add_task(db), add_rule(db)
+    done = commit(db, "complete", occ=[(rule, "2026-01-06")])
+    occ_id = db.table("tasks").select("id").eq("rule_id", rule).execute().data[0]["id"]
+    r = commit(db, "delete", [one_off, occ_id], occ=[(rule, "2026-01-08")])
+    assert r["deleted"] == 3
+    assert db.table("tasks").select("id").eq("id", one_off).execute().data == []
+    # 繰り返しの回は '削除' として残し、もう展開しない
+    rows = db.table("tasks").select("status, due_date").eq("rule_id", rule).order("due_date").execute().data
+    assert rows == [{"status": "削除", "due_date": "2026-01-06"}, {"status": "削除", "due_date": "2026-01-08"}]
+    assert done["completed"] == 1 and len(rewards(db)) == 1
+
+
+def test_expand_task_rules(app):
+    rules = [
+        {"id": 1, "task_name": "単語", "priority": "中", "freq": "weekly", "start_date": "2026-01-01", "until_date": None},
+        {"id": 2, "task_name": "音読", "priority": "低", "freq": "daily", "start_date": "2026-01-10", "until_date": "2026-01-12"},
+    ]
+    df = app.expand_task_rules(rules, date(2026, 1, 5), date(2026, 1, 20))
+    assert list(df["id"]) == ["r1:2026-01-08", "r1:2026-01-15", "r2:2026-01-10", "r2:2026-01-11", "r2:2026-01-12"]
+    assert set(df["status"]) == {"未完了"}
+    assert app.expand_task_rules([], date(2026, 1, 5), date(2026, 1, 20)).empty
+
+
+def test_task_store_hides_recorded_occurrences(app):
+    rules = [{"id": 1, "task_name": "単語", "priority": "中", "freq": "daily", "start_date": "2026-01-05", "until_date": None}]
+    tasks = pd.DataFrame([
+        {"id": 10, "task_name": "単語", "status": "完了", "due_date": "2026-01-05", "priority": "中", "rule_id": 1},
+        {"id": 11, "task_name": "単語", "status": "削除", "due_date": "2026-01-06", "priority": "中", "rule_id": 1},
+        {"id": 12, "task_name": "宿題", "status": "未完了", "due_date": "2026-01-06", "priority": "高", "rule_id": None},
+    ])
+    store = app.task_store(tasks, rules, date(2026, 1, 5), date(2026, 1, 8))
+    assert list(store["id"]) == [10, 12, "r1:2026-01-07"]
+    assert list(app.tasks_on(store, "2026-01-06")["id"]) == [12]
@@ -0,0 +1,40 @@
+import base64
+import io
+import os
+
+from PIL import Image
+from streamlit.testing.v1 import AppTest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "streamlit_app.py")
+
+
+def png(color):
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 36), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def login(u):
+    at = AppTest.from_file(APP, default_timeout=30)
+    at.run()
+    at.selectbox[0].set_value("ログイン").run()
+    at.text_input[0].input(u)
+    at.text_input[1].input("pw")
+    next(b for b in at.button if b.label == "ログイン").click().run()
+    return at
+
+
+def test_legacy_wallpaper_moves_to_hash_store_in_background(app):
+    db = app.supabase
+    data = png("red")
+    assert app.add_user("legacywp", "pw", "Legacy")[0]
+    db.table("users").update({"current_wallpaper": "カスタム", "custom_bg_data": base64.b64encode(data).decode()}).eq("username", "legacywp").execute()
+    at = login("legacywp")
+    assert not at.exception and at.session_state["legacy_wallpaper_tried"]
+    for _ in range(20):
+        row = db.table("users").select("custom_bg_hash, custom_bg_data").eq("username", "legacywp").execute().data[0]
+        if row["custom_bg_hash"]: break
+        at.run()
+    assert row == {"custom_bg_hash": app.content_hash(data), "custom_bg_data": None}
+    assert app.has_wallpaper(row["custom_bg_hash"])
+    assert at.session_state["wallpaper_job"] is None
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+from write_behind import WriteBehind
+
+
+class Recorder:
+    """書き込みを順に記録する。fail 回だけ失敗し、gate があれば開くまで止まる"""
+
+    def __init__(self, fail=0, gate=None):
+        self.writes, self.fail, self.gate = [], fail, gate
+        self.started = threading.Event()
+
+    def __call__(self, key, fields):
+        self.started.set()
+        if self.gate: self.gate.wait(5)
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("write failed")
+        self.writes.append((key, dict(fields)))
+
+
+@pytest.fixture
+def make():
+    queues = []
+
+    def make(write, **kw):
+        wb = WriteBehind(write, **{"delay": 60, "max_delay": 60, "retry": 60, **kw})
+        queues.append(wb)
+        return wb
+    yield make
+    for wb in queues: wb.close()
+
+
+def wait_for(cond, timeout=5):
+    deadline = time.time() + timeout
+    while not cond():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_puts_are_coalesced(make):
+    rec = Recorder()
+    wb = make(rec)
+    wb.put("alice", {"font": "A"})
+    wb.put("alice", {"font": "B", "goal": 90})
+    wb.put("bob", {"goal": 30})
+    assert wb.pending("alice") == {"font": "B", "goal": 90}
+    assert rec.writes == []
+    assert wb.flush("alice")
+    assert rec.writes == [("alice", {"font": "B", "goal": 90})]
+    assert wb.pending("alice") == {} and wb.pending("bob") == {"goal": 30}
+
+
+def test_written_after_delay(make):
+    rec = Recorder()
+    wb = make(rec, delay=0.05)
+    wb.put("alice", {"font": "A"})
+    wb.put("alice", {"font": "B"})
+    wait_for(lambda: rec.writes)
+    assert rec.writes == [("alice", {"font": "B"})]
+
+
+def test_max_delay_bounds_a_steady_stream(make):
+    rec = Recorder()
+    wb = make(rec, delay=0.2, max_delay=0.3)
+    start = time.time()
+    while not rec.writes:
+        wb.put("alice", {"n": time.time()})
+        assert time.time() - start < 2
+        time.sleep(0.05)
+    assert time.time() - start < 0.6
+
+
+def test_flush_before_a_direct_write(make):
+    """待っている変更は、同じ行への直接の書き込み (RPC) より前に書き終わる"""
+    rows = {"alice": {"title": "見習い"}}
+    wb = make(lambda k, f: rows[k].update(f))
+    wb.put("alice", {"title": "天才"})
+    wb.flush("alice")
+    rows["alice"]["title"] = "神童"  # ガチャの装備
+    wb.close()
+    assert rows["alice"]["title"] == "神童"
+
+
+def test_newer_value_waits_for_write_in_flight(make):
+    gate = threading.Event()
+    rec = Recorder(gate=gate)
+    wb = make(rec)
+    wb.put("alice", {"font": "A"})
+    t = threading.Thread(target=wb.flush, args=("alice",))
+    t.start()
+    rec.started.wait(5)
+    wb.put("alice", {"font": "B"})
+    # 書き込み中の値も読み直しに重ねる
+    assert wb.pending("alice") == {"font": "B"}
+    done = threading.Thread(target=wb.flush, args=("alice",))
+    done.start()
+    gate.set()
+    t.join(5); done.join(5)
+    assert rec.writes == [("alice", {"font": "A"}), ("alice", {"font": "B"})]
+
+
+def test_failed_write_is_retried_with_newer_changes_on_top(make):
+    rec = Recorder(fail=1)
+    wb = make(rec)
+    wb.put("alice", {"font": "A", "goal": 60})
+    assert not wb.flush("alice")
+    assert wb.stats["errors"] == 1
+    wb.put("alice", {"font": "B"})
+    assert wb.flush("alice")
+    assert rec.writes == [("alice", {"font": "B", "goal": 60})]
+
+
+def test_close_writes_everything(make):
+    rec = Recorder()
+    wb = make(rec)
+    wb.put("alice", {"font": "A"})
+    wb.put("bob", {"goal": 30})
+    assert wb.close()
+    assert sorted(rec.writes) == [("alice", {"font": "A"}), ("bob", {"goal": 30})]
+    # 止めた後はその場で書く
+    wb.put("alice", {"font": "B"})
+    assert rec.writes[-1] == ("alice", {"font": "B"})
+
+
+def test_gacha_equip_is_not_overwritten_by_queued_title(app):
+    db = app.supabase
+    db.table("users").insert({"username": "carol", "password": "x", "nickname": "Carol"}).execute()
+    db.table("balance_ledger").insert({"username": "carol", "reason": "opening", "coin_delta": 100}).execute()
+    user = {"username": "carol", "inventory": {}}
+    app.save_prefs(user, {"current_title": "見習い"})
+    status, result = app.draw_titles(user, 1, seed=1)
+    assert status == "ok"
+    app.pref_writer().flush()
+    assert db.table("users").select("current_title").eq("username", "carol").execute().data[0]["current_title"] == result["equip"]
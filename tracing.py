@@ -0,0 +1,199 @@
+# バックエンド呼び出しのトレース
+# クライアント (Supabase / local_db) を包み、execute() ごとにテーブル・操作・条件・所要時間・
+# 行数・転送量・呼び出し元を記録する。記録は再実行ごとのリスト (ウォーターフォール表示用) と、
+# プロセス全体の集計 (呼び出し元ごとの回数・レイテンシのヒストグラム) の両方に入る。
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+APP_FILE = "streamlit_app.py"
+# レイテンシのヒストグラムの境界 (秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# 1回の再実行で保持する呼び出しの上限 (run_every のフラグメントが同じトレースへ足し続けても増えすぎないように)
+MAX_CALLS = 500
+_FILTERS = {"eq": "=", "neq": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "in_": "in"}
+_OPS = {"select", "insert", "upsert", "update", "delete"}
+
+_local = threading.local()
+
+
+# --- 再実行ごとのトレース ---
+class Trace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add(self, call):
+        with self._lock:
+            if len(self.calls) < MAX_CALLS: self.calls.append(call)
+
+
+def begin_trace():
+    """描画スレッドで再実行の最初に呼ぶ"""
+    _local.trace = Trace()
+    return _local.trace
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+def bind(trace, fn):
+    """別スレッドで実行する関数に、呼び出し元の再実行のトレースを引き継ぐ"""
+    def run(*args, **kwargs):
+        prev = current_trace()
+        _local.trace = trace
+        try: return fn(*args, **kwargs)
+        finally: _local.trace = prev
+    return run
+
+
+# --- プロセス全体の集計 ---
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, site, table, op, seconds, n_bytes):
+        with self._lock:
+            s = self.series.setdefault((site, table, op), {"count": 0, "sum": 0.0, "bytes": 0, "buckets": [0] * len(BUCKETS)})
+            s["count"] += 1
+            s["sum"] += seconds
+            s["bytes"] += n_bytes
+            for i, b in enumerate(BUCKETS):
+                if seconds <= b: s["buckets"][i] += 1
+
+    def prometheus(self):
+        """Prometheus のテキスト形式 (node_exporter の textfile collector で読める)"""
+        lines = [
+            "# HELP study_app_backend_call_seconds Backend call latency by call site.",
+            "# TYPE study_app_backend_call_seconds histogram",
+        ]
+        byte_lines = [
+            "# HELP study_app_backend_call_bytes_total Result payload bytes by call site.",
+            "# TYPE study_app_backend_call_bytes_total counter",
+        ]
+        with self._lock:
+            for (site, table, op), s in sorted(self.series.items()):
+                labels = f'site="{site}",table="{table}",op="{op}"'
+                for b, n in zip(BUCKETS, s["buckets"]):
+                    lines.append(f'study_app_backend_call_seconds_bucket{{{labels},le="{b}"}} {n}')
+                lines.append(f'study_app_backend_call_seconds_bucket{{{labels},le="+Inf"}} {s["count"]}')
+                lines.append(f"study_app_backend_call_seconds_sum{{{labels}}} {s['sum']:.6f}")
+                lines.append(f"study_app_backend_call_seconds_count{{{labels}}} {s['count']}")
+                byte_lines.append(f"study_app_backend_call_bytes_total{{{labels}}} {s['bytes']}")
+        return "\n".join(lines + byte_lines) + "\n"
+
+
+METRICS = Metrics()
+# export_metrics で一緒に書き出す行を返す関数 (接続プールの状態など)
+COLLECTORS = []
+_export = {"at": 0.0, "lock": threading.Lock()}
+
+
+def export_metrics(path, every=10.0):
+    """集計を path へ書き出す (every 秒に1回まで)。一時ファイルから置き換えるので読み手が途中の状態を見ない"""
+    if not path: return
+    with _export["lock"]:
+        if time.monotonic() - _export["at"] < every: return
+        _export["at"] = time.monotonic()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    extra = [line for collect in COLLECTORS for line in collect()]
+    with open(tmp, "w") as f: f.write(METRICS.prometheus() + "".join(f"{line}\n" for line in extra))
+    os.replace(tmp, path)
+
+
+# --- 記録 ---
+def _call_site():
+    f = sys._getframe(2)
+    while f is not None:
+        if os.path.basename(f.f_code.co_filename) == APP_FILE and f.f_code.co_name not in ("call_rpc",):
+            return f"{f.f_code.co_name}:{f.f_lineno}"
+        f = f.f_back
+    return "?"
+
+
+def _size(data):
+    try: return len(json.dumps(data, default=str, ensure_ascii=False).encode())
+    except Exception: return 0
+
+
+@contextmanager
+def span(table, op, filters=""):
+    """1回のバックエンド呼び出しを記録する。yield した dict の "data" に結果を入れる"""
+    site = _call_site()
+    rec = {"data": None}
+    start = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        end = time.perf_counter()
+        data = rec["data"]
+        n_bytes = _size(data)
+        METRICS.observe(site, table, op, end - start, n_bytes)
+        trace = current_trace()
+        if trace is not None:
+            trace.add({
+                "site": site, "table": table, "op": op, "filters": filters,
+                "start_ms": (start - trace.started) * 1000, "ms": (end - start) * 1000,
+                "rows": len(data) if isinstance(data, list) else (1 if data else 0), "bytes": n_bytes,
+                "thread": threading.current_thread().name,
+            })
+
+
+# --- クライアントのラッパー ---
+class TracedQuery:
+    def __init__(self, inner, table):
+        self._inner = inner
+        self._table = table
+        self._op = "select"
+        self._filters = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if not callable(attr): return attr
+
+        def call(*args, **kwargs):
+            if name in _OPS: self._op = name
+            elif name in _FILTERS and args: self._filters.append(f"{args[0]}{_FILTERS[name]}{args[1] if len(args) > 1 else ''}"[:80])
+            elif name == "order" and args: self._filters.append(f"order {args[0]}{' desc' if kwargs.get('desc') else ''}")
+            elif name == "limit" and args: self._filters.append(f"limit {args[0]}")
+            self._inner = attr(*args, **kwargs)
+            return self
+        return call
+
+    def execute(self):
+        with span(self._table, self._op, " ".join(self._filters)) as rec:
+            res = self._inner.execute()
+            rec["data"] = getattr(res, "data", None)
+            return res
+
+
+class TracedRpc:
+    def __init__(self, inner, name, params):
+        self._inner, self._name, self._params = inner, name, params
+
+    def execute(self):
+        with span(f"rpc:{self._name}", "rpc") as rec:
+            res = self._inner.rpc(self._name, self._params).execute()
+            rec["data"] = getattr(res, "data", None)
+            return res
+
+
+class TracedClient:
+    """table() と rpc() を記録つきにし、それ以外はそのまま元のクライアントへ渡す"""
+
+    def __init__(self, inner):
+        self._inner = inner
+
+    def table(self, name):
+        return TracedQuery(self._inner.table(name), name)
+
+    def __getattr__(self, name):
+        if name == "rpc" and hasattr(self._inner, "rpc"):
+            return lambda fn, params=None: TracedRpc(self._inner, fn, params or {})
+        return getattr(self._inner, name)
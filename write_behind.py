@@ -0,0 +1,104 @@
+# 書き込みを後回しにしてまとめるキュー (write-behind)
+# 設定 (フォント・壁紙・目標・称号) のように、短い間に何度も上書きされる書き込みに使う。
+# put(key, fields) はすぐ戻り、同じ key への変更は後の値で上書きして1つにまとめる。
+# 最後の put から delay 秒たつか、最初の put から max_delay 秒たったら、バックグラウンドのスレッドが
+# write(key, fields) を1回だけ呼ぶ。flush(key) は待たずに書き込み、close() は残りをすべて書いてから止める。
+#
+# 同じ key の書き込みは同時に1つだけ (古い値が新しい値を追い越さない)。
+# 書き込みに失敗した分は、その後の変更を優先して戻し、retry 秒後にもう一度書く。
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+CLOSE_ATTEMPTS = 3
+
+
+class WriteBehind:
+    def __init__(self, write, delay=2.0, max_delay=10.0, retry=5.0):
+        self.write = write
+        self.delay, self.max_delay, self.retry = delay, max_delay, retry
+        self._cond = threading.Condition()
+        self._pending = {}  # key -> [fields, 最初の put の時刻, 書き込む時刻]
+        self._writing = {}  # key -> 書き込み中の fields
+        self._closed = False
+        self.stats = {"puts": 0, "writes": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, key, fields):
+        if self._closed:
+            # 止めた後に来た変更はその場で書く
+            self.write(key, dict(fields))
+            return
+        now = time.time()
+        with self._cond:
+            p = self._pending.setdefault(key, [{}, now, now])
+            p[0].update(fields)
+            p[2] = min(now + self.delay, p[1] + self.max_delay)
+            self.stats["puts"] += 1
+            self._cond.notify_all()
+
+    def pending(self, key):
+        """まだ書き終わっていない変更 (読み直した値の上に重ねる)"""
+        with self._cond:
+            return {**self._writing.get(key, {}), **(self._pending[key][0] if key in self._pending else {})}
+
+    def flush(self, key=None):
+        """key (None ならすべて) の変更を今すぐ書き込む。すべて書けたら True"""
+        with self._cond: keys = list(self._pending) if key is None else [key]
+        return all([self._write(k) for k in keys])
+
+    def close(self):
+        """残りをすべて書き込んでから止める (プロセスの終了時に atexit から呼ぶ)"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=30)
+        for _ in range(CLOSE_ATTEMPTS):
+            if self.flush(): return True
+        log.error("write-behind: %d 件を書き込めませんでした", len(self._pending))
+        return False
+
+    def _write(self, key):
+        with self._cond:
+            while key in self._writing: self._cond.wait()
+            p = self._pending.pop(key, None)
+            if p is None: return True
+            self._writing[key] = p[0]
+        try:
+            self.write(key, p[0])
+            ok = True
+        except Exception:
+            log.exception("write-behind: %s の書き込みに失敗しました", key)
+            ok = False
+        with self._cond:
+            del self._writing[key]
+            if ok:
+                self.stats["writes"] += 1
+            else:
+                self.stats["errors"] += 1
+                newer = self._pending.get(key)
+                self._pending[key] = [{**p[0], **(newer[0] if newer else {})}, p[1], time.time() + self.retry]
+            self._cond.notify_all()
+        return ok
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed: return
+                    now = time.time()
+                    waiting = [(p[2], k) for k, p in self._pending.items() if k not in self._writing]
+                    due = [k for t, k in waiting if t <= now]
+                    if due: break
+                    self._cond.wait(min(waiting)[0] - now if waiting else None)
+            for k in due: self._write(k)
+
+    def prometheus(self):
+        with self._cond: stats, queued = dict(self.stats), len(self._pending)
+        return (
+            ["# TYPE study_app_write_behind_total counter"]
+            + [f'study_app_write_behind_total{{result="{k}"}} {v}' for k, v in stats.items()]
+            + ["# TYPE study_app_write_behind_pending gauge", f"study_app_write_behind_pending {queued}"]
+        )